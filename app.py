@@ -1,30 +1,61 @@
 import streamlit as st
 import json
+import abc
+import copy
 import os
+import sys
+import importlib
+import importlib.util
 import time
 import base64
 import datetime
 import re
+import queue
+import threading
+import uuid
+import hashlib
+import weakref
+import shutil
+import tempfile
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as wait_futures
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from urllib.parse import quote
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageChops, ImageOps, ImageStat
 
 # --- KÜTÜPHANE KONTROLLERİ ---
-try:
-    from google import genai
-    from google.genai import types
-    from google.api_core.exceptions import ResourceExhausted, NotFound, InvalidArgument, Unauthenticated
-except ImportError:
+class LazyModule:
+    """
+    İlk öznitelik erişiminde içe aktarılan modül vekili. Gemini SDK ilk analizde, Firebase ilk bridge
+    kullanımında yüklenir; soğuk açılışta arayüz bu kütüphaneleri beklemeden çizilir (bkz. start_warmup).
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Kurulu mu diye sadece bakılır (içe aktarmadan)
+if importlib.util.find_spec("google.genai") is None:
     st.error("Google GenAI eksik.")
     st.stop()
-
-try:
-    import firebase_admin
-    from firebase_admin import credentials, db
-except ImportError:
+if importlib.util.find_spec("firebase_admin") is None:
     st.error("Firebase Admin eksik.")
     st.stop()
 
+genai = LazyModule("google.genai")
+types = LazyModule("google.genai.types")
+firebase_admin = LazyModule("firebase_admin")
+credentials = LazyModule("firebase_admin.credentials")
+db = LazyModule("firebase_admin.db")
+firebase_exceptions = LazyModule("firebase_admin.exceptions")
+np = LazyModule("numpy")
+pytesseract = LazyModule("pytesseract")  # Opsiyonel: yoksa yerel veri çıkarımı atlanır (bkz. ocr_available)
+
 # ==========================================
 # ⚙️ AYARLAR
 # ==========================================
@@ -33,6 +64,130 @@ MODEL_FLASH = 'gemini-2.5-flash'
 MODEL_LITE  = 'gemini-2.5-flash-lite'
 LOCAL_KEY_FILE = "api_keys.txt"
 
+# BRIDGE (İstek başına ayrı düğüm: bridge/requests/<id> -> bridge/responses/<id>)
+BRIDGE_REQUESTS_PATH = "bridge/requests"
+BRIDGE_RESPONSES_PATH = "bridge/responses"
+BRIDGE_SYSTEM_COMMAND_PATH = "bridge/system_command"
+BRIDGE_WAKE_STATUSES = ('waiting_user_selection', 'completed', 'miniapp_waiting_upload', 'timeout', 'error')
+BRIDGE_FINAL_STATUSES = ('completed', 'timeout', 'error')  # İş hangi adımda olursa olsun uygulanır
+BRIDGE_STEP_STATUSES = {'show_buttons': 'waiting_user_selection', 'upload_wait': 'miniapp_waiting_upload'}
+BRIDGE_QUEUE_TICK_SEC = 0.3      # Sadece yerel kuyruk kontrolü (ağ isteği yok)
+BRIDGE_FALLBACK_POLL_SEC = 1.0   # listen() kullanılamazsa arka plan yoklama aralığı
+
+# İSTEK BİRLEŞTİRME (Aynı bot + komut + hisse: süreç genelinde tek bridge isteği)
+BRIDGE_COALESCE_TTL_SEC = {      # Gelen görsel bu süre boyunca yeni isteklere doğrudan verilir (0: sadece uçuştakine bağlan)
+    "derinlik": 10, "teorik": 10, "teorikliste": 10, "yukselendusen": 15, "sinyal": 15,
+    "akd": 30, "akdpro": 30, "genelakd": 30, "endeks": 30, "haber": 60,
+    "takas": 300, "kurum": 300, "kurumlar": 300, "bofa": 300,
+}
+BRIDGE_COALESCE_DEFAULT_TTL_SEC = 15
+BRIDGE_COALESCE_MAX_RESULTS = 64     # Bellekte tutulan en fazla son görsel
+BRIDGE_COALESCE_JOIN_SEC = 120       # Bundan eski uçuştaki isteğe yeni oturum bağlanmaz (yeni istek açılır)
+BRIDGE_COALESCE_STALE_SEC = 3600     # Sahibi bırakılmamış (oturumu kapanmış) kayıtlar bu süre sonunda düşer
+
+# GÖRSEL TAŞIMA (Yanıtta sadece hash + yol/URL taşınır, görselin kendisi değil)
+IMAGE_TRANSPORT = "storage"      # storage | local | memory
+FIREBASE_STORAGE_BUCKET = "geminiborsa-f9a80.appspot.com"
+IMAGE_STORAGE_PREFIX = "bridge_images"
+LOCAL_IMAGE_DIR = "bridge_images"
+IMAGE_FETCH_CHUNK = 256 * 1024
+
+# GÖRSEL ÖN İŞLEME (Gemini'ye yüklemeden önce)
+IMAGE_MAX_EDGE = 2048            # Uzun kenar üst sınırı; derinlik/AKD rakamları okunur kalır
+IMAGE_UPLOAD_FORMAT = "WEBP"     # WEBP | JPEG | PNG
+IMAGE_UPLOAD_QUALITY = 90
+IMAGE_UPLOAD_LOSSLESS = True     # WEBP kayıpsız: ince kırmızı/yeşil rakamlar bulanıklaşmaz (düz ekran görüntüsünde kayıplıdan da küçük)
+IMAGE_AUTO_CROP = True           # Kenarlardaki tek renk boşlukları kırp
+IMAGE_CROP_TOLERANCE = 12
+
+# KEY HAVUZU (Kota/yoğunlukta sıradaki sağlıklı keye geçilir)
+KEY_RPM_LIMIT = 10               # Key başına dakikalık istek sınırı
+KEY_TPM_LIMIT = 250_000          # Key başına dakikalık token sınırı
+KEY_COOLDOWN_BASE_SEC = 15       # Kota hatasında ilk soğuma; her tekrarda 2 katına çıkar
+KEY_COOLDOWN_MAX_SEC = 600
+KEY_OVERLOAD_COOLDOWN_SEC = 5    # 503/overloaded: kısa soğuma, ceza büyümez
+KEY_MAX_WAIT_SEC = 30            # Tüm keyler soğumadaysa en fazla bu kadar beklenir
+KEY_MAX_FAILOVERS = 8
+KEY_TEST_WORKERS = 8             # KEY TESTİ paralel istek sayısı
+KEY_TEST_TIMEOUT_SEC = 10        # İstek başına zaman aşımı
+KEY_TEST_CACHE_TTL_SEC = 120     # Test sonuçları bu süre boyunca yeniden kullanılır (zamanlayıcı dahil)
+
+# PARALEL (SHARDED) ANALİZ: 30 bölüm gruplara ayrılır, her grup ayrı keyle eşzamanlı üretilir
+SHARD_GROUPS = [
+    ("Derinlik / AKD", [1, 2, 3, 4, 5, 6, 12, 14, 16, 17, 19, 23, 24]),
+    ("Teknik / Mum", [7, 8, 9, 13, 15, 18, 21, 22, 25, 26, 27]),
+    ("Risk / Final Karar", [10, 11, 20, 28, 29, 30]),
+]
+
+# CANLI YAYIN (Streaming) GÖRÜNTÜLEME
+STREAM_RENDER_FPS = 2            # Çalışan analiz işine bağlı panelin saniyedeki yenilenme sayısı
+EXPECTED_SECTION_COUNT = 30      # İlerleme çubuğu bölüm sayısına göre ilerler
+
+# ARKA PLAN ANALİZ İŞLERİ (Rerun / sekme yenileme / bağlantı kopması analizi durdurmaz)
+JOB_WORKERS = 4                  # Süreç genelinde aynı anda çalışan analiz sayısı
+JOB_RESULT_TTL_SEC = 3600        # Biten işin sonucu bu süre boyunca yeniden bağlanılabilir tutulur
+JOB_MAX_RESULTS = 100
+
+# METRİKLER (İstek -> görsel -> analiz hattındaki gecikme / verim ölçümleri)
+METRICS_WINDOW = 1000            # Seri başına tutulan son ölçüm sayısı (p50/p95 bu pencereden hesaplanır)
+METRICS_EXPORT_FILE = "metrics.json"
+METRICS_PROMETHEUS_PORT = None   # Örn. 9108: http://sunucu:9108/metrics (Prometheus metin formatı); None: kapalı
+
+# BAĞLANTI HAVUZU (key başına tek genai.Client, yol başına tek RTDB Reference; süreç geneli)
+CLIENT_REF_CACHE_SIZE = 512      # Önbellekte tutulan en fazla Reference (istek yolları tamamlanınca düşer)
+
+# PAYLAŞILAN DURUM (Birden fazla replika: key sağlığı, analiz sonuçları, iş ve bridge durumu tek depoda)
+STATE_BACKEND = "memory"         # memory: süreç içi (tek sunucu) | firebase: RTDB, atomik transaction (tüm replikalar)
+STATE_ROOT = "shared_state"
+STATE_JOB_PUBLISH_SEC = 1.0      # Çalışan işin ilerlemesi depoya en fazla bu sıklıkta yazılır
+STATE_JOB_STALE_SEC = 60         # Bu süredir güncellenmeyen "çalışıyor" işin sunucusu kapanmış sayılır
+STATE_SWEEP_SEC = 60             # Sahipsiz bridge kayıtları bu aralıkla temizlenir
+
+# BAĞLAM ÖNBELLEĞİ (Sabit sistem talimatı key + model başına sunucuda bir kez kaydedilir, isteklerde tanıtıcısı gönderilir)
+PROMPT_CACHE_ENABLED = True
+PROMPT_CACHE_TTL_SEC = 3600
+PROMPT_CACHE_REFRESH_SEC = 300   # Süre dolmasına bu kadar kala TTL uzatılır
+PROMPT_CACHE_RETRY_SEC = 900     # Oluşturulamazsa (desteklenmiyor / token alt sınırı) bu süre boyunca düz talimat gönderilir
+
+# WATCHLIST (Toplu tarama: hisse listesi -> bot istekleri -> analiz -> karar tablosu)
+WATCHLIST_CONCURRENCY = 4               # Aynı anda işlenen hisse sayısı (arayüzden değiştirilebilir)
+WATCHLIST_BRIDGE_TIMEOUT_SEC = 180      # Bir hissenin bot görsellerini bekleme süresi
+WATCHLIST_DEFAULT_COMMANDS = ("derinlik", "akd", "takas")
+WATCHLIST_SELECTIONS = {}               # Seçim isteyen komutta gönderilecek seçenek (komut -> metin); yoksa ilk seçenek
+WATCHLIST_REFRESH_SEC = 1.0             # Tablo yenileme aralığı (sadece tarama sürerken)
+
+# GÖRSEL DEPOSU (Oturum başına; çözülmüş bitmap değil sıkıştırılmış bayt + önizleme)
+IMAGE_STORE_MAX_BYTES = 24 * 1024 * 1024   # Oturum başına bellek sınırı
+IMAGE_STORE_SPILL = True                    # Sınır aşılınca eski görseller geçici klasöre taşınır (False: silinir)
+THUMBNAIL_WIDTH = 320
+THUMBNAIL_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Süreç geneli önizleme önbelleği (tüm oturumlar)
+PREPARED_CACHE_MAX_BYTES = 64 * 1024 * 1024   # Süreç geneli ön işlenmiş görsel önbelleği (kaynak hash'ine göre)
+
+# YEREL VERİ ÇIKARIMI (Derinlik/AKD tabloları OCR ile okunur, rapordaki hesaplar modele kesin veri olarak verilir)
+LOCAL_EXTRACTION_ENABLED = True  # pytesseract + tesseract kurulu değilse kendiliğinden atlanır
+OCR_LANG = "tur+eng"
+OCR_CONFIG = "--psm 6"           # Tek blok düzenli tablo
+OCR_SCALE = 2                    # Küçük rakamlar için okuma öncesi büyütme
+OCR_TIMEOUT_SEC = 20
+OCR_WORKERS = 4                  # Görseller paralel okunur (süreç geneli havuz)
+OCR_PROMPT_WAIT_SEC = 3.0        # İlk Gemini isteği tablolar için en fazla bu kadar bekler; kalan okuma arka planda sürer
+OCR_MIN_ROWS = 3                 # Bundan az geçerli satır okunursa tablo tanınmamış sayılır
+EXTRACTION_CACHE_MAX_ENTRIES = 256
+# Satırdaki sayı adedine göre sütun sırası (botun ekran düzenine göre değiştirilebilir)
+DEPTH_LAYOUTS = {
+    6: ("bid_orders", "bid_lots", "bid_price", "ask_price", "ask_lots", "ask_orders"),
+    4: ("bid_lots", "bid_price", "ask_price", "ask_lots"),
+}
+AKD_LAYOUTS = {
+    5: ("buy", "sell", "net", "pct", "cost"),
+    4: ("buy", "sell", "net", "cost"),
+}
+
+# ANALİZ ÖNBELLEĞİ (Aynı görseller + model + talimat = aynı rapor)
+ANALYSIS_CACHE_DIR = ".analysis_cache"
+ANALYSIS_CACHE_TTL_SEC = 12 * 3600
+ANALYSIS_CACHE_MAX_ENTRIES = 200
+
 # BOT YAPILANDIRMASI
 BOT_CONFIGS = {
     "xFinans": {
@@ -93,12 +248,14 @@ BOT_CONFIGS = {
 # ==========================================
 # 🔧 SESSION
 # ==========================================
-if 'telegram_flow' not in st.session_state: st.session_state['telegram_flow'] = {'step': 'idle', 'symbol': '', 'options': []}
-if 'telegram_images' not in st.session_state: st.session_state['telegram_images'] = []
-if 'key_index' not in st.session_state: st.session_state['key_index'] = 0
-if 'dynamic_key_pool' not in st.session_state: st.session_state['dynamic_key_pool'] = []
-if 'selected_bot_key' not in st.session_state: st.session_state['selected_bot_key'] = "xFinans"
-if 'analysis_result' not in st.session_state: st.session_state['analysis_result'] = None 
+def init_session():
+    """Oturum durumunu hazırlar (main() başında; modül import edilince hiçbir şey çalışmaz, örn. benchmark.py)."""
+    if 'bridge_jobs' not in st.session_state: st.session_state['bridge_jobs'] = {}  # istek ID -> {step, symbol, type, bot, options}
+    if 'dynamic_key_pool' not in st.session_state: st.session_state['dynamic_key_pool'] = []
+    if 'selected_bot_key' not in st.session_state: st.session_state['selected_bot_key'] = "xFinans"
+    if 'analysis_result' not in st.session_state: st.session_state['analysis_result'] = None 
+    if not st.session_state['dynamic_key_pool']:
+        load_keys_from_disk()
 
 # --- KALICI HAFIZA ---
 def load_keys_from_disk():
@@ -114,130 +271,1728 @@ def save_keys_to_disk(keys_list):
         f.write("\n".join(clean_keys))
     st.session_state['dynamic_key_pool'] = clean_keys
 
-if not st.session_state['dynamic_key_pool']:
-    load_keys_from_disk()
-
 # ==========================================
 # 🔥 FIREBASE
 # ==========================================
+def firebase_ready():
+    """Firebase bu süreçte başlatıldı mı? (Kütüphaneyi içe aktarmadan bakar)"""
+    module = sys.modules.get("firebase_admin")
+    return module is not None and bool(module._apps)
+
+@st.cache_resource(show_spinner=False)
+def get_firebase_app():
+    """Firebase'i süreç başına bir kez başlatır (Streamlit'e dokunmaz; hata istisna olarak döner, önbelleğe girmez)."""
+    if firebase_admin._apps: return firebase_admin.get_app()
+    if os.path.exists("firebase_key.json"):
+        cred = credentials.Certificate("firebase_key.json")
+    elif "firebase" in st.secrets and "json_content" in st.secrets["firebase"]:
+        json_str = st.secrets["firebase"]["json_content"]
+        cred_info = json.loads(json_str)
+        if "private_key" in cred_info:
+            cred_info["private_key"] = cred_info["private_key"].replace("\\n", "\n")
+        cred = credentials.Certificate(cred_info)
+    else:
+        raise FileNotFoundError("⚠️ Firebase Anahtarı Bulunamadı!")
+    return firebase_admin.initialize_app(cred, {'databaseURL': FIREBASE_DB_URL})
+
 def init_firebase():
-    if len(firebase_admin._apps) > 0: return
+    """Bridge ilk kullanıldığında çağrılır (uygulama açılışında değil)."""
     try:
-        if os.path.exists("firebase_key.json"):
-            cred = credentials.Certificate("firebase_key.json")
-        elif "firebase" in st.secrets and "json_content" in st.secrets["firebase"]:
-            json_str = st.secrets["firebase"]["json_content"]
-            cred_info = json.loads(json_str)
-            if "private_key" in cred_info:
-                cred_info["private_key"] = cred_info["private_key"].replace("\\n", "\n")
-            cred = credentials.Certificate(cred_info)
-        else:
-            st.error("⚠️ Firebase Anahtarı Bulunamadı!")
-            st.stop()
-        firebase_admin.initialize_app(cred, {'databaseURL': FIREBASE_DB_URL})
+        get_firebase_app()
     except Exception as e:
         st.error(f"Firebase Bağlantı Hatası: {e}")
         st.stop()
 
+@st.cache_resource(show_spinner=False)
+def start_warmup():
+    """Süreç başına bir kez: Gemini SDK'sını ve Firebase'i arka planda hazırlar; arayüz beklemeden çizilir."""
+    def warm():
+        for step in (lambda: genai.Client, get_firebase_app):
+            try: step()
+            except Exception: pass  # Hata, ilgili özellik ilk kullanıldığında kullanıcıya gösterilir
+    thread = threading.Thread(target=warm, daemon=True, name="warmup")
+    thread.start()
+    return thread
+
+# ==========================================
+# 📈 METRİKLER
+# ==========================================
+class MetricsRegistry:
+    """
+    Süreç geneli zamanlayıcı / sayaç kaydı. Her seri (isim + etiketler: bot, komut, model, key...) son
+    METRICS_WINDOW ölçümü tutar; p50/p95 bu pencereden hesaplanır. Thread-safe; Streamlit'e dokunmaz.
+    """
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self._series = {}    # (isim, etiketler) -> deque
+        self._counters = {}  # (isim, etiketler) -> toplam
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, tags):
+        return name, tuple(sorted((k, str(v)) for k, v in tags.items() if v is not None))
+
+    def observe(self, name, value, **tags):
+        key = self._key(name, tags)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None: series = self._series[key] = deque(maxlen=self.window)
+            series.append(float(value))
+
+    def incr(self, name, n=1, **tags):
+        key = self._key(name, tags)
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + n
+
+    @contextmanager
+    def timer(self, name, **tags):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.observe(name, time.perf_counter() - t0, **tags)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self._counters.clear()
+
+    def summary(self):
+        """Seri başına {name, tags, count, p50, p95, max, sum} (isme göre sıralı)."""
+        with self._lock: items = [(k, sorted(v)) for k, v in self._series.items()]
+        rows = []
+        for (name, tags), values in sorted(items):
+            if not values: continue
+            pick = lambda q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+            rows.append({'name': name, 'tags': dict(tags), 'count': len(values), 'p50': pick(0.5), 'p95': pick(0.95),
+                         'max': values[-1], 'sum': sum(values)})
+        return rows
+
+    def counters(self):
+        with self._lock: items = list(self._counters.items())
+        return [{'name': name, 'tags': dict(tags), 'value': value} for (name, tags), value in sorted(items)]
+
+    def export_json(self, path=METRICS_EXPORT_FILE):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({'timestamp': time.time(), 'histograms': self.summary(), 'counters': self.counters()}, f, ensure_ascii=False, indent=1)
+        return os.path.abspath(path)
+
+    def prometheus_text(self):
+        """Prometheus metin biçimi (0.0.4): her seri için # TYPE satırı, etiket değerleri kaçışlı."""
+        def escape(v): return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        def labels(tags, **extra):
+            tags = {**tags, **extra}
+            if not tags: return ""
+            return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in tags.items()) + "}"
+        lines, typed = [], set()
+        def declare(name, kind):
+            if name not in typed: typed.add(name); lines.append(f"# TYPE {name} {kind}")
+        for row in self.summary():  # summary() ve counters() isme göre sıralı: aynı adın satırları bir arada kalır
+            name = f"scalper_{row['name']}"
+            declare(name, "summary")
+            lines.append(f"{name}{labels(row['tags'], quantile='0.5')} {row['p50']:.6g}")
+            lines.append(f"{name}{labels(row['tags'], quantile='0.95')} {row['p95']:.6g}")
+            lines.append(f"{name}_count{labels(row['tags'])} {row['count']}")
+            lines.append(f"{name}_sum{labels(row['tags'])} {row['sum']:.6g}")
+        for row in self.counters():
+            name = f"scalper_{row['name']}_total"
+            declare(name, "counter")
+            lines.append(f"{name}{labels(row['tags'])} {row['value']}")
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    return MetricsRegistry()
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_server(port):
+    """/metrics uç noktasını süreç başına bir kez açar (port doluysa None)."""
+    metrics = get_metrics()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): pass
+
+    try: server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    except OSError: return None
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+    return server
+
+# ==========================================
+# 🔌 BAĞLANTI HAVUZU
+# ==========================================
+class ClientRegistry:
+    """
+    Süreç geneli, thread-safe istemci kaydı. Key başına TEK genai.Client tutulur; HTTP bağlantıları
+    (keep-alive) tüm oturumlar ve denemeler arasında yeniden kullanılır, her istekte TLS el sıkışması olmaz.
+    RTDB Reference nesneleri de yol başına bir kez kurulur. Fabrikalar testte sahteleriyle değiştirilebilir.
+    Sabit sistem talimatları için sunucu tarafı bağlam önbelleği tanıtıcıları da (key, model, talimat) başına burada tutulur.
+    """
+    def __init__(self, client_factory=None, reference_factory=None, max_refs=CLIENT_REF_CACHE_SIZE):
+        self.client_factory = client_factory or (lambda key: genai.Client(api_key=key))
+        self.reference_factory = reference_factory or (lambda path: db.reference(path))
+        self.max_refs = max_refs
+        self.counters = {"client_new": 0, "client_reuse": 0, "ref_new": 0, "ref_reuse": 0,
+                         "prompt_cache_hit": 0, "prompt_cache_create": 0, "prompt_cache_refresh": 0, "prompt_cache_fallback": 0}
+        self._clients = {}
+        self._refs = OrderedDict()
+        self._prompt_caches = {}  # (key, model, parmak izi) -> {'name', 'expires', 'retry_at', 'lock'}
+        self._lock = threading.Lock()
+
+    def client(self, key):
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self.counters["client_reuse"] += 1
+                return client
+            client = self._clients[key] = self.client_factory(key)
+            self.counters["client_new"] += 1
+            return client
+
+    def reference(self, path):
+        with self._lock:
+            ref = self._refs.get(path)
+            if ref is not None:
+                self._refs.move_to_end(path)
+                self.counters["ref_reuse"] += 1
+                return ref
+            ref = self._refs[path] = self.reference_factory(path)
+            self.counters["ref_new"] += 1
+            while len(self._refs) > self.max_refs: self._refs.popitem(last=False)
+            return ref
+
+    def forget_reference(self, path):
+        with self._lock: self._refs.pop(path, None)
+
+    def cached_prompt(self, key, model, instruction):
+        """
+        Talimatın sunucudaki önbellek adını döndürür (gerekirse oluşturur / süresini uzatır).
+        None: önbellek kapalı ya da kullanılamıyor; çağıran düz system_instruction göndermeli.
+        """
+        if not PROMPT_CACHE_ENABLED or not instruction: return None
+        cache_id = (key, model, prompt_fingerprint(instruction))
+        with self._lock:
+            entry = self._prompt_caches.setdefault(cache_id, {'name': None, 'expires': 0, 'retry_at': 0, 'lock': threading.Lock()})
+        # Ağ çağrıları kayıt kilidi dışında; aynı talimat için tek oluşturma
+        with entry['lock']:
+            now = time.time()
+            if entry['name'] and now < entry['expires'] - PROMPT_CACHE_REFRESH_SEC:
+                self._count("prompt_cache_hit")
+                return entry['name']
+            if now < entry['retry_at']:
+                self._count("prompt_cache_fallback")
+                return None
+            client = self.client(key)
+            ttl = f"{PROMPT_CACHE_TTL_SEC}s"
+            if entry['name'] and now < entry['expires']:
+                try:
+                    client.caches.update(name=entry['name'], config=types.UpdateCachedContentConfig(ttl=ttl))
+                    entry['expires'] = now + PROMPT_CACHE_TTL_SEC
+                    self._count("prompt_cache_refresh")
+                    return entry['name']
+                except Exception: pass  # Uzatılamadıysa yenisi oluşturulur
+            try:
+                cached = client.caches.create(model=model, config=types.CreateCachedContentConfig(
+                    system_instruction=instruction, ttl=ttl, display_name=f"borsa-{cache_id[2]}"))
+                entry.update(name=cached.name, expires=now + PROMPT_CACHE_TTL_SEC, retry_at=0)
+                self._count("prompt_cache_create")
+                return entry['name']
+            except Exception:
+                entry.update(name=None, expires=0, retry_at=now + PROMPT_CACHE_RETRY_SEC)
+                self._count("prompt_cache_fallback")
+                return None
+
+    def forget_prompt_cache(self, key, model, instruction):
+        """Sunucuda bulunamayan (silinmiş / süresi dolmuş) önbellek tanıtıcısını düşürür; sonraki istek yenisini kurar."""
+        with self._lock:
+            entry = self._prompt_caches.get((key, model, prompt_fingerprint(instruction)))
+        if entry:
+            with entry['lock']: entry.update(name=None, expires=0)
+
+    def _count(self, name):
+        with self._lock: self.counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, clients=len(self._clients), refs=len(self._refs),
+                         prompt_caches=sum(1 for e in self._prompt_caches.values() if e['name']))
+        for kind in ("client", "ref"):
+            total = stats[f"{kind}_new"] + stats[f"{kind}_reuse"]
+            stats[f"{kind}_reuse_rate"] = stats[f"{kind}_reuse"] / total if total else 0.0
+        return stats
+
+@st.cache_resource(show_spinner=False)
+def get_client_registry():
+    return ClientRegistry()
+
+def gemini_client(key): return get_client_registry().client(key)
+
+def rtdb(path): return get_client_registry().reference(path)
+
+# ==========================================
+# 🗄️ PAYLAŞILAN DURUM DEPOSU
+# ==========================================
+class MemoryStateStore:
+    """
+    Varsayılan süreç içi depo: ad alanı -> anahtar -> JSON uyumlu değer. Değerler kopyalanarak saklanır,
+    böylece ağ deposuyla aynı anlamı taşır. update() kilit altında oku-değiştir-yaz'dır.
+    """
+    shared = False
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, ns, key):
+        with self._lock: return copy.deepcopy(self._data.get(ns, {}).get(key))
+
+    def items(self, ns):
+        with self._lock: return copy.deepcopy(self._data.get(ns, {}))
+
+    def set(self, ns, key, value):
+        with self._lock: self._put(ns, key, copy.deepcopy(value))
+
+    def delete(self, ns, key): self.set(ns, key, None)
+
+    def update(self, ns, key, fn):
+        """fn(mevcut değer ya da None) -> yeni değer (None: sil). Atomiktir; yeni değeri döndürür."""
+        with self._lock:
+            value = fn(copy.deepcopy(self._data.get(ns, {}).get(key)))
+            self._put(ns, key, copy.deepcopy(value))
+            return value
+
+    def _put(self, ns, key, value):
+        bucket = self._data.setdefault(ns, {})
+        if value is None: bucket.pop(key, None)
+        else: bucket[key] = value
+
+class FirebaseStateStore(MemoryStateStore):
+    """
+    Tüm replikaların paylaştığı RTDB deposu: <root>/<ns>/<key>. update() RTDB transaction'ıdır; çakışmada fn
+    güncel değerle yeniden çağrılır. Anahtarlar RTDB'ye uygun olmalıdır (hash / hex ID; '.', '/', '#' vb. içermez).
+    reference: yol -> Reference fabrikası (testte yerel taklit verilebilir).
+    RTDB transaction'ı None yazamaz: fn None döndürürse transaction iptal edilir, düğüm ETag'e bağlı olarak silinir.
+    """
+    DELETE_RETRIES = 25  # SDK'nın transaction deneme sınırıyla aynı
+
+    class _DeleteRequested(Exception):
+        """fn None döndürdü: transaction yazmadan iptal edilir."""
+    shared = True
+
+    def __init__(self, reference=None, root=STATE_ROOT):
+        self.reference, self.root = reference or rtdb, root
+
+    def _ref(self, ns, key=None): return self.reference(f"{self.root}/{ns}" + (f"/{key}" if key else ""))
+
+    def get(self, ns, key): return self._ref(ns, key).get()
+
+    def items(self, ns): return self._ref(ns).get() or {}
+
+    def set(self, ns, key, value):
+        if value is None: self._ref(ns, key).delete()
+        else: self._ref(ns, key).set(value)
+
+    def update(self, ns, key, fn):
+        ref = self._ref(ns, key)
+        for _ in range(self.DELETE_RETRIES):
+            seen = []
+            def apply(current):
+                value = fn(current)
+                if value is None:
+                    seen[:] = [current]
+                    raise self._DeleteRequested()
+                return value
+            try: return ref.transaction(apply)
+            except self._DeleteRequested: pass
+            current, etag = ref.get(etag=True)
+            if current is None: return None       # Zaten yok
+            if current != seen[0]: continue       # Arada değişti: fn güncel değerle yeniden karar verir
+            if self._delete_if_unchanged(ref, etag): return None
+        raise db.TransactionAbortedError("Silme, eşzamanlı yazmalar yüzünden tamamlanamadı.")
+
+    @staticmethod
+    def _delete_if_unchanged(ref, etag):
+        """Koşullu silme (RTDB REST 'if-match'); SDK'da karşılığı olmadığından istemcisi üzerinden yapılır."""
+        client = getattr(ref, "_client", None)
+        if client is None:  # Yerel taklit: kendi kilidiyle tutarlı, doğrudan silinir
+            ref.delete()
+            return True
+        try: client.request('delete', ref._add_suffix(), headers={'if-match': etag})
+        except firebase_exceptions.FailedPreconditionError: return False
+        return True
+
+def shared_store(store):
+    """Sadece replikalar arası paylaşılan depo döner (süreç içi depo yerel katmanların yerini tutmaz)."""
+    return store if store is not None and store.shared else None
+
+@st.cache_resource(show_spinner=False)
+def get_state_store():
+    if STATE_BACKEND == "firebase":
+        try:
+            get_firebase_app()
+            return FirebaseStateStore()
+        except Exception:
+            get_metrics().incr("state_store_fallback")  # Firebase yoksa tek sunucu gibi çalışılır
+    return MemoryStateStore()
+
+# ==========================================
+# 📻 BRIDGE DİNLEYİCİ (PUSH)
+# ==========================================
+def _apply_rtdb_event(snapshot, event_type, path, data):
+    """RTDB 'put'/'patch' olayını yerel kopyaya uygular ve yeni kopyayı döndürür."""
+    if event_type == 'patch':
+        for k, v in (data or {}).items():
+            snapshot = _apply_rtdb_event(snapshot, 'put', f"{path.rstrip('/')}/{k}", v)
+        return snapshot
+    parts = [p for p in path.split('/') if p]
+    if not parts: return data
+    root = dict(snapshot) if isinstance(snapshot, dict) else {}
+    node = root
+    for p in parts[:-1]:
+        child = node.get(p)
+        node[p] = dict(child) if isinstance(child, dict) else {}
+        node = node[p]
+    if data is None: node.pop(parts[-1], None)
+    else: node[parts[-1]] = data
+    return root or None
+
+class BridgeListener:
+    """
+    Tek bir RTDB yolunu dinler, 'status' her değiştiğinde abone kuyruklarına (yol, status, veri) iter.
+    Reference.listen() yoksa (yerel taklit vb.) arka plan thread'inde get() ile yoklamaya düşer.
+    """
+    def __init__(self, path, ref):
+        self.path = path
+        self.ref = ref
+        self.snapshot = None
+        self.last_status = None
+        self._lock = threading.Lock()
+        self._subscribers = weakref.WeakSet()  # Oturum silinince kuyruğu da düşer
+        self._registration = None
+        self._stop = threading.Event()
+
+    def start(self):
+        try:
+            self._registration = self.ref.listen(self._on_event)
+        except Exception:
+            threading.Thread(target=self._poll_loop, daemon=True).start()
+
+    def close(self):
+        self._stop.set()
+        if self._registration is not None:
+            try: self._registration.close()
+            except Exception: pass
+
+    def subscribe(self, q):
+        with self._lock:
+            self._subscribers.add(q)
+            # Sonradan bağlanan (birleştirilmiş istek) mevcut durumu hemen alır
+            if self.last_status is not None: q.put((self.path, self.last_status, dict(self.snapshot or {})))
+
+    def unsubscribe(self, q):
+        with self._lock: self._subscribers.discard(q)
+
+    def has_subscribers(self):
+        with self._lock: return len(self._subscribers) > 0
+
+    def _on_event(self, event):
+        with self._lock:
+            self.snapshot = _apply_rtdb_event(self.snapshot, event.event_type, event.path, event.data)
+            self._publish()
+
+    def _poll_loop(self):
+        while not self._stop.is_set():
+            try:
+                data = self.ref.get()
+                with self._lock:
+                    self.snapshot = data
+                    self._publish()
+            except Exception: pass
+            self._stop.wait(BRIDGE_FALLBACK_POLL_SEC)
+
+    def _publish(self):
+        data = self.snapshot if isinstance(self.snapshot, dict) else {}
+        status = data.get('status')
+        if status == self.last_status: return
+        self.last_status = status
+        for q in list(self._subscribers):
+            q.put((self.path, status, dict(data)))
+
+class BridgeListenerHub:
+    """Süreç genelinde yol başına TEK dinleyici; her oturum kendi kuyruğuyla abone olur."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listeners = {}
+
+    def subscribe(self, path, q):
+        with self._lock:
+            listener = self._listeners.get(path)
+            if listener is None:
+                listener = BridgeListener(path, rtdb(path))
+                listener.subscribe(q)
+                listener.start()
+                self._listeners[path] = listener
+            else:
+                listener.subscribe(q)
+
+    def unsubscribe(self, path, q):
+        with self._lock:
+            listener = self._listeners.get(path)
+            if listener is None: return
+            listener.unsubscribe(q)
+            if not listener.has_subscribers():
+                listener.close()
+                del self._listeners[path]
+
+# Süreç geneli tekiller arka plan thread'lerinden de ilk kez çağrılabilir: spinner (st öğesi) gösterilmez
+@st.cache_resource(show_spinner=False)
+def get_bridge_hub():
+    return BridgeListenerHub()
+
+def session_bridge_queue():
+    """Bu oturumun dinleyici kuyruğu (bridge durumları buraya düşer)."""
+    if 'bridge_queue' not in st.session_state: st.session_state['bridge_queue'] = queue.Queue()
+    return st.session_state['bridge_queue']
+
+def unwatch_bridge(req_id):
+    q = st.session_state.get('bridge_queue')
+    if q is not None: get_bridge_hub().unsubscribe(bridge_request_path(req_id), q)
+
+def pop_bridge_events():
+    """Kuyruğu boşaltır; istek ID'si başına EN SON uyandırıcı durumu {id: (status, veri)} döndürür."""
+    q = st.session_state.get('bridge_queue')
+    latest = {}
+    if q is None: return latest
+    while True:
+        try: path, status, data = q.get_nowait()
+        except queue.Empty: break
+        if status in BRIDGE_WAKE_STATUSES: latest[path.rsplit('/', 1)[-1]] = (status, data)
+    return latest
+
+# ==========================================
+# 🖼️ GÖRSEL TAŞIMA (BRIDGE)
+# ==========================================
+IMAGE_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+
+class ImageTransport(abc.ABC):
+    """
+    Bridge görsellerini RTDB JSON'u dışında ham bayt olarak taşır.
+    put() -> yanıta yazılacak referans {backend, sha256, path, url, content_type, size}
+    open() -> referanstan okunabilir bayt akışı
+    Referans RTDB'den (dışarıdan) gelir: hash zorunludur, okunan bayt ona göre doğrulanır.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def put(self, data, content_type="image/png"): ...
+
+    @abc.abstractmethod
+    def open(self, ref): ...
+
+    def _make_ref(self, data, content_type, path, url):
+        return {'backend': self.name, 'sha256': hashlib.sha256(data).hexdigest(), 'path': path,
+                'url': url, 'content_type': content_type, 'size': len(data)}
+
+    def _object_name(self, data, content_type):
+        # İçerik adresli: aynı görsel iki kez yüklenmez
+        return f"{hashlib.sha256(data).hexdigest()}.{IMAGE_EXTENSIONS.get(content_type, 'bin')}"
+
+    def fetch(self, ref):
+        """Ham baytları tek seferde, parça parça akıtarak çeker ve hash'i doğrular."""
+        if not ref.get('sha256'): raise ValueError(f"Görsel referansında hash yok: {ref.get('path')}")
+        h, buf = hashlib.sha256(), BytesIO()
+        with self.open(ref) as f:
+            for chunk in iter(lambda: f.read(IMAGE_FETCH_CHUNK), b""):
+                h.update(chunk)
+                buf.write(chunk)
+        if h.hexdigest() != ref['sha256']:
+            raise ValueError(f"Görsel hash uyuşmazlığı: {ref.get('path')}")
+        return buf.getvalue()
+
+class StorageBucketTransport(ImageTransport):
+    name = "storage"
+
+    def __init__(self, bucket_name=FIREBASE_STORAGE_BUCKET, prefix=IMAGE_STORAGE_PREFIX):
+        from firebase_admin import storage
+        self.bucket = storage.bucket(bucket_name)
+        self.prefix = prefix
+
+    def put(self, data, content_type="image/png"):
+        path = f"{self.prefix}/{self._object_name(data, content_type)}"
+        blob = self.bucket.blob(path)
+        if not blob.exists(): blob.upload_from_string(data, content_type=content_type)
+        return self._make_ref(data, content_type, path, f"gs://{self.bucket.name}/{path}")
+
+    def open(self, ref):
+        return self.bucket.blob(ref['path']).open("rb")
+
+class LocalFileTransport(ImageTransport):
+    name = "local"
+
+    def __init__(self, root=LOCAL_IMAGE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, data, content_type="image/png"):
+        path = os.path.join(self.root, self._object_name(data, content_type))
+        if not os.path.exists(path):
+            tmp = f"{path}.{uuid.uuid4().hex[:6]}.tmp"
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, path)  # Yarım dosya asla okunmaz
+        return self._make_ref(data, content_type, path, f"file://{os.path.abspath(path)}")
+
+    def resolve(self, path):
+        """Referanstaki yolu kök klasör altında çözer; kök dışına çıkan yol (../, başka mutlak yol) reddedilir."""
+        root = os.path.realpath(self.root)
+        full = os.path.realpath(path if os.path.isabs(path) else os.path.join(root, os.path.basename(path)))
+        if os.path.commonpath([root, full]) != root: raise ValueError(f"Görsel yolu izinli klasör dışında: {path}")
+        return full
+
+    def open(self, ref):
+        return open(self.resolve(ref['path']), "rb")
+
+class MemoryTransport(ImageTransport):
+    """Testler ve yerel çalıştırma için süreç içi taklit."""
+    name = "memory"
+
+    def __init__(self):
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    def put(self, data, content_type="image/png"):
+        path = self._object_name(data, content_type)
+        with self._lock: self._blobs[path] = bytes(data)
+        return self._make_ref(data, content_type, path, f"memory://{path}")
+
+    def open(self, ref):
+        with self._lock: return BytesIO(self._blobs[ref['path']])
+
+IMAGE_TRANSPORTS = {t.name: t for t in (StorageBucketTransport, LocalFileTransport, MemoryTransport)}
+
+@st.cache_resource(show_spinner=False)
+def get_image_transport(name=IMAGE_TRANSPORT):
+    return IMAGE_TRANSPORTS[name]()
+
+def fetch_bridge_image(res_data):
+    """Bridge yanıtından görselin ham baytlarını döndürür (yoksa None)."""
+    ref = res_data.get('image')
+    metrics = get_metrics()
+    if ref:
+        backend = ref.get('backend', IMAGE_TRANSPORT)
+        with metrics.timer("image_fetch_seconds", backend=backend):
+            data = get_image_transport(backend).fetch(ref)
+    elif 'image_base64' in res_data:
+        with metrics.timer("image_fetch_seconds", backend="base64"):
+            data = base64.b64decode(res_data['image_base64'])  # Eski worker uyumluluğu
+    else:
+        return None
+    metrics.observe("image_fetch_bytes", len(data), backend=ref.get('backend', IMAGE_TRANSPORT) if ref else "base64")
+    return data
+
+# ==========================================
+# 🔗 İSTEK BİRLEŞTİRME
+# ==========================================
+class BridgeCoalescer:
+    """
+    (bot, komut, hisse) parmak izi başına tek bridge isteği. Eşzamanlı kopyalar uçuştaki isteğe bağlanır;
+    komut başına TTL'den taze görsel varsa bot'a hiç gidilmez. Her bağlanan bir "sahip"tir, RTDB düğümleri
+    son sahip bırakınca temizlenir. Seçim / manuel yükleme isteyen istekler ayrılır (yeni oturum bağlanmaz,
+    sonucu paylaşılmaz). Parmak izi ve istek kayıtları durum deposundadır: paylaşılan depoda birleştirme tüm
+    replikaları kapsar, görsel ise taşıyıcı referansından (başka replikada çekildiyse) okunur.
+    """
+    FP_NS, REQ_NS = "bridge_fingerprints", "bridge_requests"
+
+    def __init__(self, store=None, ttls=BRIDGE_COALESCE_TTL_SEC, default_ttl=BRIDGE_COALESCE_DEFAULT_TTL_SEC,
+                 max_results=BRIDGE_COALESCE_MAX_RESULTS, join_sec=BRIDGE_COALESCE_JOIN_SEC, stale_sec=BRIDGE_COALESCE_STALE_SEC):
+        self.store = store if store is not None else MemoryStateStore()
+        self.ttls, self.default_ttl, self.max_results, self.join_sec, self.stale_sec = ttls, default_ttl, max_results, join_sec, stale_sec
+        self.counters = {"new": 0, "attached": 0, "cached": 0}
+        self._images = OrderedDict()  # req_id -> (bayt, content_type): bu sunucuda çekilmiş görseller
+        self._lock = threading.Lock()
+        self._swept = 0.0
+
+    @staticmethod
+    def fingerprint(target_bot, rtype, symbol): return (str(target_bot), rtype, (symbol or "").upper())
+
+    @staticmethod
+    def fp_id(fp): return hashlib.sha1(repr(fp).encode("utf-8")).hexdigest()[:16]
+
+    def _ttl(self, rtype): return self.ttls.get(rtype, self.default_ttl)
+
+    def _count(self, kind):
+        with self._lock: self.counters[kind] += 1
+
+    def acquire(self, symbol, rtype, target_bot):
+        """('cached', sonuç) | ('attached', req_id) | ('new', req_id). 'new' ise isteği çağıran yazar."""
+        fp, now = self.fingerprint(target_bot, rtype, symbol), time.time()
+        fid = self.fp_id(fp)
+        try: self._sweep(now)
+        except Exception: get_metrics().incr("state_sweep_error")  # Temizlik başarısızlığı isteği engellemez
+        req_id = new_bridge_request_id()
+        # İstek kaydı önceden yazılır: parmak izi onu gösterdiği anda bağlanan oturum kaydı hazır bulur
+        self.store.set(self.REQ_NS, req_id, {'fid': fid, 'started': now, 'holders': 1, 'detached': False, 'selected': False})
+        use_cache, join = True, True
+        for _ in range(3):
+            outcome = [None, None]
+            def decide(doc):
+                doc = dict(doc or {}, rtype=rtype)
+                res = doc.get('result')
+                if use_cache and res and now - res['at'] <= self._ttl(rtype):
+                    outcome[:] = 'cached', res
+                elif join and doc.get('inflight') and now - doc.get('started', 0) <= self.join_sec:
+                    outcome[:] = 'attached', doc['inflight']
+                else:
+                    doc['inflight'], doc['started'] = req_id, now
+                    outcome[:] = 'new', req_id
+                return doc
+            self.store.update(self.FP_NS, fid, decide)
+            kind, value = outcome
+            if kind == 'cached':
+                image = self._image(value)
+                if image: break
+                use_cache = False  # Görsel artık okunamıyor: bot'a yeniden gidilir
+            elif kind == 'attached':
+                attached = [False]
+                def hold(req):
+                    if req is None or req.get('detached'): return req
+                    attached[0] = True
+                    return dict(req, holders=req.get('holders', 0) + 1)
+                self.store.update(self.REQ_NS, value, hold)
+                if attached[0]: break
+                join = False  # Uçuştaki istek arada bitti / ayrıldı
+            else:
+                break
+        if kind != 'new': self.store.delete(self.REQ_NS, req_id)
+        self._count(kind)
+        if kind == 'cached':
+            data, content_type = image
+            return kind, dict(value, data=data, content_type=content_type or value.get('content_type'), age=now - value['at'])
+        return kind, value
+
+    def _image(self, res):
+        with self._lock:
+            image = self._images.get(res.get('req_id'))
+        if image or not res.get('ref'): return image
+        try: data = fetch_bridge_image({'image': res['ref']})
+        except Exception: data = None
+        if data is None: return None
+        self._remember(res['req_id'], data, res.get('content_type'))
+        return data, res.get('content_type')
+
+    def _remember(self, req_id, data, content_type):
+        with self._lock:
+            self._images[req_id] = (data, content_type)
+            self._images.move_to_end(req_id)
+            while len(self._images) > self.max_results: self._images.popitem(last=False)
+
+    def _clear_inflight(self, fid, req_id, result=None):
+        def apply(doc):
+            if doc is None: return None
+            doc = dict(doc)
+            if doc.get('inflight') == req_id: doc['inflight'] = None
+            if result: doc['result'] = result
+            return doc
+        self.store.update(self.FP_NS, fid, apply)
+
+    def detach(self, req_id):
+        """İstek artık paylaşılamaz (seçim / manuel yükleme / zaman aşımı): yeni gelenler ayrı istek açar."""
+        req = self.store.update(self.REQ_NS, req_id, lambda r: dict(r, detached=True) if r else None)
+        if req: self._clear_inflight(req['fid'], req_id)
+
+    def claim_selection(self, req_id):
+        """Paylaşılan istekte seçimi ilk yapan kazanır; sonrakiler aynı sonucu bekler."""
+        won = [True]
+        def claim(req):
+            if req is None: return None
+            won[0] = not req.get('selected')
+            return dict(req, selected=True)
+        self.store.update(self.REQ_NS, req_id, claim)
+        return won[0]
+
+    def complete(self, req_id, data, content_type, ref=None):
+        """Görseli bu sunucuda saklar; istek ayrılmamışsa sonucu (taşıyıcı referansıyla) parmak izine yazar."""
+        self._remember(req_id, data, content_type)
+        req = self.store.get(self.REQ_NS, req_id)
+        if req is None: return
+        result = None if req.get('detached') else {'req_id': req_id, 'content_type': content_type, 'at': time.time(), 'ref': ref}
+        self._clear_inflight(req['fid'], req_id, result)
+
+    def result_for(self, req_id):
+        """Bu sunucudaki bir sahip görseli zaten çektiyse onu döndürür (taşıyıcıdan ikinci kez okunmaz)."""
+        with self._lock: image = self._images.get(req_id)
+        return {'data': image[0], 'content_type': image[1]} if image else None
+
+    def release(self, req_id):
+        """Sahiplerden birini düşürür; son sahipse True (çağıran RTDB düğümlerini temizler)."""
+        left = [0]
+        def drop(req):
+            if req is None: return None
+            left[0] = req.get('holders', 1) - 1
+            return dict(req, holders=left[0]) if left[0] > 0 else None
+        req = self.store.get(self.REQ_NS, req_id)
+        self.store.update(self.REQ_NS, req_id, drop)
+        if left[0] > 0: return False
+        if req: self._clear_inflight(req['fid'], req_id)
+        return True
+
+    def _sweep(self, now):
+        """Sahibi kapanmış istek ve süresi dolmuş parmak izi kayıtlarını temizler (STATE_SWEEP_SEC'te bir)."""
+        with self._lock:
+            if now - self._swept < STATE_SWEEP_SEC: return
+            self._swept = now
+        for req_id, req in self.store.items(self.REQ_NS).items():
+            if now - req.get('started', 0) > self.stale_sec:
+                self.store.update(self.REQ_NS, req_id, lambda r: None if r and now - r.get('started', 0) > self.stale_sec else r)
+        def expired(doc):
+            if not doc: return True
+            live = doc.get('inflight') and now - doc.get('started', 0) <= self.stale_sec
+            fresh = doc.get('result') and now - doc['result']['at'] <= self._ttl(doc.get('rtype'))
+            return not live and not fresh
+        for fid, doc in self.store.items(self.FP_NS).items():
+            if expired(doc): self.store.update(self.FP_NS, fid, lambda d: None if expired(d) else d)
+
+    def stats(self):
+        now = time.time()
+        docs = self.store.items(self.FP_NS).values()
+        with self._lock: counters = dict(self.counters)
+        return dict(counters, inflight=sum(1 for d in docs if d.get('inflight')),
+                    results=sum(1 for d in docs if d.get('result') and now - d['result']['at'] <= self._ttl(d.get('rtype'))))
+
+@st.cache_resource(show_spinner=False)
+def get_bridge_coalescer():
+    return BridgeCoalescer(get_state_store())
+
+def open_bridge_request(symbol, rtype, target_bot, q):
+    """
+    Birleştirici üzerinden istek açar (Streamlit'ten bağımsız): ('cached', sonuç) | ('new' / 'attached', req_id).
+    İstek varsa q, yoluna abone edilir; yeni istekse önce abone olunur, sonra yazılır (hiçbir durum kaçmaz).
+    """
+    kind, value = get_bridge_coalescer().acquire(symbol, rtype, target_bot)
+    get_metrics().incr("bridge_coalesce", result=kind, command=rtype)
+    if kind == 'cached': return kind, value
+    get_bridge_hub().subscribe(bridge_request_path(value), q)
+    if kind == 'new': submit_bridge_request(symbol, rtype, target_bot, value)
+    return kind, value
+
+def bridge_result_image(req_id):
+    """Tamamlanan isteğin görseli (bayt, content_type); başka sahip çektiyse bellekten. Görsel yoksa (None, None)."""
+    coalescer = get_bridge_coalescer()
+    res = coalescer.result_for(req_id)
+    if res: return res['data'], res['content_type']
+    res_data = rtdb(bridge_response_path(req_id)).get() or {}
+    data = fetch_bridge_image(res_data)
+    if data is None: return None, None
+    content_type = (res_data.get('image') or {}).get('content_type')
+    coalescer.complete(req_id, data, content_type, ref=res_data.get('image'))
+    return data, content_type
+
+def close_bridge_request(req_id, q=None, final_status=None):
+    """Bu sahibin payını bırakır; son sahipse son durumu yazar ya da düğümleri temizler."""
+    if q is not None: get_bridge_hub().unsubscribe(bridge_request_path(req_id), q)
+    if not get_bridge_coalescer().release(req_id): return  # Başka oturumlar hâlâ bekliyor
+    if final_status: rtdb(bridge_request_path(req_id)).update({'status': final_status})
+    else: discard_bridge_request(req_id)
+
 # ==========================================
 # 📡 TELEGRAM İŞLEMLERİ
 # ==========================================
+NO_SYMBOL_NEEDED = ["yukselendusen", "teorikliste", "sinyal", "endeks", "haber", "balina", "tum", "genelakd", "piyasayd", "teorikyd", "kurum", "kurumlar", "bofa"]
+
+def bridge_request_path(req_id): return f"{BRIDGE_REQUESTS_PATH}/{req_id}"
+def bridge_response_path(req_id): return f"{BRIDGE_RESPONSES_PATH}/{req_id}"
+
+def bridge_job_label(job): return f"{job['type']} {job['symbol']}".strip()
+
+def new_bridge_request_id():
+    # Zaman önekli: RTDB'de anahtar sırası = gönderim sırası
+    return f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+
+def submit_bridge_request(symbol, rtype, target_bot, req_id=None):
+    """İsteği kendi ID'si altında kuyruğa yazar (Streamlit'ten bağımsız). İstek ID'sini döndürür."""
+    req_id = req_id or new_bridge_request_id()
+    rtdb(bridge_request_path(req_id)).set({
+        'symbol': symbol.upper() if symbol else "",
+        'type': rtype,
+        'target_bot': target_bot,
+        'status': 'pending',
+        'timestamp': time.time()
+    })
+    return req_id
+
+def discard_bridge_request(req_id):
+    for path in (bridge_request_path(req_id), bridge_response_path(req_id)):
+        try: rtdb(path).delete()
+        except Exception: pass
+        get_client_registry().forget_reference(path)
+
 def start_telegram_request(symbol, rtype):
-    if not firebase_admin._apps: return
+    init_firebase()
     bot_key = st.session_state['selected_bot_key']
     target_bot_username = BOT_CONFIGS[bot_key]["username"]
-    no_symbol_needed = ["yukselendusen", "teorikliste", "sinyal", "endeks", "haber", "balina", "tum", "genelakd", "piyasayd", "teorikyd", "kurum", "kurumlar", "bofa"]
     
-    if rtype not in no_symbol_needed and not symbol:
+    if rtype not in NO_SYMBOL_NEEDED and not symbol:
         st.toast(f"⚠️ Bu işlem için hisse kodu gerekli!", icon="⚠️")
         return
 
-    st.session_state['telegram_flow'] = {'step': 'processing', 'symbol': symbol, 'options': []}
+    if any(j['type'] == rtype and j['symbol'] == symbol and j['bot'] == bot_key for j in st.session_state['bridge_jobs'].values()):
+        st.toast(f"⏳ Bu istek zaten bekleniyor: {rtype} {symbol}".strip(), icon="⏳")
+        return
+
     st.session_state['analysis_result'] = None 
-    
-    ref_req = db.reference('bridge/request')
-    db.reference('bridge/response').delete() 
-    
-    ref_req.set({
-        'symbol': symbol.upper() if symbol else "",
-        'type': rtype,
-        'target_bot': target_bot_username,
-        'status': 'pending',
-        'timestamp': time.time()
-    })
+    # Başka oturumda aynı istek uçuştaysa ona bağlanılır; taze görsel varsa bot'a hiç gidilmez
+    kind, value = open_bridge_request(symbol, rtype, target_bot_username, session_bridge_queue())
+    if kind == 'cached':
+        label = f"{rtype} {symbol}".strip()
+        get_image_store().add(value['data'], label=label, content_type=value['content_type'])
+        st.toast(f"Görsel Alındı! ({label}, {value['age']:.0f} sn önce çekilmiş)", icon="♻️")
+        st.rerun()
+    st.session_state['bridge_jobs'][value] = {'id': value, 'step': 'processing', 'symbol': symbol, 'type': rtype, 'bot': bot_key,
+                                              'options': [], 'submitted': time.time(), 'shared': kind == 'attached'}
     st.rerun()
 
-def send_user_selection(selection):
-    ref_req = db.reference('bridge/request')
-    ref_req.update({'status': 'selection_made', 'selection': selection, 'timestamp': time.time()})
-    st.session_state['telegram_flow']['step'] = 'processing'
-    st.session_state['telegram_flow']['options'] = []
+def send_user_selection(req_id, selection):
+    job = st.session_state['bridge_jobs'][req_id]
+    if not get_bridge_coalescer().claim_selection(req_id):
+        # Paylaşılan istekte seçimi başka oturum yaptı; aynı sonuç beklenir
+        job['step'], job['options'] = 'processing', []
+        st.toast("Seçim başka bir oturumdan yapıldı, sonuç bekleniyor.", icon="👥")
+        st.rerun()
+    rtdb(bridge_request_path(req_id)).update({'status': 'selection_made', 'selection': selection, 'timestamp': time.time()})
+    job['step'] = 'processing'
+    job['options'] = []
+    job['submitted'] = time.time()  # Seçim sonrası tur ayrıca ölçülür
     st.toast(f"Seçim İletildi: {selection}", icon="📨")
-    time.sleep(0.5) 
     st.rerun()
 
 def send_restart_command():
-    if not firebase_admin._apps: return
-    db.reference('bridge/system_command').set({'command': 'restart', 'timestamp': time.time()})
+    init_firebase()
+    rtdb(BRIDGE_SYSTEM_COMMAND_PATH).set({'command': 'restart', 'timestamp': time.time()})
     st.toast("🔄 Yeniden Başlatma Komutu Gönderildi!", icon="🔄")
 
+def finish_bridge_job(req_id, final_status=None):
+    """İsteği oturumdan düşürür; son sahipse istenen son durumu yazar, yoksa düğümleri temizler."""
+    unwatch_bridge(req_id)
+    st.session_state['bridge_jobs'].pop(req_id, None)
+    close_bridge_request(req_id, final_status=final_status)
+
 def check_firebase_status():
+    """
+    Dinleyici kuyruğunu boşaltır; RTDB'ye sadece durum değiştiğinde (yanıt için) gidilir.
+    Kullanıcıyı bekleyen işe (seçim / yükleme) gelen ara durum kaybolmaz: 'pending' olarak saklanır ve iş
+    tekrar "işleniyor"a döndüğünde uygulanır (örn. paylaşılan istekte seçimi başka oturum yaptı ve bitti).
+    """
     try:
-        if not firebase_admin._apps: return
-        flow = st.session_state['telegram_flow']
-        
-        if flow['step'] == 'processing':
-            status_data = db.reference('bridge/request').get()
-            if not status_data: return
-            status = status_data.get('status')
+        jobs = st.session_state['bridge_jobs']
+        if not jobs or not firebase_ready(): return  # Bekleyen istek yoksa Firebase'e hiç dokunulmaz
+        changed = False
+
+        events = pop_bridge_events()
+        for req_id, job in jobs.items():
+            if job['step'] == 'processing' and 'pending' in job: events.setdefault(req_id, job.pop('pending'))
+        for req_id, (status, status_data) in events.items():
+            job = jobs.get(req_id)
+            if not job: continue
+            if job['step'] != 'processing' and status not in BRIDGE_FINAL_STATUSES:
+                if status != BRIDGE_STEP_STATUSES.get(job['step']): job['pending'] = (status, status_data)
+                continue
+            get_metrics().observe("bridge_roundtrip_seconds", time.time() - job.get('submitted', time.time()),
+                                  bot=job['bot'], command=job['type'], status=status)
             
+            if status != 'completed': get_bridge_coalescer().detach(req_id)  # Seçim / yükleme / zaman aşımı paylaşılmaz
             if status == 'waiting_user_selection':
-                res_data = db.reference('bridge/response').get()
+                res_data = rtdb(bridge_response_path(req_id)).get()
                 if res_data and 'options' in res_data:
-                    st.session_state['telegram_flow']['options'] = res_data['options']
-                    st.session_state['telegram_flow']['step'] = 'show_buttons'
-                    st.rerun()
+                    job['options'] = res_data['options']
+                    job['step'] = 'show_buttons'
+                    changed = True
             elif status == 'completed':
-                res_data = db.reference('bridge/response').get()
-                if res_data and 'image_base64' in res_data:
-                    try:
-                        img_data = base64.b64decode(res_data['image_base64'])
-                        img = Image.open(BytesIO(img_data))
-                        st.session_state['telegram_images'].append(img)
-                        st.toast("Görsel Alındı!", icon="📸")
-                        st.session_state['telegram_flow']['step'] = 'idle'
-                        st.rerun()
-                    except: pass
+                # Tamamlandı olayı bir kez gelir: görsel okunamazsa iş "işleniyor"da kalmaz, hatayla kapanır
+                try:
+                    img_data, content_type = bridge_result_image(req_id)
+                    if img_data is None: raise ValueError("yanıtta görsel yok")
+                    get_image_store().add(img_data, label=bridge_job_label(job), content_type=content_type)
+                    st.toast(f"Görsel Alındı! ({bridge_job_label(job)})", icon="👥" if job.get('shared') else "📸")
+                except Exception as e:
+                    get_metrics().incr("bridge_image_error", command=job['type'])
+                    st.toast(f"Görsel alınamadı ({bridge_job_label(job)}): {e}", icon="⚠️")
+                finish_bridge_job(req_id)
+                changed = True
             elif status == 'miniapp_waiting_upload':
-                st.session_state['telegram_flow']['step'] = 'upload_wait'
-                st.rerun()
+                job['step'] = 'upload_wait'
+                changed = True
             elif status == 'timeout':
-                st.error("Zaman aşımı.")
-                st.session_state['telegram_flow']['step'] = 'idle'
-                st.rerun()
+                st.toast(f"Zaman aşımı: {bridge_job_label(job)}", icon="⌛")
+                finish_bridge_job(req_id)
+                changed = True
+            elif status == 'error':
+                res_data = rtdb(bridge_response_path(req_id)).get() or {}
+                st.toast(f"Bot hatası ({bridge_job_label(job)}): {res_data.get('error') or 'bilinmiyor'}", icon="⚠️")
+                finish_bridge_job(req_id)
+                changed = True
+        if changed: st.rerun()
     except Exception: pass
 
+@st.fragment(run_every=BRIDGE_QUEUE_TICK_SEC)
+def bridge_status_watcher():
+    # Sadece yerel kuyruğa bakar; durum değişince check_firebase_status tüm sayfayı yeniler
+    check_firebase_status()
+
 # [Lines 1-320 omitted for brevity] ...
 
 # ==========================================
-# 🤖 GEMINI ANALİZ
+# 🪄 GÖRSEL ÖN İŞLEME
 # ==========================================
-def get_current_key():
-    pool = st.session_state['dynamic_key_pool']
-    if not pool: return None
-    return pool[st.session_state['key_index'] % len(pool)]
+def crop_to_content(img, tolerance=IMAGE_CROP_TOLERANCE, pad=4):
+    """Sol üst köşe rengindeki düz kenar boşluklarını kırpar (veri bölgesi kalır)."""
+    rgb = img.convert("RGB")
+    bg = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+    mask = ImageChops.difference(rgb, bg).convert("L").point(lambda v: 255 if v > tolerance else 0)
+    bbox = mask.getbbox()
+    if not bbox: return img
+    left, top, right, bottom = bbox
+    return img.crop((max(left - pad, 0), max(top - pad, 0), min(right + pad, img.width), min(bottom + pad, img.height)))
+
+def preprocess_image(img, max_edge=IMAGE_MAX_EDGE, fmt=IMAGE_UPLOAD_FORMAT, quality=IMAGE_UPLOAD_QUALITY, crop=IMAGE_AUTO_CROP,
+                     lossless=IMAGE_UPLOAD_LOSSLESS):
+    """
+    Görseli Gemini'ye hazırlar: kırp -> uzun kenarı küçült (asla büyütme) -> metadata'sız yeniden kodla.
+    Dönüş: {data, mime_type, sha256, size, original_size, original_bytes, bytes}
+    """
+    t0 = time.perf_counter()
+    original_bytes = img.info.get('source_bytes') or len(img.tobytes())
+    original_size = img.size
+    work = crop_to_content(img) if crop else img
+    if max(work.size) > max_edge:
+        scale = max_edge / max(work.size)
+        work = work.resize((max(1, round(work.width * scale)), max(1, round(work.height * scale))), Image.Resampling.LANCZOS)
+
+    if fmt == "JPEG" or work.mode not in ("RGB", "RGBA"):
+        work = work.convert("RGB" if fmt == "JPEG" or "A" not in work.getbands() else "RGBA")
+    if work is img: work = img.copy()
+    work.info = {}  # EXIF/ICC vb. metadata taşınmaz
+
+    buf = BytesIO()
+    if fmt == "PNG": work.save(buf, "PNG", optimize=True)
+    elif fmt == "WEBP" and lossless: work.save(buf, "WEBP", lossless=True, quality=80, method=4)  # quality = sıkıştırma eforu
+    elif fmt == "WEBP": work.save(buf, "WEBP", quality=quality, method=4, use_sharp_yuv=True)
+    else: work.save(buf, "JPEG", quality=quality, optimize=True, subsampling=0)  # 4:4:4 -> ince rakamlar bulanıklaşmaz
+    data = buf.getvalue()
+    get_metrics().observe("image_preprocess_seconds", time.perf_counter() - t0, format=fmt)
+    return {'data': data, 'mime_type': f"image/{fmt.lower()}", 'sha256': hashlib.sha256(data).hexdigest(),
+            'size': work.size, 'original_size': original_size, 'original_bytes': original_bytes, 'bytes': len(data)}
+
+def format_preprocess_report(prepared):
+    lines = []
+    for i, p in enumerate(prepared, 1):
+        saved = 1 - p['bytes'] / p['original_bytes'] if p['original_bytes'] else 0
+        lines.append(f"#{i}: {p['original_size'][0]}x{p['original_size'][1]} → {p['size'][0]}x{p['size'][1]} | "
+                     f"{p['original_bytes'] / 1024:.0f} KB → {p['bytes'] / 1024:.0f} KB (%{saved * 100:.0f} tasarruf)")
+    return lines
 
-def analyze_images_stream(all_images, model_name):
-    max_retries = 3
-    key = get_current_key()
-    if not key:
-        yield "HATA: API Key bulunamadı!"
-        return
+# ==========================================
+# 🗃️ GÖRSEL DEPOSU
+# ==========================================
+def make_thumbnail(img, width=THUMBNAIL_WIDTH):
+    """Önizleme için küçük WEBP baytları üretir."""
+    thumb = img.copy()
+    thumb.thumbnail((width, width * 3), Image.Resampling.LANCZOS)
+    if thumb.mode not in ("RGB", "RGBA"): thumb = thumb.convert("RGBA" if "A" in thumb.getbands() else "RGB")
+    buf = BytesIO()
+    thumb.save(buf, "WEBP", quality=80)
+    return buf.getvalue()
+
+class HashedLRUCache:
+    """
+    Hash'e göre süreç geneli LRU önbellek (önizlemeler, ön işlenmiş görseller, ayrıştırılmış raporlar). Her değer bir kez üretilir;
+    önizlemelerde aynı baytlar st.image'e verildiği için tarayıcı rerun'larda görseli yeniden indirmez.
+    """
+    def __init__(self, max_bytes, size_of=len):
+        self.max_bytes, self.size_of = max_bytes, size_of
+        self.total_bytes = 0
+        self.hits = self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """Önbellekte varsa döner; yoksa factory() ile üretip saklar."""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+        thumb = factory()
+        self.put(key, thumb)
+        return thumb
+
+    def peek(self, key):
+        """Varsa değeri döndürür; yoksa None (üretmez)."""
+        with self._lock: return self._items.get(key)
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items: return
+            self._items[key] = value
+            self.total_bytes += self.size_of(value)
+            while self.total_bytes > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self.total_bytes -= self.size_of(old)
+
+@st.cache_resource(show_spinner=False)
+def get_thumbnail_cache():
+    return HashedLRUCache(THUMBNAIL_CACHE_MAX_BYTES)
+
+@st.cache_resource(show_spinner=False)
+def get_prepared_cache():
+    # Anahtar kaynak görselin hash'i; değer preprocess_image() çıktısı
+    return HashedLRUCache(PREPARED_CACHE_MAX_BYTES, size_of=lambda p: p['bytes'])
+
+def thumbnail_for_bytes(data, key=None):
+    """Ham görsel baytlarının önizlemesi (görsel sadece önbellekte yoksa çözülür)."""
+    def build():
+        with Image.open(BytesIO(data)) as img: return make_thumbnail(img)
+    return get_thumbnail_cache().get(key or hashlib.sha256(data).hexdigest(), build)
+
+class ImageStore:
+    """
+    Oturum başına görsel deposu. Çözülmüş bitmap yerine sıkıştırılmış bayt + küçük önizleme tutar;
+    görsel sadece analiz/gösterim anında çözülür. Bellek sınırı aşılınca en uzun süredir
+    kullanılmayan görselin baytları geçici klasöre taşınır (spill kapalıysa görsel silinir).
+    """
+    def __init__(self, max_bytes=IMAGE_STORE_MAX_BYTES, spill=IMAGE_STORE_SPILL):
+        self.max_bytes, self.spill = max_bytes, spill
+        self.memory_bytes = 0
+        self.spilled_bytes = 0
+        self._entries = OrderedDict()  # id -> kayıt (ekleme sırası)
+        self._lru = OrderedDict()      # baytları bellekte olan id'ler (eskiden yeniye)
+        self._lock = threading.Lock()
+        self._spill_dir = None
+
+    def __len__(self): return len(self._entries)
+    def __contains__(self, image_id): return image_id in self._entries
+
+    def add(self, data, label="", content_type=None):
+        """Baytları doğrular, önizlemeyi üretir ve saklar. Görsel id'si (sha256) döner."""
+        image_id = hashlib.sha256(data).hexdigest()
+        with Image.open(BytesIO(data)) as img:  # Geçersiz görsel burada hata verir
+            size = img.size
+            get_thumbnail_cache().get(image_id, lambda: make_thumbnail(img))
+        with self._lock:
+            if image_id in self._entries: return image_id  # Aynı görsel iki kez tutulmaz
+            self._entries[image_id] = {'id': image_id, 'label': label, 'data': data, 'path': None,
+                                       'size': size, 'bytes': len(data), 'content_type': content_type}
+            self._lru[image_id] = True
+            self.memory_bytes += len(data)
+            self._enforce_cap()
+        return image_id
+
+    def entries(self):
+        with self._lock: return list(self._entries.values())
+
+    def get_bytes(self, image_id):
+        with self._lock:
+            entry = self._entries[image_id]
+            if entry['data'] is not None:
+                self._lru.move_to_end(image_id)
+                return entry['data']
+            path = entry['path']
+        with open(path, "rb") as f: return f.read()
+
+    def thumbnail(self, image_id):
+        """Ortak önizleme önbelleğinden; önbellekten düşmüşse baytlardan yeniden üretilir."""
+        return get_thumbnail_cache().get(image_id, lambda: make_thumbnail(self.open(image_id)))
+
+    def prepared(self, image_id):
+        """Ön işlenmiş hali (ortak önbellekten; görsel sadece ilk seferde çözülür)."""
+        return get_prepared_cache().get(image_id, lambda: preprocess_image(self.open(image_id)))
+
+    def open(self, image_id):
+        """Görseli PIL olarak çözer (sadece analiz/gösterim anında çağrılır)."""
+        img = Image.open(BytesIO(self.get_bytes(image_id)))
+        img.info['source_bytes'] = self._entries[image_id]['bytes']
+        return img
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._lru.clear()
+            self.memory_bytes = self.spilled_bytes = 0
+            if self._spill_dir: shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+    def _enforce_cap(self):
+        # En yeni görsel her zaman bellekte kalır
+        while self.memory_bytes > self.max_bytes and len(self._lru) > 1:
+            old_id, _ = self._lru.popitem(last=False)
+            entry = self._entries[old_id]
+            self.memory_bytes -= entry['bytes']
+            if self.spill:
+                if self._spill_dir is None:
+                    self._spill_dir = tempfile.mkdtemp(prefix="scalper_imgs_")
+                    weakref.finalize(self, shutil.rmtree, self._spill_dir, True)  # Oturum silinince klasör de gider
+                entry['path'] = os.path.join(self._spill_dir, old_id)
+                with open(entry['path'], "wb") as f: f.write(entry['data'])
+                self.spilled_bytes += entry['bytes']
+            else:
+                del self._entries[old_id]
+            entry['data'] = None
+
+def get_image_store():
+    # isinstance kullanılmaz: her rerun'da sınıf yeniden tanımlanır
+    if 'telegram_images' not in st.session_state: st.session_state['telegram_images'] = ImageStore()
+    return st.session_state['telegram_images']
+
+def prepare_image_bytes(data):
+    """Ham görsel baytlarını ön işler (ortak önbellekten; aynı görsel bir kez işlenir)."""
+    def build():
+        with Image.open(BytesIO(data)) as img:
+            img.info['source_bytes'] = len(data)
+            return preprocess_image(img)
+    return get_prepared_cache().get(hashlib.sha256(data).hexdigest(), build)
+
+class UploadRegistry:
+    """
+    Oturum başına yükleme kaydı (file_id -> kayıt). Her dosya sadece ilk görüldüğü rerun'da okunur,
+    doğrulanır ve Telegram görselleriyle aynı ön işlemden geçirilir; sonraki rerun ve analizler kaydı kullanır.
+    """
+    def __init__(self):
+        self._records = {}
+
+    def sync(self, uploaded_files):
+        """Yeni dosyaları kaydeder, yükleyiciden kaldırılanları unutur. Yükleme sırasıyla kayıtları döner."""
+        current = {}
+        for uf in uploaded_files or []:
+            current[uf.file_id] = self._records.get(uf.file_id) or self._register(uf)
+        self._records = current
+        return list(current.values())
+
+    def _register(self, uf):
+        data = uf.getvalue()
+        image_id = hashlib.sha256(data).hexdigest()
+        record = {'file_id': uf.file_id, 'id': image_id, 'name': uf.name, 'bytes': len(data), 'prepared': None, 'error': None}
+        try:
+            with Image.open(BytesIO(data)) as img:
+                img.load()  # Bozuk dosya burada yakalanır (bir kez)
+                img.info['source_bytes'] = len(data)
+                get_thumbnail_cache().get(image_id, lambda: make_thumbnail(img))
+                record['prepared'] = get_prepared_cache().get(image_id, lambda: preprocess_image(img))
+        except Exception as e:
+            record['error'] = str(e)
+        return record
+
+def get_upload_registry():
+    if 'upload_registry' not in st.session_state: st.session_state['upload_registry'] = UploadRegistry()
+    return st.session_state['upload_registry']
 
-    gemini_contents = [ "Aşağıdaki borsa görsellerini (Grafik, Liste, Derinlik, Takas vb.) en ince detayına kadar analiz et." ] + all_images
+# ==========================================
+# 🔢 YEREL VERİ ÇIKARIMI (OCR)
+# ==========================================
+NUMBER_RE = re.compile(r"[-+(]?%?\d[\d.,]*[KkMm]?%?\)?")
+AKD_TOTAL_RE = re.compile(r"toplam|total", re.IGNORECASE)
+AKD_OTHER_RE = re.compile(r"di[gğ]er|other", re.IGNORECASE)
+MARKET_FACTS_PROMPT = ("YEREL OLARAK HESAPLANMIŞ KESİN VERİLER (görsellerdeki tablolardan okunmuştur). Bu değerleri yeniden "
+                       "hesaplama; ilgili bölümlerde (1, 2, 4, 5, 6, 19) hesap adımlarını yazmadan doğrudan kullan ve yorumla:")
+
+def parse_tr_number(token):
+    """'1.234.567' -> 1234567, '12,34' -> 12.34, '1,2M' -> 1200000, '(450)' -> -450. Sayı değilse None."""
+    t = token.strip().replace("TL", "").replace("₺", "")
+    if not NUMBER_RE.fullmatch(t): return None
+    sign = -1 if t[0] in "-(" else 1
+    t = t.strip("+-()%")
+    scale = {'k': 1e3, 'm': 1e6}.get(t[-1].lower(), 1)
+    if scale != 1: t = t[:-1]
+    if "," in t and "." in t:
+        t = t.replace(".", "").replace(",", ".") if t.rfind(",") > t.rfind(".") else t.replace(",", "")
+    elif t.count(",") > 1: t = t.replace(",", "")
+    elif "," in t: t = t.replace(",", ".")
+    elif t.count(".") > 1 or re.fullmatch(r"\d{1,3}\.\d{3}", t): t = t.replace(".", "")  # Binlik ayırıcı
+    try: return sign * float(t) * scale
+    except ValueError: return None
+
+@st.cache_resource(show_spinner=False)
+def ocr_available():
+    """pytesseract, tesseract programı ve OCR_LANG'daki dil verileri kurulu mu (hepsi opsiyonel; süreçte bir kez bakılır)."""
+    if not LOCAL_EXTRACTION_ENABLED or importlib.util.find_spec("pytesseract") is None or shutil.which("tesseract") is None:
+        return False
+    try: installed = set(pytesseract.get_languages(config=""))
+    except Exception: return False
+    return all(lang in installed for lang in OCR_LANG.split("+"))  # Örn. 'tur' yoksa her görsel hata verirdi
+
+def ocr_rows(img, scale=OCR_SCALE):
+    """Görseldeki metni satır satır kelime listesi olarak okur (satırlar yukarıdan aşağı, kelimeler soldan sağa)."""
+    gray = img.convert("L")
+    if scale != 1: gray = gray.resize((gray.width * scale, gray.height * scale), Image.Resampling.LANCZOS)
+    if ImageStat.Stat(gray).mean[0] < 128: gray = ImageOps.invert(gray)  # Koyu tema: tesseract açık zemin ister
+    data = pytesseract.image_to_data(gray, lang=OCR_LANG, config=OCR_CONFIG, timeout=OCR_TIMEOUT_SEC,
+                                     output_type=pytesseract.Output.DICT)
+    lines = {}
+    for i, word in enumerate(data['text']):
+        if not word.strip() or float(data['conf'][i]) < 0: continue
+        line = lines.setdefault((data['block_num'][i], data['par_num'][i], data['line_num'][i]), [data['top'][i], []])
+        line[1].append((data['left'][i], word.strip()))
+    return [[w for _, w in sorted(words)] for _, words in sorted(lines.values(), key=lambda l: l[0])]
+
+def split_row(words):
+    """Satırı (ad, sayılar) olarak ayırır: baştaki sayı olmayan kelimeler kurum adıdır, aradaki simgeler atılır."""
+    values = [parse_tr_number(w) for w in words]
+    i = next((i for i, v in enumerate(values) if v is not None), len(words))
+    return " ".join(words[:i]), [v for v in values[i:] if v is not None]
+
+def rows_to_table(rows, layouts, named):
+    """Yerleşime uyan satırlar -> {sütun: numpy dizisi} (en sık görülen sayı adedinin yerleşimi). Yetersizse None."""
+    rows = [(name, values) for name, values in map(split_row, rows) if bool(name) == named and len(values) in layouts]
+    if not rows: return None
+    widths = [len(values) for _, values in rows]
+    width = max(set(widths), key=widths.count)
+    rows = [(name, values) for name, values in rows if len(values) == width]
+    if len(rows) < OCR_MIN_ROWS: return None
+    matrix = np.array([values for _, values in rows], dtype=float)
+    table = {col: matrix[:, j] for j, col in enumerate(layouts[width])}
+    if named: table['name'] = np.array([name for name, _ in rows])
+    return table
+
+def _filter_table(table, mask):
+    if int(mask.sum()) < OCR_MIN_ROWS: return None
+    return {col: values[mask] for col, values in table.items()}
+
+def read_depth_table(rows):
+    """Derinlik: alış fiyatı satış fiyatının altında olmayan satırlar yanlış okunmuş sayılır ve atılır."""
+    table = rows_to_table(rows, DEPTH_LAYOUTS, named=False)
+    return None if table is None else _filter_table(table, table['bid_price'] < table['ask_price'])
+
+def read_akd_table(rows):
+    """AKD: alış - satış = net tutmayan satırlar (yanlış okunmuş sütun) atılır."""
+    table = rows_to_table(rows, AKD_LAYOUTS, named=True)
+    if table is None: return None
+    ok = np.abs(table['buy'] - table['sell'] - table['net']) <= np.maximum(table['buy'], table['sell']) * 0.02 + 1
+    return _filter_table(table, ok)
+
+def depth_metrics(t):
+    """Kademe dengesi, en iyi fiyatlar, duvarlar ve (emir adedi varsa) emir başına ortalama lot."""
+    bid, ask = t['bid_lots'], t['ask_lots']
+    best_bid, best_ask = t['bid_price'][0], t['ask_price'][0]
+    mid = (best_bid + best_ask) / 2
+    m = {'levels': int(len(bid)), 'best_bid': best_bid, 'best_ask': best_ask, 'mid': mid, 'spread_pct': (best_ask - best_bid) / mid * 100,
+         'bid_lots': bid.sum(), 'ask_lots': ask.sum(), 'bid_ask_ratio': bid.sum() / ask.sum() if ask.sum() else None,
+         'top5_bid_share_pct': bid[:5].sum() / bid.sum() * 100 if bid.sum() else None,
+         'top5_ask_share_pct': ask[:5].sum() / ask.sum() * 100 if ask.sum() else None,
+         'bid_wall': [t['bid_price'][bid.argmax()], bid.max()], 'ask_wall': [t['ask_price'][ask.argmax()], ask.max()]}
+    if 'bid_orders' in t:
+        bid_orders, ask_orders = t['bid_orders'].sum(), t['ask_orders'].sum()
+        m['bid_lot_per_order'] = bid.sum() / bid_orders if bid_orders else None
+        m['ask_lot_per_order'] = ask.sum() / ask_orders if ask_orders else None
+        if m['bid_lot_per_order'] and m['ask_lot_per_order']: m['lot_per_order_ratio'] = m['bid_lot_per_order'] / m['ask_lot_per_order']
+    return m
+
+def akd_metrics(t):
+    """İlk 5 kurum konsantrasyonu (Bölüm 2), AORT, dominant alıcı ve ilk 5 ortalama maliyet (Bölüm 6 / 19)."""
+    is_total = np.array([bool(AKD_TOTAL_RE.search(n)) for n in t['name']])
+    is_other = np.array([bool(AKD_OTHER_RE.search(n)) for n in t['name']])
+    brokers = ~is_total & ~is_other
+    buy, net, cost = t['buy'], t['net'], t['cost']
+    volume = buy[is_total][0] if is_total.any() else buy[~is_total].sum()  # Her işlemin bir alıcısı var: hacim = toplam alış
+    priced = ~is_total & (cost > 0)
+    aort = cost[is_total][0] if is_total.any() and cost[is_total][0] > 0 else \
+        (np.average(cost[priced], weights=buy[priced]) if buy[priced].sum() else None)
+    names, net_b, cost_b = t['name'][brokers], net[brokers], cost[brokers]
+    top = np.argsort(-net_b)[:5]
+    top_net = np.clip(net_b[top], 0, None)
+    m = {'brokers': int(brokers.sum()), 'volume': volume, 'aort': aort,
+         'top5_net_buy': top_net.sum(), 'top5_concentration_pct': top_net.sum() / volume * 100 if volume else None,
+         'top_buyers': [[str(names[i]), net_b[i], cost_b[i]] for i in top if net_b[i] > 0],
+         'top_sellers': [[str(names[i]), net_b[i], cost_b[i]] for i in np.argsort(net_b)[:3] if net_b[i] < 0]}
+    if top_net.sum():
+        m['top5_avg_cost'] = np.average(cost_b[top], weights=top_net)
+        m['dominant'] = {'name': str(names[top[0]]), 'net': net_b[top[0]], 'cost': cost_b[top[0]]}
+        m['dominant_vs_top5_cost_pct'] = (m['dominant']['cost'] - m['top5_avg_cost']) / m['top5_avg_cost'] * 100 if m['top5_avg_cost'] else None
+    return m
+
+def _plain(value):
+    """numpy değerlerini JSON/RTDB uyumlu, yuvarlanmış Python değerlerine çevirir."""
+    if isinstance(value, dict): return {k: _plain(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)): return [_plain(v) for v in value]
+    if isinstance(value, (str, int)) or value is None: return value
+    return round(float(value), 2)
+
+@st.cache_resource(show_spinner=False)
+def get_extraction_cache():
+    # Anahtar ön işlenmiş görselin hash'i; değer {'depth' / 'akd': tablo}
+    return HashedLRUCache(EXTRACTION_CACHE_MAX_ENTRIES, size_of=lambda _: 1)
+
+def extract_image_tables(prepared):
+    """
+    Tek görselden tanınan tablolar: {'depth': ...} ve/veya {'akd': ...}. Görsel hash'ine göre bir kez okunur;
+    OCR hatası da boş sonuç olarak saklanır (aynı görsel her analizde yeniden denenmez).
+    """
+    def build():
+        try:
+            with get_metrics().timer("ocr_seconds"):
+                with Image.open(BytesIO(prepared['data'])) as img: rows = ocr_rows(img)
+        except Exception:
+            get_metrics().incr("local_extraction", result="ocr_error")
+            return {}
+        tables = {'depth': read_depth_table(rows), 'akd': read_akd_table(rows)}
+        return {kind: table for kind, table in tables.items() if table is not None}
+    return get_extraction_cache().get(prepared['sha256'], build)
+
+@st.cache_resource(show_spinner=False)
+def get_ocr_executor():
+    # Süre sınırını aşan okuma arka planda biter; sonucu çıkarım önbelleğine düşer (sonraki çağrılar bekleme yapmaz)
+    return ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix="ocr")
+
+def extract_market_facts(prepared_images, run_ocr=True, timeout=None):
+    """
+    Derinlik / AKD tablolarını görsellerden CPU'da okur ve raporun hesaplarını (ilk 5 konsantrasyonu, lot/emir,
+    fiyat - AORT makası, dominant kurum maliyeti) vektörel olarak yapar. OCR yoksa / tablo tanınmazsa None.
+    Dönüş JSON uyumludur (iş meta verisinde ve taramada saklanır).
+    run_ocr=False: sadece daha önce okunmuş görseller kullanılır (yeni OCR yapılmaz, örn. önbellekten gelen rapor).
+    timeout: görseller paralel okunur, en fazla bu kadar beklenir (None: hepsi); bitmeyenler bu sonuca girmez.
+    """
+    if not prepared_images or not ocr_available(): return None
+    if run_ocr:
+        futures = [get_ocr_executor().submit(extract_image_tables, p) for p in prepared_images]
+        done, late = wait_futures(futures, timeout=timeout)
+        if late: get_metrics().incr("local_extraction", result="timeout")
+        results = [f.result() if f in done and f.exception() is None else None for f in futures]
+    else:
+        results = [get_extraction_cache().peek(p['sha256']) for p in prepared_images]
+    found = {}
+    for tables in results:
+        for kind, table in (tables or {}).items(): found.setdefault(kind, table)
+    facts = {}
+    if 'depth' in found: facts['depth'] = depth_metrics(found['depth'])
+    if 'akd' in found: facts['akd'] = akd_metrics(found['akd'])
+    get_metrics().incr("local_extraction", result="+".join(facts) or "none")
+    if not facts: return None
+    price, akd = facts.get('depth', {}).get('mid'), facts.get('akd', {})
+    if price and akd.get('aort'): facts['price_aort_spread_pct'] = (price - akd['aort']) / akd['aort'] * 100
+    if price and akd.get('dominant'): facts['dominant_cost_vs_price_pct'] = (akd['dominant']['cost'] - price) / price * 100
+    return _plain(facts)
+
+def _num(v, digits=0):
+    """Türkçe sayı biçimi: 1234567.8 -> '1.234.568' (digits=0) / '1.234.567,80'."""
+    return f"{v:,.{digits}f}".replace(",", "_").replace(".", ",").replace("_", ".")
+
+def format_market_facts(facts):
+    """Yerel ölçümler -> kısa Türkçe satırlar (prompt'a eklenir ve arayüzde gösterilir)."""
+    lines, depth, akd = [], facts.get('depth'), facts.get('akd')
+    if depth:
+        ratio = f" (kat sayısı {_num(depth['bid_ask_ratio'], 2)})" if depth.get('bid_ask_ratio') else ""
+        lines.append(f"Derinlik ({depth['levels']} kademe): alış {_num(depth['bid_lots'])} lot / satış {_num(depth['ask_lots'])} lot{ratio}, "
+                     f"en iyi alış {_num(depth['best_bid'], 2)} / satış {_num(depth['best_ask'], 2)} (makas %{_num(depth['spread_pct'], 2)})")
+        lines.append(f"Duvarlar: alış {_num(depth['bid_wall'][0], 2)} ({_num(depth['bid_wall'][1])} lot), "
+                     f"satış {_num(depth['ask_wall'][0], 2)} ({_num(depth['ask_wall'][1])} lot)")
+        if depth.get('bid_lot_per_order') and depth.get('ask_lot_per_order'):
+            lines.append(f"Emir başına ortalama lot: alış {_num(depth['bid_lot_per_order'])}, satış {_num(depth['ask_lot_per_order'])} "
+                         f"(oran {_num(depth.get('lot_per_order_ratio', 0), 2)})")
+    if akd:
+        if akd.get('top5_concentration_pct') is not None:
+            lines.append(f"İlk 5 kurum konsantrasyonu: %{_num(akd['top5_concentration_pct'], 2)} "
+                         f"(ilk 5 net alış {_num(akd['top5_net_buy'])} lot / hacim {_num(akd['volume'])} lot)")
+        if akd.get('aort'): lines.append(f"AORT (ağırlıklı ortalama maliyet): {_num(akd['aort'], 2)}")
+        if akd.get('dominant'):
+            dom = akd['dominant']
+            lines.append(f"Dominant alıcı: {dom['name']} (net {_num(dom['net'])} lot, maliyet {_num(dom['cost'], 2)}); "
+                         f"ilk 5 ortalama maliyet {_num(akd.get('top5_avg_cost', 0), 2)} (fark %{_num(akd.get('dominant_vs_top5_cost_pct', 0), 2)})")
+        if akd.get('top_buyers'): lines.append("İlk alıcılar: " + ", ".join(f"{n} {_num(v)}" for n, v, _ in akd['top_buyers']))
+        if akd.get('top_sellers'): lines.append("İlk satıcılar: " + ", ".join(f"{n} {_num(v)}" for n, v, _ in akd['top_sellers']))
+    if 'price_aort_spread_pct' in facts: lines.append(f"Fiyat - AORT makası: %{_num(facts['price_aort_spread_pct'], 2)}")
+    if 'dominant_cost_vs_price_pct' in facts: lines.append(f"Dominant maliyet - fiyat farkı: %{_num(facts['dominant_cost_vs_price_pct'], 2)}")
+    return lines
+
+# ==========================================
+# 🗄️ ANALİZ ÖNBELLEĞİ
+# ==========================================
+def prompt_fingerprint(instruction=None):
+    return hashlib.sha256((instruction or SYSTEM_INSTRUCTION).encode("utf-8")).hexdigest()[:16]
+
+def analysis_cache_key(image_hashes, model_name, prompt_fp):
+    # Görsel sırası önemsiz: aynı set aynı anahtarı üretir
+    return hashlib.sha256(json.dumps([sorted(image_hashes), model_name, prompt_fp]).encode()).hexdigest()
+
+class AnalysisCache:
+    """
+    Disk üzerinde TTL + LRU analiz önbelleği; durum deposu paylaşımlıysa ikinci katman odur
+    (bir replikada üretilen analiz diğerlerinde yeniden üretilmez).
+    Her kayıt ayrı bir JSON dosyasıdır; dosyanın mtime'ı son erişim zamanıdır.
+    """
+    NS = "analysis"
+
+    def __init__(self, root=ANALYSIS_CACHE_DIR, ttl=ANALYSIS_CACHE_TTL_SEC, max_entries=ANALYSIS_CACHE_MAX_ENTRIES, store=None):
+        self.root, self.ttl, self.max_entries, self.store = root, ttl, max_entries, shared_store(store)
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> son erişim (eskiden yeniye)
+        os.makedirs(root, exist_ok=True)
+        found = []
+        for name in os.listdir(root):
+            if name.endswith(".json"):
+                found.append((os.path.getmtime(os.path.join(root, name)), name[:-5]))
+        for mtime, key in sorted(found): self._index[key] = mtime
+
+    def _path(self, key): return os.path.join(self.root, f"{key}.json")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f: return json.load(f)
+        except (OSError, ValueError): return None
+
+    def _write_disk(self, key, entry):
+        tmp = f"{self._path(key)}.{uuid.uuid4().hex[:6]}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f: json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, self._path(key))
+
+    def _drop(self, key):
+        self._index.pop(key, None)
+        try: os.remove(self._path(key))
+        except OSError: pass
+
+    def _touch(self, key):
+        now = time.time()
+        self._index[key] = now
+        self._index.move_to_end(key)
+        try: os.utime(self._path(key), (now, now))
+        except OSError: pass
+
+    def _evict(self):
+        while len(self._index) > self.max_entries:
+            self._drop(next(iter(self._index)))
+
+    def get(self, key):
+        with self._lock: entry = self._read_disk(key)
+        if entry is None and self.store is not None:
+            try: entry = self.store.get(self.NS, key)
+            except Exception: entry = None
+            if entry:
+                with self._lock:
+                    self._write_disk(key, entry)
+                    self._evict()
+        with self._lock:
+            if not entry or time.time() - entry.get('created', 0) > self.ttl:
+                if entry: self._drop(key)
+                self.misses += 1
+                return None
+            self._touch(key)
+            self.hits += 1
+            return entry['text']
+
+    def put(self, key, text, **meta):
+        if not text: return
+        entry = {'created': time.time(), 'text': text, **meta}
+        with self._lock:
+            self._write_disk(key, entry)
+            self._touch(key)
+            self._evict()
+        if self.store is not None:
+            try: self.store.set(self.NS, key, entry)
+            except Exception: pass
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_cache():
+    return AnalysisCache(store=get_state_store())
+
+# ==========================================
+# 🔑 KEY HAVUZU (ZAMANLAYICI)
+# ==========================================
+def mask_key(key): return f"{key[:5]}...{key[-3:]}"
+
+def classify_key_error(error_msg):
+    """Hata metnini sınıflar: quota | overload | auth | None (key ile ilgisiz)."""
+    msg = error_msg.lower()
+    if "429" in msg or "resource_exhausted" in msg or "quota" in msg: return "quota"
+    if "503" in msg or "overloaded" in msg or "unavailable" in msg: return "overload"
+    if "api_key_invalid" in msg or "permission_denied" in msg or "401" in msg or "403" in msg: return "auth"
+    return None
+
+def parse_retry_delay(error_msg):
+    # 429 yanıtındaki "retryDelay: '37s'" ipucu
+    m = re.search(r"retryDelay['\"]?\s*:\s*['\"]?(\d+(?:\.\d+)?)s", error_msg)
+    return float(m.group(1)) if m else 0
+
+class KeyPoolScheduler:
+    """
+    dynamic_key_pool üzerinde key seçer. Sağlık kayıtları durum deposunda key başına bir belgedir (anahtar olarak
+    key'in kendisi değil hash'i): rerun'lar ve oturumlar, paylaşılan depoda tüm replikalar aynı soğuma ve dakikalık
+    kota bilgisini görür. Seçim belge üzerinde atomik güncellemeyle yapılır; iki sunucu aynı son kotayı birlikte
+    harcayamaz. Key başına: soğuma bitişi, ardışık ceza sayısı, son 60 sn'deki istek ve token kayıtları.
+    """
+    NS = "key_health"
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else MemoryStateStore()
+
+    @staticmethod
+    def key_id(key): return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def model_id(model): return (model or "-").replace(".", "_")  # RTDB anahtarında '.' olamaz
+
+    @staticmethod
+    def _norm(h):
+        """Depodan gelen belgeyi tamamlar (RTDB boş liste / sözlük saklamaz)."""
+        h = dict(h or {})
+        for field, default in (('cooldown_until', 0.0), ('strikes', 0), ('last_used', 0.0), ('last_error', None), ('ok', 0), ('fail', 0)):
+            h.setdefault(field, default)
+        h['requests'] = list(h.get('requests') or [])
+        h['tokens'] = [list(t) for t in h.get('tokens') or []]
+        h['probes'] = dict(h.get('probes') or {})  # model -> [zaman, ok, hata türü]
+        return h
+
+    @staticmethod
+    def _prune(h, now):
+        h['requests'] = [t for t in h['requests'] if now - t <= 60]
+        h['tokens'] = [t for t in h['tokens'] if now - t[0] <= 60]
+
+    def _usage(self, h, now):
+        self._prune(h, now)
+        return len(h['requests']), sum(n for _, n in h['tokens'])
+
+    def _available(self, h, now, model=None):
+        rpm, tpm = self._usage(h, now)
+        probe = h['probes'].get(self.model_id(model))
+        if probe and not probe[1] and now - probe[0] <= KEY_TEST_CACHE_TTL_SEC: return False  # Yakın zamanda test edildi, başarısız
+        return h['cooldown_until'] <= now and rpm < KEY_RPM_LIMIT and tpm < KEY_TPM_LIMIT
+
+    def _health(self, pool):
+        docs = self.store.items(self.NS)
+        return {k: self._norm(docs.get(self.key_id(k))) for k in pool}
+
+    def _mutate(self, key, fn):
+        def apply(h):
+            h = self._norm(h)
+            fn(h)
+            return h
+        return self.store.update(self.NS, self.key_id(key), apply)
+
+    def acquire(self, pool, exclude=(), model=None):
+        """En az yüklü sağlıklı keyi seçer ve isteği ona atomik olarak yazar. Uygun key yoksa None."""
+        now = time.time()
+        health = self._health([k for k in pool if k not in exclude])
+        candidates = sorted((k for k, h in health.items() if self._available(h, now, model)),
+                            key=lambda k: (len(health[k]['requests']), health[k]['last_used']))
+        for key in candidates:
+            claimed = [False]
+            def claim(h):
+                claimed[0] = self._available(h, now, model)  # Başka sunucu arada kotayı doldurmuş olabilir
+                if claimed[0]:
+                    h['requests'].append(now)
+                    h['last_used'] = now
+            self._mutate(key, claim)
+            if claimed[0]: return key
+        return None
+
+    def next_available_in(self, pool):
+        """Herhangi bir keyin tekrar kullanılabilir olmasına kalan süre (sn)."""
+        now = time.time()
+        waits = []
+        for h in self._health(pool).values():
+            self._prune(h, now)
+            wait = max(h['cooldown_until'] - now, 0)
+            if len(h['requests']) >= KEY_RPM_LIMIT: wait = max(wait, 60 - (now - h['requests'][0]))
+            if sum(n for _, n in h['tokens']) >= KEY_TPM_LIMIT: wait = max(wait, 60 - (now - h['tokens'][0][0]))
+            waits.append(wait)
+        return min(waits) if waits else None
+
+    def report_success(self, key, tokens=0):
+        now = time.time()
+        def apply(h):
+            h['strikes'] = 0
+            h['ok'] += 1
+            h['last_error'] = None
+            if tokens: h['tokens'].append([now, tokens])
+        self._mutate(key, apply)
+
+    def report_failure(self, key, kind, retry_after=0):
+        now = time.time()
+        def apply(h):
+            h['fail'] += 1
+            h['last_error'] = kind
+            if kind == "overload":
+                cooldown = KEY_OVERLOAD_COOLDOWN_SEC
+            elif kind == "auth":
+                cooldown = KEY_COOLDOWN_MAX_SEC
+            else:
+                h['strikes'] += 1
+                cooldown = min(KEY_COOLDOWN_BASE_SEC * 2 ** (h['strikes'] - 1), KEY_COOLDOWN_MAX_SEC)
+            h['cooldown_until'] = max(h['cooldown_until'], now + max(cooldown, retry_after))
+        self._mutate(key, apply)
+
+    def record_probe(self, key, model, ok, kind=None):
+        now = time.time()
+        def apply(h):
+            h['requests'].append(now)
+            h['probes'][self.model_id(model)] = [now, ok, kind]
+            if kind == "auth": h['cooldown_until'] = max(h['cooldown_until'], now + KEY_COOLDOWN_MAX_SEC)
+        self._mutate(key, apply)
+
+    def cached_probe(self, key, model):
+        """TTL içindeki son test sonucu (True/False); yoksa None."""
+        probe = self._norm(self.store.get(self.NS, self.key_id(key)))['probes'].get(self.model_id(model))
+        if probe and time.time() - probe[0] <= KEY_TEST_CACHE_TTL_SEC: return probe[1]
+        return None
+
+    def snapshot(self, pool):
+        """Sidebar için key başına durum özeti."""
+        now = time.time()
+        rows = []
+        for k, h in self._health(pool).items():
+            rpm, tpm = self._usage(h, now)
+            fresh = [p[1] for p in h['probes'].values() if now - p[0] <= KEY_TEST_CACHE_TTL_SEC]
+            rows.append({'key': mask_key(k), 'cooldown': max(h['cooldown_until'] - now, 0), 'rpm': rpm, 'tpm': tpm,
+                         'ok': h['ok'], 'fail': h['fail'], 'last_error': h['last_error'],
+                         'probe_ok': all(fresh) if fresh else None})
+        return rows
+
+@st.cache_resource(show_spinner=False)
+def get_key_scheduler():
+    return KeyPoolScheduler(get_state_store())
+
+def probe_key(key, model):
+    """(key, model) çiftini 1 token'lık istekle dener. Dönüş: (ok, hata türü)."""
+    try:
+        config = types.GenerateContentConfig(max_output_tokens=1, http_options=types.HttpOptions(timeout=KEY_TEST_TIMEOUT_SEC * 1000))
+        gemini_client(key).models.generate_content(model=model, contents="T", config=config)
+        return True, None
+    except Exception as e:
+        return False, classify_key_error(str(e)) or "error"
+
+def run_key_health_check(pool, models):
+    """
+    Tüm (key, model) çiftlerini sınırlı bir thread havuzunda paralel dener.
+    Bir keyin tüm modelleri bittikçe (key, {model: ok}, önbellekten_mi) üretir.
+    """
+    scheduler = get_key_scheduler()
+    results = {k: {} for k in pool}
+    pending = []
+    for k in pool:
+        for m in models:
+            cached = scheduler.cached_probe(k, m)
+            if cached is None: pending.append((k, m))
+            else: results[k][m] = cached
+    for k in pool:
+        if len(results[k]) == len(models): yield k, results[k], True
+    if not pending: return
+    with ThreadPoolExecutor(max_workers=min(KEY_TEST_WORKERS, len(pending))) as ex:
+        futures = {ex.submit(probe_key, k, m): (k, m) for k, m in pending}
+        for fut in as_completed(futures):
+            k, m = futures[fut]
+            ok, kind = fut.result()
+            scheduler.record_probe(k, m, ok, kind)
+            results[k][m] = ok
+            if len(results[k]) == len(models): yield k, results[k], False
 
-    # --- GÜNCELLENMİŞ VE GELİŞTİRİLMİŞ TALİMAT ---
-    SYSTEM_INSTRUCTION = """
+# ==========================================
+# 🤖 GEMINI ANALİZ
+# ==========================================
+# --- GÜNCELLENMİŞ VE GELİŞTİRİLMİŞ TALİMAT ---
+SYSTEM_INSTRUCTION = """
     Sen Kıdemli Borsa Stratejistisin, Fon Yöneticisisin ve Eski Bir Piyasa Yapıcısın (Market Maker).
 
     GÖREVİN:
@@ -385,112 +2140,825 @@ def analyze_images_stream(all_images, model_name):
     * **Slogan Cümle:** Durumu özetleyen tek cümlelik, akılda kalıcı, profesyonel bir borsa atasözü veya motto.
     """
 
-    # Correct indentation for the loop: aligning it with SYSTEM_INSTRUCTION
+def split_prompt_sections(instruction):
+    """Talimatı (giriş metni, {bölüm no: '## N. ...' bloğu}) olarak ayırır."""
+    parts = re.split(r'(?m)^[ \t]*## (?=\d+\.)', instruction)
+    sections = {int(re.match(r'\d+', p).group()): "    ## " + p for p in parts[1:]}
+    return parts[0], sections
+
+PROMPT_HEAD, PROMPT_SECTIONS = split_prompt_sections(SYSTEM_INSTRUCTION)
+
+def build_shard_instruction(section_numbers):
+    body = "".join(PROMPT_SECTIONS[n] for n in sorted(section_numbers))
+    return (PROMPT_HEAD + body +
+            "\n    ⚠️ SADECE yukarıdaki başlıkları, numaralarını DEĞİŞTİRMEDEN ve bu sırayla yaz. Başka başlık ekleme.\n")
+
+# --- YAPISAL (JSON) ÇIKTI MODU ---
+SENTIMENT_COLORS = {"OLUMLU": "green", "OLUMSUZ": "red", "NÖTR": "blue"}
+
+def build_section_schema():
+    """Bölüm başına bir nesne: {id, title, sentiment, body}."""
+    return types.Schema(
+        type=types.Type.ARRAY,
+        items=types.Schema(
+            type=types.Type.OBJECT,
+            properties={
+                "id": types.Schema(type=types.Type.INTEGER, description="Bölüm numarası (1-30)"),
+                "title": types.Schema(type=types.Type.STRING, description="Numarasız ve etiketsiz başlık (emoji dahil)"),
+                "sentiment": types.Schema(type=types.Type.STRING, enum=list(SENTIMENT_COLORS)),
+                "body": types.Schema(type=types.Type.STRING, description="Bölüm içeriği (markdown, :green[...] renk kodları serbest)"),
+            },
+            required=["id", "title", "sentiment", "body"],
+            property_ordering=["id", "title", "sentiment", "body"],
+        ),
+    )
+
+STRUCTURED_INSTRUCTION = SYSTEM_INSTRUCTION + """
+    🧾 ÇIKTI FORMATI (YAPISAL MOD):
+    Raporu markdown başlıkları yerine JSON dizisi olarak döndür. Yukarıdaki her başlık için bir nesne:
+    * id: Başlık numarası, title: Başlık metni (numara ve etiket olmadan), sentiment: OLUMLU / OLUMSUZ / NÖTR
+    * body: Başlığın altındaki analiz (madde işaretleri ve renk kodları kullanılabilir, '## ' başlığı yazma).
+    """
+
+PROMPT_CACHE_ERROR_RE = re.compile(r"cached[\s_-]?content", re.IGNORECASE)
+PROMPT_CACHE_REASON_RE = re.compile(r"not[\s_]found|permission|denied|expired|too small|min(imum)?[\s_]*(total[\s_]*)?token", re.IGNORECASE)
+
+def is_prompt_cache_error(error_msg):
+    """Sadece talimat önbelleğine özgü hatalar (bulunamadı / izin yok / süresi doldu / token alt sınırı)."""
+    return bool(PROMPT_CACHE_ERROR_RE.search(error_msg) and PROMPT_CACHE_REASON_RE.search(error_msg))
+
+def _gemini_stream_events(gemini_contents, model_name, instruction, pool, scheduler, extra_config=None):
+    """
+    Key failover'lı TEK akış çağrısı (Streamlit'ten bağımsız, thread içinde çalışabilir).
+    extra_config: GenerateContentConfig'e eklenecek alanlar (örn. JSON şeması).
+    Olaylar: ('text', parça) | ('info', mesaj) | ('reset', None: önceki deneme çöpe) | ('error', mesaj)
+             | ('warn', mesaj: model STOP dışında bir nedenle durdu, örn. MAX_TOKENS / SAFETY; rapor eksik)
+    """
+    max_retries = max(3, min(len(pool), KEY_MAX_FAILOVERS))
+    tried = set()
+    metrics = get_metrics()
+    use_prompt_cache = True
     for attempt in range(max_retries):
+        # Önce denenmemiş sağlıklı key; hepsi denendiyse herhangi bir sağlıklı key
+        key = scheduler.acquire(pool, exclude=tried, model=model_name) or scheduler.acquire(pool, model=model_name)
+        if not key:
+            wait = scheduler.next_available_in(pool)
+            if wait is None or wait > KEY_MAX_WAIT_SEC:
+                yield 'error', f"HATA: Tüm API keyler kota/soğuma durumunda (~{wait or 0:.0f} sn)."
+                return
+            yield 'info', f"⏳ Tüm keyler meşgul, {wait:.0f} sn bekleniyor...\n\n"
+            time.sleep(wait)
+            key = scheduler.acquire(pool, model=model_name)
+            if not key:
+                yield 'error', "HATA: Uygun API key bulunamadı!"
+                return
+        cached_name, first_chunk = None, True
         try:
-            client = genai.Client(api_key=key)
+            client = gemini_client(key)
+            if use_prompt_cache: cached_name = get_client_registry().cached_prompt(key, model_name, instruction)
+            metrics.incr("gemini_prompt_cache", model=model_name, result="hit" if cached_name else "off")
+            # Önbellek varsa talimat tekrar gönderilmez (ikisi birlikte verilemez)
+            instruction_config = {'cached_content': cached_name} if cached_name else {'system_instruction': instruction}
             config = types.GenerateContentConfig(
-                system_instruction=SYSTEM_INSTRUCTION,
+                **instruction_config,
                 temperature=0.2, 
-                max_output_tokens=99999 
+                max_output_tokens=99999,
+                **(extra_config or {})
             )
+            t0 = time.perf_counter()
             response_stream = client.models.generate_content_stream(
                 model=model_name, contents=gemini_contents, config=config
             )
+            tokens, finish = 0, None
             for chunk in response_stream:
-                if chunk.text: yield chunk.text
-            break
+                if first_chunk:
+                    metrics.observe("gemini_first_chunk_seconds", time.perf_counter() - t0, model=model_name, key=mask_key(key))
+                    first_chunk = False
+                if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                    tokens = chunk.usage_metadata.total_token_count
+                for candidate in getattr(chunk, 'candidates', None) or []:
+                    if candidate.finish_reason: finish = getattr(candidate.finish_reason, 'name', str(candidate.finish_reason))
+                if chunk.text: yield 'text', chunk.text
+            scheduler.report_success(key, tokens)
+            metrics.observe("gemini_generation_seconds", time.perf_counter() - t0, model=model_name, key=mask_key(key))
+            metrics.incr("gemini_tokens", tokens, model=model_name)
+            if finish != "STOP":
+                # Kesik rapor önbelleğe alınmaz ('warn')
+                metrics.incr("gemini_incomplete", model=model_name, reason=finish or "unknown")
+                yield 'warn', f"\n\n⚠️ Rapor eksik olabilir: model yanıtı {finish or 'bilinmeyen bir neden'} ile bitti.\n"
+            return
         except Exception as e:
             error_msg = str(e)
-            if "503" in error_msg or "429" in error_msg or "overloaded" in error_msg.lower():
+            kind = classify_key_error(error_msg)
+            if cached_name and first_chunk and is_prompt_cache_error(error_msg) and attempt < max_retries - 1:
+                # Önbellek sunucuda yok / reddedildi (403 "CachedContent not found" key hatası sayılmaz):
+                # tanıtıcı düşer, bu istek düz talimatla tekrarlanır
+                get_client_registry().forget_prompt_cache(key, model_name, instruction)
+                metrics.incr("gemini_prompt_cache", model=model_name, result="fallback")
+                use_prompt_cache = False
+                continue
+            metrics.incr("gemini_errors", model=model_name, key=mask_key(key), kind=kind or "other")
+            if kind:
+                scheduler.report_failure(key, kind, parse_retry_delay(error_msg))
+                tried.add(key)
                 if attempt < max_retries - 1:
-                    yield f"⚠️ Sunucu yoğun ({model_name}), yeniden deneniyor... ({attempt+1}/{max_retries})\n\n"
-                    time.sleep(2)
+                    reason = {"quota": "Kota doldu", "overload": "Sunucu yoğun", "auth": "Key geçersiz"}[kind]
+                    yield 'reset', None
+                    yield 'info', f"⚠️ {reason} ({model_name}, {mask_key(key)}), sonraki keye geçiliyor... ({attempt+1}/{max_retries})\n\n"
                     continue
                 else:
-                    yield f"❌ HATA: Google Sunucuları çok yoğun. Hata: {error_msg}"
+                    yield 'error', f"❌ HATA: Google Sunucuları çok yoğun. Hata: {error_msg}"
             else:
-                yield f"HATA: {error_msg}"
-                break
+                yield 'error', f"HATA: {error_msg}"
+            return
+
+def _sharded_stream_events(gemini_contents, model_name, pool, scheduler):
+    """
+    SHARD_GROUPS'taki her grubu ayrı bir çağrıyla (zamanlayıcı sayesinde farklı keylerle) paralel çalıştırır.
+    Gruplardan gelen bölümler tamamlandıkça 1..30 sırasıyla akıtılır; çıktı tek çağrılık raporla aynı formattadır.
+    Tüketici akışı kapatırsa (iptal / hata) gruplar beklenmez: işçiler bir sonraki parçada kendi akışlarını kapatır.
+    Kesilen (STOP dışı) ya da bölümleri eksik biten gruplar sonda 'warn' olarak bildirilir (rapor önbelleğe alınmaz).
+    """
+    events = queue.Queue()
+    n = len(SHARD_GROUPS)
+    owner = {num: gi for gi, (_, nums) in enumerate(SHARD_GROUPS) for num in nums}
+    tails, done, errors, warns, completed, received = [""] * n, [False] * n, {}, {}, {}, set()
+    next_num, last_num = 1, max(owner)
+
+    stop = threading.Event()
+
+    def worker(gi, instruction):
+        stream = _gemini_stream_events(gemini_contents, model_name, instruction, pool, scheduler)
+        try:
+            for kind, text in stream:
+                if stop.is_set(): break
+                events.put((gi, kind, text))
+        except Exception as e:
+            events.put((gi, 'error', f"HATA: {e}"))
+        finally:
+            stream.close()
+            events.put((gi, 'done', None))
+
+    def store(section):
+        m = re.match(r'## (\d+)\.', section)
+        if m: received.add(int(m.group(1)))
+        if m and int(m.group(1)) >= next_num:
+            completed[int(m.group(1))] = section if section.endswith("\n") else section + "\n"
+
+    ex = ThreadPoolExecutor(max_workers=n, thread_name_prefix="analysis-shard")
+    try:
+        for gi, (_, nums) in enumerate(SHARD_GROUPS):
+            ex.submit(worker, gi, build_shard_instruction(nums))
+        while not all(done):
+            gi, kind, text = events.get()
+            if kind == 'text':
+                tails[gi] += text
+                while True:
+                    idx = tails[gi].find("\n## ", 1)
+                    if idx == -1: break
+                    store(tails[gi][:idx + 1])
+                    tails[gi] = tails[gi][idx + 1:]
+            elif kind == 'reset':
+                tails[gi] = ""
+            elif kind == 'info':
+                yield 'info', f"[{SHARD_GROUPS[gi][0]}] {text}"
+            elif kind == 'error':
+                errors[gi] = text
+            elif kind == 'warn':
+                warns[gi] = text.strip()
+            elif kind == 'done':
+                done[gi] = True
+                store(tails[gi])
+                tails[gi] = ""
+            # Sıradaki bölüm hazırsa akıt; sahibi bittiği halde gelmediyse atla
+            while next_num <= last_num:
+                if next_num in completed:
+                    yield 'text', completed.pop(next_num)
+                    next_num += 1
+                elif done[owner.get(next_num, 0)]:
+                    next_num += 1
+                else:
+                    break
+    finally:
+        stop.set()
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    if len(errors) == n:
+        yield 'error', next(iter(errors.values()))
+    for gi, err in errors.items():
+        if len(errors) < n: yield 'warn', f"\n⚠️ {SHARD_GROUPS[gi][0]} grubu tamamlanamadı: {err}\n"
+    for gi, (label, nums) in enumerate(SHARD_GROUPS):
+        if gi in errors: continue
+        if gi in warns: yield 'warn', f"\n[{label}] {warns[gi]}\n"
+        missing = [num for num in nums if num not in received]
+        if missing: yield 'warn', f"\n⚠️ {label} grubunda eksik bölüm: {', '.join(map(str, missing))}\n"
+
+class StreamEvent(str):
+    """
+    analyze_images_stream'in rapor metni olmayan çıktıları (kind: 'reset' | 'info' | 'warn' | 'error').
+    str olduğundan sadece birleştiren tüketiciler çalışmaya devam eder; akışı izleyenler stream_kind ile ayırır.
+    'reset': önceki denemenin akmış metni geçersizdir (key değişti), tüketici tamponunu temizlemelidir.
+    """
+    def __new__(cls, text, kind):
+        event = super().__new__(cls, text or "")
+        event.kind = kind
+        return event
+
+def stream_kind(chunk): return getattr(chunk, 'kind', 'text')
+
+def analyze_images_stream(prepared_images, model_name, use_cache=True, sharded=False, structured=False, pool=None):
+    """
+    prepared_images: preprocess_image() çıktıları (sıkıştırılmış bayt + mime).
+    structured=True: şemalı JSON akıtır (sections_from_json ile çözülür); sharded bu modda kullanılmaz.
+    use_cache=False: analiz önbelleği hiç kullanılmaz (okunmaz, sonuç yazılmaz).
+    pool: key listesi; verilmezse oturumdaki havuz (arka plan thread'lerinden verilmesi zorunlu).
+    """
+    if pool is None: pool = st.session_state['dynamic_key_pool']
+    cache = get_analysis_cache()
+    sharded = sharded and not structured
+    if structured: prompt_fp = prompt_fingerprint(STRUCTURED_INSTRUCTION)
+    else: prompt_fp = prompt_fingerprint(SYSTEM_INSTRUCTION + (json.dumps(SHARD_GROUPS) if sharded else ""))
+    cache_key = analysis_cache_key([p['sha256'] for p in prepared_images], model_name, prompt_fp)
+    if use_cache:
+        cached = cache.get(cache_key)
+        get_metrics().incr("analysis_cache", model=model_name, result="miss" if cached is None else "hit")
+        if cached is not None:
+            yield cached  # Önbellekten anında tekrar oynat
+            return
+
+    if not pool:
+        yield StreamEvent("HATA: API Key bulunamadı!", 'error')
+        return
+    scheduler = get_key_scheduler()
+
+    image_parts = [types.Part.from_bytes(data=p['data'], mime_type=p['mime_type']) for p in prepared_images]
+    get_metrics().observe("gemini_payload_bytes", sum(p['bytes'] for p in prepared_images), model=model_name)
+    gemini_contents = [ "Aşağıdaki borsa görsellerini (Grafik, Liste, Derinlik, Takas vb.) en ince detayına kadar analiz et." ] + image_parts
+    # Hesaplar yerelde yapıldıysa model sadece yorumlar (daha kısa çıktı); OCR ilk isteği en fazla OCR_PROMPT_WAIT_SEC geciktirir
+    facts = extract_market_facts(prepared_images, timeout=OCR_PROMPT_WAIT_SEC)
+    if facts: gemini_contents.insert(1, "\n".join([MARKET_FACTS_PROMPT] + [f"- {line}" for line in format_market_facts(facts)]))
+
+    if sharded:
+        events = _sharded_stream_events(gemini_contents, model_name, pool, scheduler)
+    elif structured:
+        json_config = {'response_mime_type': "application/json", 'response_schema': build_section_schema()}
+        events = _gemini_stream_events(gemini_contents, model_name, STRUCTURED_INSTRUCTION, pool, scheduler, json_config)
+    else:
+        events = _gemini_stream_events(gemini_contents, model_name, SYSTEM_INSTRUCTION, pool, scheduler)
+
+    parts, complete = [], True
+    for kind, text in events:
+        if kind == 'text':
+            parts.append(text)
+            yield text
+        elif kind == 'reset':
+            parts = []
+            yield StreamEvent(None, 'reset')
+        elif kind == 'info':
+            yield StreamEvent(text, 'info')
+        else:  # 'warn' / 'error': rapor eksik, önbelleğe yazılmaz
+            complete = False
+            yield StreamEvent(text, kind)
+    if complete and use_cache: cache.put(cache_key, "".join(parts), model=model_name)  # use_cache=False: ne okunur ne yazılır
 
 # ==========================================
 # 🧩 METİN AYRIŞTIRICI VE FİLTRELEME (HİBRİT)
 # ==========================================
-def parse_markdown_sections(text):
+# --- YEDEK KELİME HAVUZU (Fallback) ---
+POS_KEYWORDS = ["OLUMLU", "POZİTİF", "POZITIF", "YEŞİL", "YESIL", "GÜÇLÜ", "GUCLU", "ALIM", "FIRSAT", "RALLİ", "RALLI", "GÜVENLİ", "GUVENLI", "YÜKSELİŞ", "YUKSELIS"]
+NEG_KEYWORDS = ["OLUMSUZ", "NEGATİF", "NEGATIF", "KIRMIZI", "ZAYIF", "RİSK", "RISK", "TUZAK", "UZAK", "SATIŞ", "SATIS", "DÜŞÜŞ", "DUSUS", "TEHLİKE", "TEHLIKE", "UÇURUM", "UCURUM"]
+NEU_KEYWORDS = ["NÖTR", "NOTR", "YATAY", "DENGELİ", "DENGELI", "KARARSIZ", "BELİRSİZ", "BELIRSIZ"]
+
+# Tüm havuz TEK regex'e derlenir (modül yüklenirken bir kez); eşleşen kelime -> kategori
+KEYWORD_CATEGORY = {**{k: "neu" for k in NEU_KEYWORDS}, **{k: "neg" for k in NEG_KEYWORDS}, **{k: "pos" for k in POS_KEYWORDS}}
+KEYWORD_RE = re.compile("|".join(re.escape(k) for k in sorted(KEYWORD_CATEGORY, key=len, reverse=True)))
+SECTION_HEADER_RE = re.compile(r'^\d+\.')
+AI_TAG_COLORS = (("green", ("[OLUMLU]", "[POZİTİF]")), ("red", ("[OLUMSUZ]", "[NEGATİF]")), ("blue", ("[NÖTR]", "[NOTR]")))
+
+PARSE_CACHE_SIZE = 32
+
+@st.cache_resource(show_spinner=False)
+def get_parse_cache():
+    # Rapor hash'i -> bölümler; süreç geneli (app.py her rerun'da yeniden çalıştığından modül globali her seferinde boş olurdu)
+    return HashedLRUCache(PARSE_CACHE_SIZE, size_of=lambda sections: 1)
+
+def classify_header(header_line):
     """
-    Markdown metnini böler ve rengi belirler.
-    STRATEJİ:
+    Başlığın rengini belirler.
     1. Önce Yapay Zeka'nın koyduğu [ETİKET]'e bakar (En Kesin Yöntem).
-    2. Eğer etiket yoksa, geniş kelime havuzundan (POS_KEYWORDS vb.) tarar.
+    2. Eğer etiket yoksa, derlenmiş kelime havuzundan tek geçişte tarar.
+    """
+    # Türkçe karakter temizliği yaparak uppercase
+    clean_header = header_line.replace('İ', 'I').replace('ı', 'I').upper()
+    for color, tags in AI_TAG_COLORS:
+        if any(tag in clean_header for tag in tags): return color
+
+    # AI Etiket Koymayı Unuttuysa
+    found = {KEYWORD_CATEGORY[m.group()] for m in KEYWORD_RE.finditer(clean_header)}
+    kw_pos, kw_neg = "pos" in found, "neg" in found
+    if kw_pos and not kw_neg: return "green"
+    if kw_neg and not kw_pos: return "red"
+    return "blue"  # Çakışma varsa veya hiçbiri yoksa
+
+class IncrementalSectionParser:
+    """
+    Rapor metnini parça parça alır; her '## ' görüldüğünde önceki bölüm tamamlanmış sayılır.
+    Akış sırasında beslenirse üretim bittiği anda bölümler ve duygu sayıları hazırdır.
+    """
+    def __init__(self):
+        self.sections = []
+        self.counts = {"green": 0, "red": 0, "blue": 0}
+        self._buf = ""
+        self._text_hash = hashlib.sha1()
+
+    def feed(self, chunk):
+        """Yeni tamamlanan bölümleri döndürür."""
+        self._text_hash.update(chunk.encode("utf-8"))
+        self._buf += chunk
+        new = []
+        while True:
+            idx = self._buf.find("## ")
+            if idx == -1: break
+            section = self._add(self._buf[:idx])
+            if section: new.append(section)
+            self._buf = self._buf[idx + 3:]
+        return new
+
+    def finish(self):
+        self._add(self._buf)
+        self._buf = ""
+        get_parse_cache().put(self._text_hash.hexdigest(), self.sections)
+        return self.sections
+
+    def _add(self, section):
+        if not section.strip(): return None
+        header_line = section.split('\n', 1)[0].strip()
+        # Filtreleme: Sadece rakamla başlayanları al
+        if not SECTION_HEADER_RE.match(header_line): return None
+        parsed = {
+            "id": len(self.sections),
+            "header": header_line,
+            "body": "## " + section,
+            "color": classify_header(header_line)
+        }
+        self.sections.append(parsed)
+        self.counts[parsed["color"]] += 1
+        return parsed
+
+def parse_markdown_sections(text):
+    """
+    Markdown metnini böler ve rengi belirler. Sonuç rapor hash'ine göre saklanır;
+    aynı rapor için (her rerun, her checkbox tıklaması) tekrar ayrıştırma yapılmaz.
     """
     if not text: return []
-    
-    raw_sections = text.split("## ")
+    text_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    metrics, parsed = get_metrics(), []
+    def build():
+        parsed.append(True)
+        with metrics.timer("parse_seconds"):
+            parser = IncrementalSectionParser()
+            parser.feed(text)
+            return parser.finish()
+    sections = get_parse_cache().get(text_hash, build)
+    metrics.incr("parse_cache", result="miss" if parsed else "hit")
+    return sections
+
+def sections_from_json(raw):
+    """
+    Yapısal moddaki JSON çıktısını parse_markdown_sections() ile aynı biçime çevirir.
+    Çözülemezse None döner (çağıran markdown yoluna düşer).
+    """
+    raw = (raw or "").strip()
+    if raw.startswith("```"): raw = raw.strip("`").removeprefix("json").strip()
+    try: items = json.loads(raw)
+    except ValueError: return None
+    if isinstance(items, dict): items = items.get("sections")
+    if not isinstance(items, list): return None
+
     parsed_sections = []
-    
-    counter = 0 
-    
-    # --- YEDEK KELİME HAVUZU (Fallback) ---
-    POS_KEYWORDS = ["OLUMLU", "POZİTİF", "POZITIF", "YEŞİL", "YESIL", "GÜÇLÜ", "GUCLU", "ALIM", "FIRSAT", "RALLİ", "RALLI", "GÜVENLİ", "GUVENLI", "YÜKSELİŞ", "YUKSELIS"]
-    NEG_KEYWORDS = ["OLUMSUZ", "NEGATİF", "NEGATIF", "KIRMIZI", "ZAYIF", "RİSK", "RISK", "TUZAK", "UZAK", "SATIŞ", "SATIS", "DÜŞÜŞ", "DUSUS", "TEHLİKE", "TEHLIKE", "UÇURUM", "UCURUM"]
-    NEU_KEYWORDS = ["NÖTR", "NOTR", "YATAY", "DENGELİ", "DENGELI", "KARARSIZ", "BELİRSİZ", "BELIRSIZ"]
+    for item in sorted((i for i in items if isinstance(i, dict)), key=lambda i: i.get("id") or 0):
+        sentiment = str(item.get("sentiment", "NÖTR")).upper().replace("NOTR", "NÖTR")
+        header = f"{item.get('id')}. {str(item.get('title', '')).strip()} [{sentiment}]"
+        parsed_sections.append({
+            "id": len(parsed_sections),
+            "header": header,
+            "body": f"## {header}\n{str(item.get('body', '')).strip()}\n",
+            "color": SENTIMENT_COLORS.get(sentiment, "blue")
+        })
+    return parsed_sections or None
 
-    for i, section in enumerate(raw_sections):
-        if not section.strip(): continue
-        
-        lines = section.split('\n')
-        header_line = lines[0].strip()
-        
-        # Filtreleme: Sadece rakamla başlayanları al
-        if not re.match(r'^\d+\.', header_line):
+def sections_to_markdown(sections):
+    return "\n".join(s['body'] for s in sections)
+
+# ==========================================
+# 📺 ARKA PLAN ANALİZ İŞLERİ
+# ==========================================
+JOB_ID_RE = re.compile(r"[0-9a-f]{12}")
+
+class AnalysisJob:
+    """
+    Tek analiz işi: akan çıktı tamponu + bitince sonuç (metin, bölümler). Streamlit'e dokunmaz.
+    store (paylaşılan durum deposu) verilirse durum ve ilerleme oraya da yazılır; diğer replikalar RemoteJob ile okur.
+    """
+    NS = "jobs"
+
+    def __init__(self, job_id, meta=None, store=None):
+        self.id = job_id
+        self.meta = meta or {}
+        self.status = "queued"  # queued | running | done | error
+        self.error = None
+        self.result = None      # {'text', 'sections'}
+        self.sections_done = 0
+        self.live_headers = []  # Akış sırasında tamamlanan bölümler (header, color)
+        self.notice = None      # Rapora girmeyen durum mesajı (örn. key değişimi)
+        self.created, self.finished = time.time(), None
+        self._chunks = []
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+        self.store, self._published = store, 0.0
+
+    @property
+    def running(self): return self.status in ("queued", "running")
+
+    @property
+    def cancel_requested(self): return self._cancel.is_set()
+
+    def cancel(self): self._cancel.set()
+
+    def append(self, chunk):
+        with self._lock: self._chunks.append(chunk)
+        self.notice = None
+        self.publish()
+
+    def reset(self):
+        """Başarısız denemenin akmış metnini atar (yeni key rapora baştan başlar)."""
+        with self._lock: self._chunks = []
+        self.sections_done, self.live_headers = 0, []
+
+    @property
+    def text(self):
+        with self._lock: return "".join(self._chunks)
+
+    def publish(self, force=False):
+        """Durumu depoya yazar (STATE_JOB_PUBLISH_SEC'te bir). Başka replikadan gelen iptal isteği de burada okunur."""
+        now = time.time()
+        if self.store is None or (not force and now - self._published < STATE_JOB_PUBLISH_SEC): return
+        self._published = now
+        doc = {'status': self.status, 'error': self.error, 'result': self.result, 'meta': self.meta, 'created': self.created,
+               'finished': self.finished, 'updated': now, 'sections_done': self.sections_done,
+               'live_headers': [list(h) for h in self.live_headers], 'notice': self.notice,
+               'text': self.text if self.running else None}
+        def merge(current):
+            if (current or {}).get('cancel'): self._cancel.set()
+            return doc
+        try: self.store.update(self.NS, self.id, merge)
+        except Exception: pass  # Depo erişilemezse iş yerel olarak sürer
+
+class RemoteJob:
+    """Başka replikada çalışan işin depodaki görünümü (AnalysisJob ile aynı okuma arayüzü)."""
+    def __init__(self, job_id, doc, store):
+        self.id, self.store = job_id, store
+        self.meta = doc.get('meta') or {}
+        self.status, self.error = doc.get('status', "error"), doc.get('error')
+        result = doc.get('result')
+        self.result = {'text': result.get('text', ""), 'sections': result.get('sections') or []} if result else None
+        self.created, self.finished = doc.get('created', time.time()), doc.get('finished')
+        self.sections_done = doc.get('sections_done', 0)
+        self.live_headers = [tuple(h) for h in doc.get('live_headers') or []]
+        self.notice = doc.get('notice')
+        self.text = doc.get('text') or ""
+        if self.running and time.time() - doc.get('updated', 0) > STATE_JOB_STALE_SEC:
+            self.status, self.error = "error", "HATA: Analizi yürüten sunucu yanıt vermiyor."
+
+    @property
+    def running(self): return self.status in ("queued", "running")
+
+    def cancel(self):
+        self.store.update(AnalysisJob.NS, self.id, lambda doc: dict(doc, cancel=True) if doc else None)
+
+class JobManager:
+    """
+    Süreç geneli iş yürütücü (thread havuzu). İşler script çalışmasından bağımsızdır:
+    sayfa yenilense ya da bağlantı kopsa da sürer; arayüz iş ID'siyle yeniden bağlanıp birikmiş çıktıyı gösterir.
+    Biten işler JOB_RESULT_TTL_SEC boyunca saklanır. Paylaşılan depoda iş başka replikada olsa da bulunur.
+    """
+    def __init__(self, workers=JOB_WORKERS, ttl=JOB_RESULT_TTL_SEC, max_results=JOB_MAX_RESULTS, store=None):
+        self.ttl, self.max_results, self.store = ttl, max_results, shared_store(store)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, meta=None, **kwargs):
+        """fn(job, *args, **kwargs) arka planda çalışır. İş ID'sini döndürür."""
+        job = AnalysisJob(uuid.uuid4().hex[:12], meta, store=self.store)
+        with self._lock:
+            expired = self._prune()
+            self._jobs[job.id] = job
+        self._forget(expired)
+        job.publish(force=True)
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def get(self, job_id):
+        with self._lock: job = self._jobs.get(job_id)
+        if job is not None or self.store is None or not JOB_ID_RE.fullmatch(job_id or ""): return job
+        try: doc = self.store.get(AnalysisJob.NS, job_id)
+        except Exception: doc = None
+        if not doc: return None
+        job = RemoteJob(job_id, doc, self.store)
+        if job.finished and time.time() - job.finished > self.ttl: return None
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = "running"
+        job.publish(force=True)
+        try:
+            fn(job, *args, **kwargs)
+        except Exception as e:
+            job.error = f"HATA: {e}"
+        finally:
+            job.finished = time.time()
+            job.status = "error" if job.error else "done"
+            job.publish(force=True)
+
+    def _prune(self):
+        """Süresi dolan / fazla işleri yerelden atar; depodan silinecek ID'leri döndürür (kilit dışında silinir)."""
+        now = time.time()
+        expired = [j.id for j in self._jobs.values() if j.finished and now - j.finished > self.ttl]
+        for job_id in expired: del self._jobs[job_id]
+        while len(self._jobs) > self.max_results:
+            oldest = next((j.id for j in self._jobs.values() if j.finished), None)
+            if oldest is None: break
+            del self._jobs[oldest]
+            expired.append(oldest)
+        return expired
+
+    def _forget(self, job_ids):
+        if self.store is None: return
+        for job_id in job_ids:
+            try: self.store.delete(AnalysisJob.NS, job_id)
+            except Exception: pass
+
+@st.cache_resource(show_spinner=False)
+def get_job_manager():
+    return JobManager(store=get_state_store())
+
+def run_analysis_job(job, prepared, model_name, use_cache=True, sharded=False, structured=False, pool=()):
+    """İş yöneticisinde çalışır: akışı tamponlar, bölümleri akışla birlikte ayrıştırır; hata/iptalde eldeki kısmı saklar."""
+    parser = None if structured else IncrementalSectionParser()
+    stream = analyze_images_stream(prepared, model_name, use_cache=use_cache, sharded=sharded, structured=structured, pool=list(pool))
+    for chunk_text in stream:
+        if job.cancel_requested:
+            stream.close()  # Yarım rapor önbelleğe yazılmaz
+            job.error = "⛔ Analiz durduruldu."
+            break
+        kind = stream_kind(chunk_text)
+        if kind == 'error':  # "HATA: ..." / "❌ HATA: ..." (son deneme) fark etmez
+            job.error = chunk_text.strip()
+            break
+        if kind == 'reset':
+            job.reset()
+            parser = None if structured else IncrementalSectionParser()
             continue
-            
-        body = "## " + section
-        
-        # --- RENK VE DUYGU ANALİZİ ---
-        label_color = "blue" # Varsayılan: Nötr
-        
-        # Türkçe karakter temizliği yaparak uppercase
-        clean_header = header_line.replace('İ', 'I').replace('ı', 'I').upper()
-        
-        # 1. YÖNTEM: AI TAG KONTROLÜ (Öncelikli)
-        ai_pos = "[OLUMLU]" in clean_header or "[POZİTİF]" in clean_header
-        ai_neg = "[OLUMSUZ]" in clean_header or "[NEGATİF]" in clean_header
-        ai_neu = "[NÖTR]" in clean_header or "[NOTR]" in clean_header
-
-        if ai_pos:
-            label_color = "green"
-        elif ai_neg:
-            label_color = "red"
-        elif ai_neu:
-            label_color = "blue"
+        if kind == 'info':
+            job.notice = chunk_text.strip()
+            continue
+        if kind == 'warn' and structured:
+            job.error = chunk_text.strip()  # JSON'a eklenmez; sonuç yine de gösterilir
+            continue
+        job.append(chunk_text)
+        if structured:
+            job.sections_done = job.text.count('"sentiment"')
         else:
-            # 2. YÖNTEM: KELİME HAVUZU (AI Etiket Koymayı Unuttuysa)
-            kw_pos = any(k in clean_header for k in POS_KEYWORDS)
-            kw_neg = any(k in clean_header for k in NEG_KEYWORDS)
-            
-            if kw_pos and not kw_neg:
-                label_color = "green"
-            elif kw_neg and not kw_pos:
-                label_color = "red"
-            # Çakışma varsa veya hiçbiri yoksa Blue kalır.
+            for section in parser.feed(chunk_text): job.live_headers.append((section['header'], section['color']))
+            job.sections_done = len(parser.sections)
+
+    # Analiz sırasında okunan tablolardan (önbellekten gelen raporda OCR için beklenmez)
+    job.meta['market_facts'] = extract_market_facts(prepared, run_ocr=False)
+    get_metrics().observe("analysis_job_seconds", time.time() - job.created, model=model_name,
+                          mode="structured" if structured else "sharded" if sharded else "stream", status="error" if job.error else "ok")
+    if structured:
+        raw = job.text
+        sections = sections_from_json(raw)
+        # JSON çözülemezse ham metin markdown olarak ayrıştırılır (yedek yol)
+        job.result = {'text': sections_to_markdown(sections) if sections else raw, 'sections': sections}
+    else:
+        job.result = {'text': job.text, 'sections': parser.finish()}
+
+@st.fragment(run_every=1.0 / STREAM_RENDER_FPS)
+def analysis_job_panel(job_id):
+    """
+    Çalışan işe bağlanır. Biten bölümler sadece başlık olarak, yazılmakta olan bölüm tam metin gösterilir;
+    böylece her yenilemede tüm rapor yeniden gönderilmez. İş bitince sayfa bir kez yenilenir.
+    """
+    job = get_job_manager().get(job_id)
+    if job is None or not job.running: st.rerun()
+    done = job.sections_done
+    label = job.meta.get('label', "Analiz")
+    st.progress(min(done / EXPECTED_SECTION_COUNT, 0.99),
+                text=f"{label} yazılıyor... Bölüm {min(done + 1, EXPECTED_SECTION_COUNT)}/{EXPECTED_SECTION_COUNT} ({time.time() - job.created:.0f} sn)")
+    if job.live_headers:
+        st.caption(" · ".join(f":{color}[{header}]" for header, color in job.live_headers))
+    if job.notice: st.caption(job.notice)
+    text = job.text
+    if not job.meta.get('structured'):
+        tail = text[text.rfind("## "):] if "## " in text else text
+        if tail.strip(): st.markdown(tail)
+    if st.button("🛑 Analizi Durdur", key="job_stop"): job.cancel()
+
+def current_analysis_job():
+    """Oturumdaki ya da URL'deki (?job=) iş; sekme yenilenince URL'den yeniden bağlanılır."""
+    job_id = st.session_state.get('analysis_job') or st.query_params.get('job')
+    if not job_id: return None
+    job = get_job_manager().get(job_id)
+    if job is None:  # Süresi dolmuş / sunucu yeniden başlamış
+        st.session_state.pop('analysis_job', None)
+        if 'job' in st.query_params: del st.query_params['job']
+        return None
+    st.session_state['analysis_job'] = job_id
+    return job
 
-        parsed_sections.append({
-            "id": counter,
-            "header": header_line,
-            "body": body,
-            "color": label_color
-        })
-        counter += 1
-        
-    return parsed_sections
+# ==========================================
+# 📋 WATCHLIST (TOPLU TARAMA)
+# ==========================================
+DECISION_RANK = {"ALIM FIRSATI": 0, "İZLE": 1, "UZAK DUR": 2}
+DECISION_ICONS = {"ALIM FIRSATI": "🟢", "İZLE": "🔵", "UZAK DUR": "🔴"}
+DECISION_RE = re.compile(r"ALIM FIRSATI|[İI]ZLE|UZAK DUR")
+SCORE_RE = re.compile(r"Genel Puan[^\d]*(?:10\s*üzerinden\s*)?(\d+(?:[.,]\d+)?)")
+
+def parse_tickers(text):
+    """'thyao, ASELS\nGARAN' -> ['THYAO', 'ASELS', 'GARAN'] (sıra korunur, tekrarlar atılır)."""
+    return list(dict.fromkeys(t.upper() for t in re.split(r"[\s,;]+", text or "") if t))
+
+def section_number(section):
+    m = re.match(r"(\d+)\.", section['header'])
+    return int(m.group(1)) if m else None
+
+def extract_decision(sections):
+    """Bölüm 30'dan nihai karar, bölüm 20'den genel puan ve özet yorum. Dönüş: (karar, puan, özet)"""
+    decision, score, summary = None, None, ""
+    for sec in sections:
+        num = section_number(sec)
+        if num == 30:
+            line = next((l for l in sec['body'].splitlines() if "Nihai Karar" in l), sec['body'])
+            m = DECISION_RE.search(line.split("Nihai Karar", 1)[-1])
+            if m: decision = m.group().replace("IZLE", "İZLE")
+        elif num == 20:
+            m = SCORE_RE.search(sec['body'])
+            if m: score = min(float(m.group(1).replace(",", ".")), 10.0)
+            line = next((l for l in sec['body'].splitlines() if "Özet Yorum" in l), "")
+            summary = line.split("Özet Yorum", 1)[-1].strip(" *:").strip()
+    return decision, score, summary
+
+class WatchlistRun:
+    """
+    Hisse listesini arka plan thread'inde uçtan uca işler:
+    bot istekleri (hisse başına tüm komutlar aynı anda) -> görseller -> Gemini analizi -> karar özeti.
+    Streamlit'e dokunmaz (key havuzu parametre olarak gelir); arayüz satırları fragment ile okur.
+    Aynı anda en fazla `concurrency` hisse işlenir.
+    """
+    def __init__(self, symbols, commands, target_bot, model_name, pool, concurrency=WATCHLIST_CONCURRENCY):
+        self.symbols, self.commands = list(symbols), list(commands)
+        self.target_bot, self.model_name, self.pool = target_bot, model_name, list(pool)
+        self.bot_name = next((name for name, cfg in BOT_CONFIGS.items() if cfg['username'] == target_bot), str(target_bot))
+        self.concurrency = max(1, int(concurrency))
+        self.rows = {s: {'symbol': s, 'stage': "⏸️ Sırada", 'decision': None, 'score': None, 'summary': "",
+                         'notes': [], 'report': None, 'images': 0, 'seconds': None, 'facts': None} for s in self.symbols}
+        self.started, self.finished = time.time(), None
+        self._lock = threading.Lock()
+        self._cancel = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True, name="watchlist").start()
+
+    def cancel(self): self._cancel.set()
+
+    @property
+    def running(self): return self.finished is None
+
+    def snapshot(self):
+        """Sıralı satırlar: önce karar (ALIM > İZLE > UZAK DUR), sonra puan; bitmeyenler en altta."""
+        with self._lock: rows = [dict(r) for r in self.rows.values()]
+        return sorted(rows, key=lambda r: (DECISION_RANK.get(r['decision'], 3), -(r['score'] or 0), r['report'] is None))
+
+    def _update(self, symbol, **fields):
+        with self._lock:
+            note = fields.pop('note', None)
+            if note: self.rows[symbol]['notes'].append(note)
+            self.rows[symbol].update(fields)
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as ex:
+            for _ in as_completed([ex.submit(self._process, s) for s in self.symbols]): pass
+        self.finished = time.time()
+
+    def _process(self, symbol):
+        if self._cancel.is_set(): return self._update(symbol, stage="⛔ İptal")
+        t0 = time.time()
+        try:
+            self._update(symbol, stage="📡 Bot görselleri")
+            images = self._collect_images(symbol)
+            if self._cancel.is_set(): return self._update(symbol, stage="⛔ İptal")
+            if not images: raise RuntimeError("Hiç görsel alınamadı")
+
+            self._update(symbol, stage="🧠 Analiz", images=len(images))
+            report = ""
+            for chunk in analyze_images_stream(images, self.model_name, pool=self.pool):
+                kind = stream_kind(chunk)
+                if kind == 'error': raise RuntimeError(chunk.strip())
+                if kind == 'reset': report = ""  # Key değişti: rapor baştan gelir
+                elif kind != 'info': report += chunk
+            decision, score, summary = extract_decision(parse_markdown_sections(report))
+            # Analizle paralel süren okumalar artık bitmiş olur (tablo sütunları için beklenir)
+            self._update(symbol, stage="✅ Tamam", report=report, decision=decision, score=score, summary=summary,
+                         facts=extract_market_facts(images))
+        except Exception as e:
+            self._update(symbol, stage="❌ Hata", note=str(e))
+        finally:
+            self._update(symbol, seconds=round(time.time() - t0, 1))
+            get_metrics().observe("watchlist_symbol_seconds", time.time() - t0, bot=self.bot_name, model=self.model_name)
+
+    def _collect_images(self, symbol):
+        """Tüm komutları aynı anda gönderir, yanıtları dinleyici kuyruğundan bekler."""
+        q, pending, images = queue.Queue(), {}, []
+        for cmd in self.commands:
+            # Aynı komut başka oturumda / taramada uçuştaysa ona bağlanılır, taze görsel varsa doğrudan alınır
+            kind, value = open_bridge_request(symbol, cmd, self.target_bot, q)
+            if kind == 'cached': images.append(prepare_image_bytes(value['data']))
+            else: pending[bridge_request_path(value)] = (value, cmd, time.time())
+
+        deadline = time.time() + WATCHLIST_BRIDGE_TIMEOUT_SEC
+        try:
+            while pending and not self._cancel.is_set() and time.time() < deadline:
+                try: path, status, _ = q.get(timeout=min(1.0, max(0.0, deadline - time.time())))
+                except queue.Empty: continue
+                if path not in pending or status not in BRIDGE_WAKE_STATUSES: continue
+                req_id, cmd, submitted = pending[path]
+                if status == 'waiting_user_selection' and self._auto_select(symbol, req_id, cmd): continue  # Sonuç beklenir
+                del pending[path]
+                get_metrics().observe("bridge_roundtrip_seconds", time.time() - submitted, bot=self.bot_name, command=cmd, status=status)
+                if status == 'completed':
+                    try:
+                        data, _ = bridge_result_image(req_id)
+                        if data is None: raise ValueError("görsel yok")
+                        images.append(prepare_image_bytes(data))
+                    except Exception as e:
+                        self._update(symbol, note=f"{cmd}: {e}")
+                    close_bridge_request(req_id, q)
+                else:
+                    # Manuel yükleme isteyen (ya da seçeneği okunamayan) komutlar toplu modda atlanır
+                    self._update(symbol, note=f"{cmd}: {status}")
+                    get_bridge_coalescer().detach(req_id)
+                    close_bridge_request(req_id, q, final_status=None if status in ('timeout', 'error') else 'cancelled')
+        finally:
+            for path, (req_id, cmd, _) in pending.items():
+                self._update(symbol, note=f"{cmd}: yanıt yok")
+                try: close_bridge_request(req_id, q, final_status='cancelled')
+                except Exception: pass
+        return images
+
+    def _auto_select(self, symbol, req_id, cmd):
+        """Seçim isteyen komutta WATCHLIST_SELECTIONS'taki (yoksa ilk) seçeneği gönderir; sonuç beklenecekse True."""
+        coalescer = get_bridge_coalescer()
+        coalescer.detach(req_id)
+        if not coalescer.claim_selection(req_id): return True  # Paylaşılan istekte seçimi başka oturum yaptı
+        options = (rtdb(bridge_response_path(req_id)).get() or {}).get('options') or []
+        if not options: return False
+        choice = WATCHLIST_SELECTIONS.get(cmd)
+        if choice not in options: choice = options[0]
+        rtdb(bridge_request_path(req_id)).update({'status': 'selection_made', 'selection': choice, 'timestamp': time.time()})
+        self._update(symbol, note=f"{cmd}: {choice}")
+        return True
+
+def watchlist_table(rows):
+    return [{"#": i, "Hisse": r['symbol'],
+             "Karar": f"{DECISION_ICONS.get(r['decision'], '⚪')} {r['decision'] or '-'}",
+             "Puan": r['score'], "Özet": r['summary'],
+             "İlk 5 %": ((r['facts'] or {}).get('akd') or {}).get('top5_concentration_pct'),
+             "AORT Makas %": (r['facts'] or {}).get('price_aort_spread_pct'), "Görsel": r['images'], "Durum": r['stage'],
+             "Süre (sn)": r['seconds'], "Not": " | ".join(r['notes'])}
+            for i, r in enumerate(rows, 1)]
+
+@st.fragment(run_every=WATCHLIST_REFRESH_SEC)
+def watchlist_live_panel():
+    # Tarama sürerken sadece bu parça yenilenir; bitince tüm sayfa bir kez yenilenir
+    run = st.session_state.get('watchlist_run')
+    if run is None: return
+    if not run.running: st.rerun()
+    rows = run.snapshot()
+    done = sum(r['seconds'] is not None for r in rows)
+    st.progress(done / len(rows), text=f"Taranıyor... {done}/{len(rows)} hisse ({time.time() - run.started:.0f} sn)")
+    st.dataframe(watchlist_table(rows), hide_index=True, use_container_width=True)
+    if st.button("🛑 Taramayı Durdur", key="wl_stop"): run.cancel()
 
 # ==========================================
 # 🖥️ ARAYÜZ (MAIN)
 # ==========================================
 def main():
     st.set_page_config(page_title="Scalper AI Ultra", layout="wide")
-    init_firebase()
+    init_session()
+    start_warmup()  # Firebase / Gemini SDK arka planda; ilk bridge / analiz kullanımına kadar beklenmez
+    if METRICS_PROMETHEUS_PORT: start_metrics_server(METRICS_PROMETHEUS_PORT)
     check_firebase_status()
 
     # --- SIDEBAR ---
@@ -500,6 +2968,7 @@ def main():
             send_restart_command()
         if st.button("⚠️ SİSTEMİ SIFIRLA (RESET)", type="primary"):
             st.session_state.clear()
+            st.query_params.clear()
             st.rerun()
         st.divider()
         
@@ -528,20 +2997,49 @@ def main():
             else:
                 st.info(f"Test Modelleri:\n{MODEL_FLASH}\n{MODEL_LITE}")
                 res_box = st.container(border=True)
-                for k in pool:
-                    mk = f"{k[:5]}...{k[-3:]}"
-                    try:
-                        c = genai.Client(api_key=k)
-                        try:
-                            c.models.generate_content(model=MODEL_FLASH, contents="T", config=types.GenerateContentConfig(max_output_tokens=1))
-                            f_status = "✅"
-                        except: f_status = "❌"
-                        try:
-                            c.models.generate_content(model=MODEL_LITE, contents="T", config=types.GenerateContentConfig(max_output_tokens=1))
-                            l_status = "✅"
-                        except: l_status = "❌"
-                        res_box.write(f"**{mk}** | F: {f_status} | L: {l_status}")
-                    except Exception as e: res_box.error(f"HATA: {e}")
+                try:
+                    # Sonuçlar geldikçe yazılır; son KEY_TEST_CACHE_TTL_SEC içinde test edilenler tekrar denenmez
+                    for k, res, cached in run_key_health_check(pool, (MODEL_FLASH, MODEL_LITE)):
+                        f_status = "✅" if res[MODEL_FLASH] else "❌"
+                        l_status = "✅" if res[MODEL_LITE] else "❌"
+                        res_box.write(f"**{mask_key(k)}** | F: {f_status} | L: {l_status}" + (" ♻️" if cached else ""))
+                except Exception as e: res_box.error(f"HATA: {e}")
+
+        if st.session_state['dynamic_key_pool']:
+            with st.expander("🩺 Key Durumu"):
+                for row in get_key_scheduler().snapshot(st.session_state['dynamic_key_pool']):
+                    if row['cooldown'] > 0: state = f"🧊 {row['cooldown']:.0f} sn"
+                    elif row['probe_ok'] is False: state = "❌ Test"
+                    else: state = "✅"
+                    st.caption(f"**{row['key']}** | {state} | {row['rpm']} istek/dk | {row['tpm']} token/dk | ✔ {row['ok']} ✖ {row['fail']}")
+                conn = get_client_registry().stats()
+                st.caption(f"🔌 {conn['clients']} istemci, %{conn['client_reuse_rate'] * 100:.0f} yeniden kullanım | "
+                           f"{conn['refs']} RTDB ref, %{conn['ref_reuse_rate'] * 100:.0f} yeniden kullanım | "
+                           f"🧠 {conn['prompt_caches']} talimat önbelleği ({conn['prompt_cache_hit']} isabet, {conn['prompt_cache_fallback']} düz)")
+                st.caption("🗄️ Durum deposu: " + ("paylaşılan (Firebase, tüm replikalar)" if get_state_store().shared else "süreç içi (tek sunucu)"))
+
+        with st.expander("📈 Metrikler"):
+            metrics = get_metrics()
+            rows = metrics.summary()
+            if rows:
+                st.dataframe([{"Ölçüm": r['name'], "Etiket": ", ".join(f"{k}={v}" for k, v in r['tags'].items()), "n": r['count'],
+                               "p50": round(r['p50'], 3), "p95": round(r['p95'], 3), "maks": round(r['max'], 3)} for r in rows],
+                             hide_index=True, use_container_width=True)
+            else:
+                st.caption("Henüz ölçüm yok.")
+            counters = metrics.counters()
+            if counters:
+                st.dataframe([{"Sayaç": c['name'], "Etiket": ", ".join(f"{k}={v}" for k, v in c['tags'].items()), "Toplam": c['value']}
+                              for c in counters], hide_index=True, use_container_width=True)
+            c1, c2 = st.columns(2)
+            if c1.button("💾 Dışa Aktar", key="metrics_export", use_container_width=True):
+                st.toast(f"Metrikler kaydedildi: {metrics.export_json()}", icon="💾")
+            if c2.button("🧹 Sıfırla", key="metrics_reset", use_container_width=True):
+                metrics.reset()
+                st.rerun()
+            if METRICS_PROMETHEUS_PORT:
+                up = start_metrics_server(METRICS_PROMETHEUS_PORT) is not None
+                st.caption(f"Prometheus: :{METRICS_PROMETHEUS_PORT}/metrics " + ("✅" if up else "❌ (port kullanımda)"))
 
     # --- MAIN CONTENT ---
     st.title(f"⚡ Scalper AI: {selected_bot_name}")
@@ -559,26 +3057,69 @@ def main():
             if columns[col_idx].button(btn_label, use_container_width=True):
                 start_telegram_request(symbol, btn_cmd)
 
-        step = st.session_state['telegram_flow']['step']
-        if step == 'processing':
-            st.info(f"⏳ Veri Çekiliyor...")
-            st.spinner("İşleniyor...")
-            time.sleep(1)
-            st.rerun()
-        elif step == 'show_buttons':
-            st.success("👇 Seçenekler:")
-            opts = st.session_state['telegram_flow']['options']
-            cols = st.columns(2)
-            for i, opt in enumerate(opts):
-                if cols[i%2].button(f"👉 {opt}", key=f"btn_{i}"):
-                    send_user_selection(opt)
-        elif step == 'upload_wait':
-            st.warning("⚠️ MİNİ-APP LİSTESİ AÇILDI!")
-            st.info("Lütfen telefondan listeyi açıp SS alın ve SAĞ TARAFA yükleyin.")
-            if st.button("❌ İptal Et"):
-                db.reference('bridge/request').update({'status': 'cancelled'})
-                st.session_state['telegram_flow']['step'] = 'idle'
-                st.rerun()
+        # Bekleyen istekler (aynı anda birden fazla olabilir)
+        jobs = list(st.session_state['bridge_jobs'].values())
+        for bridge_job in jobs:
+            req_id, label = bridge_job['id'], bridge_job_label(bridge_job)
+            if bridge_job['step'] == 'processing':
+                st.info(f"⏳ Veri Çekiliyor... ({label})")
+            elif bridge_job['step'] == 'show_buttons':
+                st.success(f"👇 Seçenekler ({label}):")
+                cols = st.columns(2)
+                for i, opt in enumerate(bridge_job['options']):
+                    if cols[i%2].button(f"👉 {opt}", key=f"btn_{req_id}_{i}"):
+                        send_user_selection(req_id, opt)
+            elif bridge_job['step'] == 'upload_wait':
+                st.warning(f"⚠️ MİNİ-APP LİSTESİ AÇILDI! ({label})")
+                st.info("Lütfen telefondan listeyi açıp SS alın ve SAĞ TARAFA yükleyin.")
+                if st.button("❌ İptal Et", key=f"cancel_{req_id}"):
+                    finish_bridge_job(req_id, 'cancelled')
+                    st.rerun()
+        upload_waiting = any(j['step'] == 'upload_wait' for j in jobs)
+        if jobs:  # Seçim / yükleme beklenirken de (paylaşılan istek başka oturumda bitebilir)
+            bridge_status_watcher()
+
+        # 📋 WATCHLIST (TOPLU TARAMA)
+        st.divider()
+        wl_run = st.session_state.get('watchlist_run')
+        with st.expander("📋 Watchlist (Toplu Tarama)", expanded=wl_run is not None):
+            wl_text = st.text_area("Hisseler:", placeholder="THYAO, ASELS, GARAN ...", key="wl_symbols")
+            cmd_labels = {cmd: label for label, cmd in buttons_list if cmd not in NO_SYMBOL_NEEDED}
+            wl_cmds = st.multiselect("Komutlar:", list(cmd_labels), default=[c for c in WATCHLIST_DEFAULT_COMMANDS if c in cmd_labels],
+                                     format_func=cmd_labels.get, key=f"wl_cmds_{selected_bot_name}")
+            c1, c2 = st.columns(2)
+            wl_conc = c1.number_input("Eşzamanlı hisse:", min_value=1, max_value=16, value=WATCHLIST_CONCURRENCY, key="wl_conc")
+            wl_model = c2.selectbox("Model:", [MODEL_FLASH, MODEL_LITE], key="wl_model")
+
+            if st.button("🚀 TARAMAYI BAŞLAT", use_container_width=True, disabled=wl_run is not None and wl_run.running):
+                tickers = parse_tickers(wl_text)
+                init_firebase()
+                if not tickers or not wl_cmds: st.toast("⚠️ Hisse listesi ve en az bir komut gerekli!", icon="⚠️")
+                elif not st.session_state['dynamic_key_pool']: st.toast("⚠️ API Key bulunamadı!", icon="⚠️")
+                else:
+                    wl_run = WatchlistRun(tickers, wl_cmds, BOT_CONFIGS[selected_bot_name]["username"], wl_model,
+                                          st.session_state['dynamic_key_pool'], wl_conc)
+                    st.session_state['watchlist_run'] = wl_run
+                    wl_run.start()
+                    st.rerun()
+
+            if wl_run is not None and wl_run.running:
+                watchlist_live_panel()
+            elif wl_run is not None:
+                rows = wl_run.snapshot()
+                st.caption(f"✅ Tarama bitti: {len(rows)} hisse, {wl_run.finished - wl_run.started:.0f} sn")
+                st.dataframe(watchlist_table(rows), hide_index=True, use_container_width=True)
+                reports = [r['symbol'] for r in rows if r['report']]
+                if reports:
+                    c1, c2 = st.columns([2, 1])
+                    wl_pick = c1.selectbox("Rapor:", reports, key="wl_pick", label_visibility="collapsed")
+                    if c2.button("📄 Raporu Aç", use_container_width=True):
+                        report = wl_run.rows[wl_pick]['report']
+                        st.session_state['analysis_result'] = report
+                        st.session_state['analysis_sections'] = parse_markdown_sections(report)
+                        st.session_state['preprocess_report'] = None
+                        st.session_state['market_facts'] = wl_run.rows[wl_pick]['facts']
+                        st.rerun()
 
         # 𝕏 TARAYICI
         st.divider()
@@ -602,142 +3143,167 @@ def main():
 
     with col2:
         st.subheader("🧠 Detaylı Analiz")
+        job = current_analysis_job()
         uploaded_files = st.file_uploader("Görsel Yükle", accept_multiple_files=True)
-        if uploaded_files and st.session_state['telegram_flow']['step'] == 'upload_wait':
-            db.reference('bridge/request').update({'status': 'manual_completed'})
-            st.session_state['telegram_flow']['step'] = 'idle'
+        if uploaded_files and upload_waiting:
+            for bridge_job in jobs:  # 'job' analiz işidir, ezilmez
+                if bridge_job['step'] == 'upload_wait': finish_bridge_job(bridge_job['id'], 'manual_completed')
             st.success("Manuel yükleme alındı!")
             time.sleep(1)
             st.rerun()
 
-        manual_imgs = []
-        if uploaded_files:
-            for uf in uploaded_files:
-                try:
-                    # Dosyayı PIL Image formatında aç
-                    img = Image.open(uf)
-                    manual_imgs.append(img)
-                except Exception as e:
-                    st.error(f"Görsel okuma hatası: {e}")
-
-        # Manuel yüklenenler (PIL) + Telegram'dan gelenler (PIL) birleştiriliyor
-        all_imgs = manual_imgs + st.session_state['telegram_images']
-
-        if all_imgs:
-            st.write(f"{len(all_imgs)} Görsel Analize Hazır")
+        # Yüklenen dosyalar sadece ilk rerun'da çözülür ve ön işlenir; sonrası kayıttan gelir
+        upload_files = {uf.file_id: uf for uf in uploaded_files or []}
+        uploads = []
+        for rec in get_upload_registry().sync(uploaded_files):
+            if rec['error']: st.error(f"Görsel okuma hatası ({rec['name']}): {rec['error']}")
+            else: uploads.append(rec)
+
+        # Manuel yüklenenler + Telegram'dan gelenler (sıkıştırılmış depo) birleştiriliyor
+        image_store = get_image_store()
+        telegram_entries = image_store.entries()
+        image_count = len(uploads) + len(telegram_entries)
+
+        if image_count:
+            st.write(f"{image_count} Görsel Analize Hazır")
+            # Önizlemeler hash önbelleğinden gelir; tam çözünürlük sadece 🔍 açılınca yüklenir
             cols = st.columns(3)
-            for i, img in enumerate(all_imgs):
-                cols[i%3].image(img, use_container_width=True)
+            previews = [(r['id'], None, lambda uf=upload_files[r['file_id']]: uf.getvalue()) for r in uploads]
+            previews += [(e['id'], e['label'] or None, lambda i=e['id']: image_store.get_bytes(i)) for e in telegram_entries]
+            previews = list({p[0]: p for p in previews}.values())  # Aynı görsel bir kez gösterilir
+            for i, (img_hash, caption, load_full) in enumerate(previews):
+                col = cols[i%3]
+                if col.toggle("🔍", key=f"zoom_{img_hash[:16]}", help="Tam çözünürlükte göster"):
+                    col.image(load_full(), caption=caption, use_container_width=True)
+                elif img_hash in image_store:
+                    col.image(image_store.thumbnail(img_hash), caption=caption, use_container_width=True)
+                else:
+                    col.image(thumbnail_for_bytes(load_full(), img_hash), caption=caption, use_container_width=True)
+            if telegram_entries:
+                st.caption(f"🗃️ Depo: {image_store.memory_bytes / 1048576:.1f} MB bellekte, {image_store.spilled_bytes / 1048576:.1f} MB diskte")
             if st.button("TEMİZLE", type="secondary"):
-                st.session_state['telegram_images'] = []
+                image_store.clear()
                 st.session_state['analysis_result'] = None 
+                st.session_state.pop('analysis_job', None)
+                st.query_params.clear()
                 st.rerun()
 
             st.divider()
             model_choice = st.radio("Model:", [MODEL_FLASH, MODEL_LITE], horizontal=True)
+            skip_cache = st.checkbox("♻️ Önbelleği atla (yeniden analiz et)", value=False)
+            structured = st.toggle("🧾 Yapısal Çıktı (JSON şeması)", value=False, help="Bölümler şemalı JSON olarak alınır; filtre doğrudan bu nesneleri kullanır.")
+            sharded = st.checkbox("⚡ Paralel Analiz (bölüm grupları farklı keylerle eşzamanlı)", value=False, disabled=structured)
 
             # --- ANALİZ BUTONU ---
-            if st.button("ANALİZİ BAŞLAT 🚀", type="primary", use_container_width=True):
-                progress_bar = st.progress(0)
-                status_text = st.empty()
-                response_container = st.empty()
-                full_text = ""
-                
-                # Canlı Yayın (Streaming)
-                for chunk_text in analyze_images_stream(all_imgs, model_choice):
-                    if chunk_text.startswith("HATA:"):
-                        st.error(chunk_text)
-                        break
-                    else:
-                        full_text += chunk_text
-                        response_container.markdown(full_text)
-                        progress = min(len(full_text) / 9000, 0.95)
-                        progress_bar.progress(progress)
-                        status_text.caption(f"Analiz yazılıyor... %{int(progress * 100)}")
-                
-                progress_bar.progress(1.0)
-                status_text.caption("Analiz Tamamlandı! %100")
-                
-                # Sonucu Hafızaya At ve Sayfayı Yenile
-                st.session_state['analysis_result'] = full_text
-                st.rerun() 
+            # Analiz arka plan işi olarak çalışır; bu oturum sadece işe bağlanır (rerun/yenileme analizi kesmez)
+            if st.button("ANALİZİ BAŞLAT 🚀", type="primary", use_container_width=True, disabled=job is not None and job.running):
+                # Ön İşleme: küçült + yeniden kodla (hash önbelleğinden; aynı görsel ikinci analizde yeniden işlenmez)
+                prepared = [r['prepared'] for r in uploads] + [image_store.prepared(e['id']) for e in telegram_entries]
+                report = format_preprocess_report(prepared)
+                job_id = get_job_manager().submit(
+                    run_analysis_job, prepared, model_choice, use_cache=not skip_cache, sharded=sharded, structured=structured,
+                    pool=st.session_state['dynamic_key_pool'],
+                    meta={'label': "Yapısal analiz" if structured else "Analiz", 'structured': structured, 'preprocess_report': report})
+                st.session_state['analysis_job'] = job_id
+                st.query_params['job'] = job_id
+                st.session_state['analysis_result'] = None
+                st.rerun()
 
-            # --- FİLTRELİ SONUÇ GÖSTERİMİ ---
-            if st.session_state['analysis_result']:
-                st.divider()
-                st.subheader("🔍 Sonuç Filtresi")
+        elif upload_waiting:
+            st.markdown("### ⬅️ LÜTFEN GÖRSEL YÜKLEYİN")
+            st.caption("Mini-App tespit edildi.")
+        elif not st.session_state['analysis_result'] and not st.query_params.get('job'):
+            st.info("Veri bekleniyor.")
+
+        # --- ÇALIŞAN / BİTEN ANALİZ İŞİ ---
+        if job is not None and job.running:
+            analysis_job_panel(job.id)
+        elif job is not None:
+            if st.session_state.get('analysis_job_loaded') != job.id:
+                # Sonuç oturuma bir kez alınır (sonrasında Watchlist raporu vb. üzerine yazılabilir)
+                st.session_state['analysis_job_loaded'] = job.id
+                st.session_state['analysis_result'] = job.result['text'] if job.result else None
+                st.session_state['analysis_sections'] = job.result['sections'] if job.result else None
+                st.session_state['preprocess_report'] = job.meta.get('preprocess_report')
+                st.session_state['market_facts'] = job.meta.get('market_facts')
+            if job.error: st.error(job.error)
+
+        # --- FİLTRELİ SONUÇ GÖSTERİMİ (Görsel yokken de: örn. Watchlist raporu) ---
+        if st.session_state['analysis_result']:
+            st.divider()
+            if st.session_state.get('preprocess_report'):
+                with st.expander("📦 Görsel Ön İşleme Raporu"):
+                    for line in st.session_state['preprocess_report']: st.caption(line)
+            if st.session_state.get('market_facts'):
+                with st.expander("🔢 Yerel Ölçümler (OCR)"):
+                    for line in format_market_facts(st.session_state['market_facts']): st.caption(line)
+            st.subheader("🔍 Sonuç Filtresi")
+            
+            # Yapısal moddan gelen bölüm nesneleri varsa doğrudan kullanılır; yoksa markdown ayrıştırılır
+            sections = st.session_state.get('analysis_sections') or parse_markdown_sections(st.session_state['analysis_result'])
+            
+            # --- SAYIMLARI YAP ---
+            count_pos = sum(1 for s in sections if s['color'] == 'green')
+            count_neg = sum(1 for s in sections if s['color'] == 'red')
+            count_neu = sum(1 for s in sections if s['color'] == 'blue')
+
+            with st.expander("📂 Analiz Başlıklarını Filtrele", expanded=True):
                 
-                sections = parse_markdown_sections(st.session_state['analysis_result'])
+                # --- KATEGORİ BUTONLARI ---
+                c1, c2, c3 = st.columns(3)
                 
-                # --- SAYIMLARI YAP ---
-                count_pos = sum(1 for s in sections if s['color'] == 'green')
-                count_neg = sum(1 for s in sections if s['color'] == 'red')
-                count_neu = sum(1 for s in sections if s['color'] == 'blue')
-
-                with st.expander("📂 Analiz Başlıklarını Filtrele", expanded=True):
-                    
-                    # --- KATEGORİ BUTONLARI ---
-                    c1, c2, c3 = st.columns(3)
-                    
-                    # OLUMLU (YEŞİL)
-                    if c1.button(f"✅ OLUMLU ({count_pos})", use_container_width=True):
-                        for s in sections:
-                            st.session_state[f"chk_{s['id']}"] = (s['color'] == 'green')
-                        st.rerun()
-
-                    # OLUMSUZ (KIRMIZI)
-                    if c2.button(f"🔻 OLUMSUZ ({count_neg})", use_container_width=True):
-                        for s in sections:
-                            st.session_state[f"chk_{s['id']}"] = (s['color'] == 'red')
-                        st.rerun()
+                # OLUMLU (YEŞİL)
+                if c1.button(f"✅ OLUMLU ({count_pos})", use_container_width=True):
+                    for s in sections:
+                        st.session_state[f"chk_{s['id']}"] = (s['color'] == 'green')
+                    st.rerun()
 
-                    # NÖTR (MAVİ)
-                    if c3.button(f"🔹 NÖTR ({count_neu})", use_container_width=True):
-                        for s in sections:
-                            st.session_state[f"chk_{s['id']}"] = (s['color'] == 'blue')
-                        st.rerun()
-                    
-                    st.divider()
+                # OLUMSUZ (KIRMIZI)
+                if c2.button(f"🔻 OLUMSUZ ({count_neg})", use_container_width=True):
+                    for s in sections:
+                        st.session_state[f"chk_{s['id']}"] = (s['color'] == 'red')
+                    st.rerun()
 
-                    # --- TOPLU İŞLEM BUTONLARI ---
-                    col_act1, col_act2 = st.columns(2)
-                    if col_act1.button("Tümünü Seç", key="sel_all", use_container_width=True):
-                        for s in sections:
-                            st.session_state[f"chk_{s['id']}"] = True
-                        st.rerun()
-                    if col_act2.button("Tümünü Kaldır", key="desel_all", use_container_width=True):
-                        for s in sections:
-                            st.session_state[f"chk_{s['id']}"] = False
-                        st.rerun()
-                    
-                    st.divider()
-                    
-                    f_cols = st.columns(2)
-                    for i, s in enumerate(sections):
-                        # Key tabanlı state yönetimi
-                        chk_key = f"chk_{s['id']}"
-                        if chk_key not in st.session_state:
-                            st.session_state[chk_key] = True
-                            
-                        display_text = f":{s['color']}[{s['header']}]"
-                        
-                        f_cols[i % 2].checkbox(display_text, key=chk_key)
-
-                st.markdown("---")
-                # Filtrelenmiş içeriği göster
-                for s in sections:
-                    if st.session_state.get(f"chk_{s['id']}", True):
-                        st.markdown(s['body'])
-                        st.markdown("") 
+                # NÖTR (MAVİ)
+                if c3.button(f"🔹 NÖTR ({count_neu})", use_container_width=True):
+                    for s in sections:
+                        st.session_state[f"chk_{s['id']}"] = (s['color'] == 'blue')
+                    st.rerun()
                 
-                st.success("Analiz Gösterildi.")
+                st.divider()
 
-        else:
-            if step == 'upload_wait':
-                st.markdown("### ⬅️ LÜTFEN GÖRSEL YÜKLEYİN")
-                st.caption("Mini-App tespit edildi.")
-            else:
-                st.info("Veri bekleniyor.")
+                # --- TOPLU İŞLEM BUTONLARI ---
+                col_act1, col_act2 = st.columns(2)
+                if col_act1.button("Tümünü Seç", key="sel_all", use_container_width=True):
+                    for s in sections:
+                        st.session_state[f"chk_{s['id']}"] = True
+                    st.rerun()
+                if col_act2.button("Tümünü Kaldır", key="desel_all", use_container_width=True):
+                    for s in sections:
+                        st.session_state[f"chk_{s['id']}"] = False
+                    st.rerun()
+                
+                st.divider()
+                
+                f_cols = st.columns(2)
+                for i, s in enumerate(sections):
+                    # Key tabanlı state yönetimi
+                    chk_key = f"chk_{s['id']}"
+                    if chk_key not in st.session_state:
+                        st.session_state[chk_key] = True
+                        
+                    display_text = f":{s['color']}[{s['header']}]"
+                    
+                    f_cols[i % 2].checkbox(display_text, key=chk_key)
+
+            st.markdown("---")
+            # Filtrelenmiş içeriği göster
+            for s in sections:
+                if st.session_state.get(f"chk_{s['id']}", True):
+                    st.markdown(s['body'])
+                    st.markdown("") 
+            
+            st.success("Analiz Gösterildi.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,533 @@
+"""
+Scalper AI — Çevrimdışı Performans Ölçümü (Benchmark)
+
+Canlı servis gerektirmez; app.py'deki gerçek kod yolları yerel taklitlerle çalıştırılır:
+  * FakeRTDB       : bridge/requests + bridge/responses durum makinesi (listen destekli)
+  * FakeBridgeBot  : ayarlanabilir gecikmeyle istekleri cevaplayan sahte Telegram köprüsü
+  * FakeGeminiClient: gerçekçi 30 bölümlük raporu ayarlanabilir token hızında akıtan, 429/503 üreten sahte model
+  * synthetic_screenshot(): derinlik / AKD benzeri sentetik ekran görüntüleri
+
+Ölçülenler: uçtan uca gecikme, N eşzamanlı oturumda verim, oturum başına bellek,
+parse_markdown_sections() ve görsel işleme maliyeti (+ app.py metrik kaydındaki aşama kırılımı).
+
+Kullanım:
+    python benchmark.py --sessions 8 --requests 3 --bot-latency 0.5 --token-rate 2000 --fail-rate 0.05
+    python benchmark.py --quick --json bench.json
+"""
+import argparse
+import atexit
+import copy
+import gc
+import hashlib
+import json
+import queue
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import types as pytypes
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+import app
+
+BENCH_BOT = "BorsaBilgi"
+BENCH_SYMBOLS = ["THYAO", "ASELS", "GARAN", "SISE", "KCHOL", "EREGL", "BIMAS", "TUPRS", "AKBNK", "FROTO"]
+CHARS_PER_TOKEN = 4
+
+# ==========================================
+# 🔥 SAHTE RTDB
+# ==========================================
+class FakeRTDB:
+    """
+    Süreç içi Realtime Database taklidi. reference(path) -> get/set/update/delete/listen.
+    listen() geri çağrısı her değişiklikte yolun TAM kopyasıyla ('put', '/') çağrılır.
+    """
+    def __init__(self):
+        self.root = {}
+        self.writes = 0
+        self._lock = threading.RLock()
+        self._listeners = []  # (parçalar, geri çağrı)
+
+    @staticmethod
+    def _parts(path): return [p for p in path.split('/') if p]
+
+    def _get(self, parts):
+        node = self.root
+        for p in parts:
+            if not isinstance(node, dict) or p not in node: return None
+            node = node[p]
+        return copy.deepcopy(node)
+
+    def _set(self, parts, value):
+        if not parts:
+            self.root = copy.deepcopy(value) if isinstance(value, dict) else {}
+            return
+        node = self.root
+        for p in parts[:-1]:
+            child = node.get(p)
+            if not isinstance(child, dict): child = node[p] = {}
+            node = child
+        if value is None: node.pop(parts[-1], None)
+        else: node[parts[-1]] = copy.deepcopy(value)
+
+    def _write(self, parts, updates):
+        with self._lock:
+            for sub, value in updates: self._set(parts + sub, value)
+            self.writes += 1
+            # Yazılan yolun ataları ve torunları dinleyenlere, gerçek RTDB gibi yazım sırasıyla bildirilir
+            for lp, cb in list(self._listeners):
+                if lp[:len(parts)] == parts or parts[:len(lp)] == lp:
+                    cb(pytypes.SimpleNamespace(event_type='put', path='/', data=self._get(lp)))
+
+    def reference(self, path):
+        return FakeReference(self, self._parts(path))
+
+class FakeReference:
+    def __init__(self, fake_db, parts):
+        self._db, self._parts = fake_db, parts
+        self.path = "/" + "/".join(parts)
+
+    def get(self, etag=False):
+        with self._db._lock: data = self._db._get(self._parts)
+        if not etag: return data
+        return data, hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    def set(self, value): self._db._write(self._parts, [([], value)])
+
+    def update(self, values): self._db._write(self._parts, [(self._db._parts(k), v) for k, v in values.items()])
+
+    def delete(self): self.set(None)
+
+    def transaction(self, update):
+        """Gerçek RTDB'de çakışmada yeniden denenir; burada kilit altında tek seferde uygulanır. SDK gibi None reddedilir."""
+        with self._db._lock:
+            value = update(self._db._get(self._parts))
+            if value is None: raise ValueError('Value must not be none.')
+            self._db._write(self._parts, [([], value)])
+            return value
+
+    def listen(self, callback):
+        entry = (self._parts, callback)
+        with self._db._lock:
+            self._db._listeners.append(entry)
+            data = self._db._get(self._parts)
+        callback(pytypes.SimpleNamespace(event_type='put', path='/', data=data))
+
+        def close():
+            with self._db._lock:
+                if entry in self._db._listeners: self._db._listeners.remove(entry)
+        return pytypes.SimpleNamespace(close=close)
+
+# ==========================================
+# 🖼️ SENTETİK EKRAN GÖRÜNTÜLERİ
+# ==========================================
+def synthetic_screenshot(symbol, kind, seed=0, width=1080, rows=40):
+    """Derinlik / AKD tablosuna benzeyen koyu temalı PNG (rakam satırları + hacim çubukları)."""
+    rnd = random.Random(f"{symbol}-{kind}-{seed}")
+    img = Image.new("RGB", (width, 130 + rows * 44), (16, 18, 24))
+    d = ImageDraw.Draw(img)
+    d.rectangle([0, 0, width, 90], fill=(28, 32, 44))
+    d.text((24, 24), f"{symbol}  |  {kind.upper()}  |  {rnd.uniform(20, 400):.2f} TL", fill=(235, 235, 240))
+    d.text((24, 56), time.strftime("%d.%m.%Y %H:%M:%S"), fill=(150, 150, 160))
+    price = rnd.uniform(20, 400)
+    for i in range(rows):
+        y = 110 + i * 44
+        d.rectangle([0, y, width, y + 43], fill=(22, 24, 32) if i % 2 else (30, 33, 43))
+        bid_lot, ask_lot = rnd.randint(1_000, 900_000), rnd.randint(1_000, 900_000)
+        d.rectangle([width // 2 - int(bid_lot / 900_000 * 420), y + 8, width // 2, y + 36], fill=(20, 90, 50))
+        d.rectangle([width // 2, y + 8, width // 2 + int(ask_lot / 900_000 * 420), y + 36], fill=(110, 30, 36))
+        d.text((24, y + 14), f"{bid_lot:>9,}  {price - i * 0.05:8.2f}", fill=(120, 230, 150))
+        d.text((width // 2 + 24, y + 14), f"{price + (i + 1) * 0.05:8.2f}  {ask_lot:>9,}", fill=(240, 120, 120))
+    buf = BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+# ==========================================
+# 📡 SAHTE BRIDGE BOTU
+# ==========================================
+class FakeBridgeBot:
+    """
+    bridge/requests'i dinler; 'pending' (ve seçim sonrası 'selection_made') istekleri gecikmeyle cevaplar:
+    görseli taşıma katmanına koyar, yanıtı yazar, durumu 'completed' yapar.
+    selection_rate oranında önce 'waiting_user_selection' ile seçenek ister.
+    """
+    def __init__(self, fake_db, latency=0.5, jitter=0.2, selection_rate=0.0, workers=8, seed=0):
+        self.db = fake_db
+        self.latency, self.jitter, self.selection_rate = latency, jitter, selection_rate
+        self.transport = app.get_image_transport("memory")
+        self.served = 0
+        self._rnd = random.Random(seed)
+        self._handled = set()  # (istek ID, durum)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fake-bot")
+        self._registration = None
+
+    def start(self):
+        self._registration = self.db.reference(app.BRIDGE_REQUESTS_PATH).listen(self._on_event)
+        return self
+
+    def close(self):
+        if self._registration: self._registration.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _on_event(self, event):
+        for req_id, req in (event.data or {}).items():
+            status = (req or {}).get('status')
+            if status not in ('pending', 'selection_made'): continue
+            with self._lock:
+                if (req_id, status) in self._handled: continue
+                self._handled.add((req_id, status))
+                ask = status == 'pending' and self._rnd.random() < self.selection_rate
+                delay = max(0.0, self.latency + self._rnd.uniform(-self.jitter, self.jitter))
+            self._executor.submit(self._serve, req_id, dict(req), ask, delay)
+
+    def _serve(self, req_id, req, ask_selection, delay):
+        time.sleep(delay)
+        if ask_selection:
+            self.db.reference(app.bridge_response_path(req_id)).set({'options': ["1 Gün", "1 Hafta"]})
+            self.db.reference(app.bridge_request_path(req_id)).update({'status': 'waiting_user_selection'})
+            return
+        data = synthetic_screenshot(req.get('symbol') or "XU100", req.get('type', ""), seed=req_id)
+        ref = self.transport.put(data, "image/png")
+        self.db.reference(app.bridge_response_path(req_id)).set({'image': ref})
+        self.db.reference(app.bridge_request_path(req_id)).update({'status': 'completed'})
+        with self._lock: self.served += 1
+
+# ==========================================
+# 🤖 SAHTE GEMINI
+# ==========================================
+def synthetic_report(seed=0):
+    """SYSTEM_INSTRUCTION'daki 30 başlıkla gerçekçi uzunlukta rapor (bölüm 20 puan, bölüm 30 karar içerir)."""
+    rnd = random.Random(seed)
+    parts = []
+    for num, block in sorted(app.PROMPT_SECTIONS.items()):
+        title = block.strip().split("\n", 1)[0].removeprefix("## ").split(". ", 1)[-1]
+        tag = rnd.choice(["OLUMLU", "OLUMSUZ", "NÖTR"])
+        lines = [f"## {num}. {title} [{tag}]"]
+        for _ in range(rnd.randint(3, 6)):
+            lines.append(f"* **{rnd.choice(['Alıcı', 'Satıcı', 'Kurum', 'Lot', 'Maliyet'])}:** "
+                         f"{rnd.randint(10_000, 9_000_000):,} lot, ortalama {rnd.uniform(20, 400):.2f} TL; "
+                         f":{rnd.choice(['green', 'red', 'blue'])}[{rnd.choice(['güçlü alım', 'dağıtım', 'yatay seyir'])}] görülüyor.")
+        if num == 20:
+            lines += [f"* **Genel Puan:** 10 üzerinden {rnd.randint(1, 10)}", "* **Özet Yorum:** Veriler karışık sinyal veriyor."]
+        if num == 30:
+            lines += [f"* **Nihai Karar:** :{rnd.choice(['green[ALIM FIRSATI]', 'blue[İZLE]', 'red[UZAK DUR]'])}",
+                      "* **Slogan Cümle:** Sabreden derviş muradına ermiş."]
+        parts.append("\n".join(lines) + "\n\n")
+    return "".join(parts)
+
+class FakeGeminiModels:
+    def __init__(self, owner, key):
+        self.owner, self.key = owner, key
+
+    def generate_content_stream(self, model, contents, config=None):
+        o = self.owner
+        with o.lock:
+            o.calls += 1
+            if getattr(config, 'cached_content', None): o.cached_calls += 1
+            roll = o.rnd.random()
+            seed = o.rnd.random()
+        time.sleep(o.ttfb)
+        if roll < o.fail_rate / 2:
+            o.failures += 1
+            raise Exception("429 RESOURCE_EXHAUSTED. Quota exceeded. {'retryDelay': '2s'}")
+        if roll < o.fail_rate:
+            o.failures += 1
+            raise Exception("503 UNAVAILABLE. The model is overloaded. Please try again later.")
+        text = synthetic_report(seed)
+        return self._stream(text)
+
+    def _stream(self, text):
+        o = self.owner
+        chunk_chars = o.chunk_tokens * CHARS_PER_TOKEN
+        for i in range(0, len(text), chunk_chars):
+            if o.token_rate: time.sleep(o.chunk_tokens / o.token_rate)
+            yield pytypes.SimpleNamespace(text=text[i:i + chunk_chars], usage_metadata=None)
+        yield pytypes.SimpleNamespace(text=None, usage_metadata=pytypes.SimpleNamespace(total_token_count=len(text) // CHARS_PER_TOKEN),
+                                      candidates=[pytypes.SimpleNamespace(finish_reason="STOP")])
+
+    def generate_content(self, model, contents, config=None):
+        time.sleep(self.owner.ttfb)
+        return pytypes.SimpleNamespace(text="T")
+
+class FakeGeminiCaches:
+    """client.caches: bağlam önbelleği oluşturma / TTL uzatma."""
+    def __init__(self, owner):
+        self.owner = owner
+
+    def create(self, model, config=None):
+        with self.owner.lock:
+            self.owner.cache_creates += 1
+            return pytypes.SimpleNamespace(name=f"cachedContents/bench-{self.owner.cache_creates}", model=model)
+
+    def update(self, name, config=None):
+        return pytypes.SimpleNamespace(name=name)
+
+class FakeGeminiClient:
+    """genai.Client yerine geçer (ClientRegistry.client_factory ile enjekte edilir)."""
+    def __init__(self, backend, key):
+        self.models = FakeGeminiModels(backend, key)
+        self.caches = FakeGeminiCaches(backend)
+
+class FakeGeminiBackend:
+    """Tüm sahte istemcilerin paylaştığı ayarlar ve sayaçlar."""
+    def __init__(self, token_rate=2000, ttfb=0.4, fail_rate=0.05, chunk_tokens=20, seed=0):
+        self.token_rate, self.ttfb, self.fail_rate, self.chunk_tokens = token_rate, ttfb, fail_rate, chunk_tokens
+        self.calls = self.failures = self.cached_calls = self.cache_creates = 0
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def client(self, key): return FakeGeminiClient(self, key)
+
+# ==========================================
+# 🧪 SENARYOLAR
+# ==========================================
+def percentile(values, q):
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+def describe(values, unit=""):
+    if not values: return "-"
+    return (f"n={len(values)} ort={statistics.mean(values):.3f}{unit} p50={percentile(values, 0.5):.3f}{unit} "
+            f"p95={percentile(values, 0.95):.3f}{unit} maks={max(values):.3f}{unit}")
+
+def install_fakes(args):
+    """app.py'nin istemci kaydına sahte RTDB ve Gemini fabrikalarını takar."""
+    fake_db = FakeRTDB()
+    backend = FakeGeminiBackend(args.token_rate, args.ttfb, args.fail_rate, seed=args.seed)
+    registry = app.get_client_registry()
+    registry.reference_factory = fake_db.reference
+    registry.client_factory = backend.client
+    store = None
+    if args.state == "firebase":
+        # Singleton'lar ilk kullanımda depoyu alır; paylaşılan depo yolu sahte RTDB üzerinde ölçülür
+        store = app.FirebaseStateStore(reference=fake_db.reference)
+        app.get_state_store = lambda: store
+    # Ölçüm raporları çalışma dizinindeki gerçek .analysis_cache/'e yazılmaz
+    cache_dir = tempfile.mkdtemp(prefix="bench_analysis_cache_")
+    atexit.register(shutil.rmtree, cache_dir, True)
+    cache = app.AnalysisCache(root=cache_dir, store=store)
+    app.get_analysis_cache = lambda: cache
+    return fake_db, backend
+
+def wait_for_bridge(path, q, timeout):
+    """Dinleyici kuyruğundan isteğin son durumunu bekler; seçim istenirse ilk seçeneği gönderir."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try: event_path, status, _ = q.get(timeout=max(0.01, deadline - time.time()))
+        except queue.Empty: break
+        if event_path != path: continue
+        if status == 'waiting_user_selection':
+            req_id = path.rsplit('/', 1)[-1]
+            app.get_bridge_coalescer().detach(req_id)
+            if not app.get_bridge_coalescer().claim_selection(req_id): continue  # Paylaşılan istekte seçimi başka oturum yaptı
+            options = (app.rtdb(app.bridge_response_path(req_id)).get() or {}).get('options') or ["-"]
+            app.rtdb(path).update({'status': 'selection_made', 'selection': options[0], 'timestamp': time.time()})
+        elif status in ('completed', 'timeout', 'error'):
+            return status
+    return 'timeout'
+
+def run_session(session_id, args, pool, results):
+    """Tek kullanıcı oturumu: bot istekleri -> görsel deposu -> ön işleme -> analiz -> ayrıştırma."""
+    q, store = queue.Queue(), app.ImageStore()
+    target_bot = app.BOT_CONFIGS[BENCH_BOT]["username"]
+    for i in range(args.requests):
+        symbol = BENCH_SYMBOLS[0] if args.hot else BENCH_SYMBOLS[(session_id + i) % len(BENCH_SYMBOLS)]
+        row = {'session': session_id, 'symbol': symbol, 'ok': False}
+        t0 = time.perf_counter()
+        try:
+            image_ids = []
+            for cmd in args.commands:
+                # Uygulamayla aynı yol: birleştirici (uçuştaki isteğe bağlan / taze görseli al) -> dinleyici -> taşıyıcı
+                kind, value = app.open_bridge_request(symbol, cmd, target_bot, q)
+                if kind == 'cached':
+                    image_ids.append(store.add(value['data'], label=f"{cmd} {symbol}", content_type=value['content_type']))
+                    continue
+                try:
+                    status = wait_for_bridge(app.bridge_request_path(value), q, args.bridge_timeout)
+                    if status != 'completed': raise RuntimeError(f"bridge {cmd}: {status}")
+                    data, content_type = app.bridge_result_image(value)
+                    image_ids.append(store.add(data, label=f"{cmd} {symbol}", content_type=content_type or "image/png"))
+                finally:
+                    app.close_bridge_request(value, q)
+            row['bridge_s'] = time.perf_counter() - t0
+
+            t1 = time.perf_counter()
+            prepared = [store.prepared(image_id) for image_id in image_ids]
+            row['prepare_s'] = time.perf_counter() - t1
+
+            t2, first, text = time.perf_counter(), None, []
+            for chunk in app.analyze_images_stream(prepared, args.model, use_cache=False, pool=pool):
+                kind = app.stream_kind(chunk)
+                if kind == 'error': raise RuntimeError(chunk.strip())
+                if kind == 'reset': text = []  # Key değişti: rapor baştan gelir
+                if kind != 'text': continue
+                if first is None: first = time.perf_counter() - t2
+                text.append(chunk)
+            row['first_chunk_s'], row['analysis_s'] = first, time.perf_counter() - t2
+
+            t3 = time.perf_counter()
+            sections = app.parse_markdown_sections("".join(text))
+            row['parse_s'] = time.perf_counter() - t3
+            row['sections'] = len(sections)
+            row['ok'] = len(sections) >= app.EXPECTED_SECTION_COUNT
+        except Exception as e:
+            row['error'] = str(e)[:160]
+        row['e2e_s'] = time.perf_counter() - t0
+        results.append(row)
+    results.append({'session': session_id, 'store_bytes': store.memory_bytes + store.spilled_bytes})
+
+def bench_end_to_end(args):
+    fake_db, backend = install_fakes(args)
+    bot = FakeBridgeBot(fake_db, args.bot_latency, args.bot_jitter, args.selection_rate, workers=args.bot_workers, seed=args.seed).start()
+    pool = [f"AIzaBENCH{i:04d}xxxxxxxxxxxx" for i in range(args.keys)]
+    results = []
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions, thread_name_prefix="bench-session") as ex:
+        for sid in range(args.sessions): ex.submit(run_session, sid, args, pool, results)
+    wall = time.perf_counter() - t0
+    bot.close()
+
+    rows = [r for r in results if 'symbol' in r]
+    ok = [r for r in rows if r['ok']]
+    return {
+        'sessions': args.sessions, 'analyses': len(rows), 'succeeded': len(ok), 'wall_s': wall,
+        'throughput_per_min': len(ok) / wall * 60 if wall else 0,
+        'e2e_s': [r['e2e_s'] for r in ok], 'bridge_s': [r['bridge_s'] for r in ok],
+        'prepare_s': [r['prepare_s'] for r in ok], 'first_chunk_s': [r['first_chunk_s'] for r in ok if r.get('first_chunk_s')],
+        'analysis_s': [r['analysis_s'] for r in ok], 'parse_s': [r['parse_s'] for r in ok],
+        'errors': [r['error'] for r in rows if r.get('error')],
+        'gemini_calls': backend.calls, 'gemini_failures': backend.failures,
+        'gemini_cached_calls': backend.cached_calls, 'prompt_cache_creates': backend.cache_creates, 'bot_served': bot.served, 'rtdb_writes': fake_db.writes,
+        'coalesce': app.get_bridge_coalescer().stats(),
+    }
+
+def bench_parse(iterations):
+    reports = [synthetic_report(seed) for seed in range(iterations)]
+    cold, warm, incremental = [], [], []
+    for text in reports:
+        app.get_parse_cache.clear()
+        t0 = time.perf_counter(); app.parse_markdown_sections(text); cold.append(time.perf_counter() - t0)
+        t0 = time.perf_counter(); app.parse_markdown_sections(text); warm.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        parser = app.IncrementalSectionParser()
+        for i in range(0, len(text), 80): parser.feed(text[i:i + 80])
+        parser.finish()
+        incremental.append(time.perf_counter() - t0)
+    return {'report_chars': statistics.mean(len(t) for t in reports), 'cold_s': cold, 'warm_s': warm, 'incremental_80b_s': incremental}
+
+def bench_images(iterations):
+    shots = [synthetic_screenshot(BENCH_SYMBOLS[i % len(BENCH_SYMBOLS)], "derinlik", seed=i) for i in range(iterations)]
+    transport = app.get_image_transport("memory")
+    fetch, store_add, preprocess, thumb, ratio = [], [], [], [], []
+    for data in shots:
+        ref = transport.put(data)
+        t0 = time.perf_counter(); transport.fetch(ref); fetch.append(time.perf_counter() - t0)
+        t0 = time.perf_counter(); app.ImageStore().add(data); store_add.append(time.perf_counter() - t0)
+        with Image.open(BytesIO(data)) as img:
+            img.info['source_bytes'] = len(data)
+            t0 = time.perf_counter(); prepared = app.preprocess_image(img); preprocess.append(time.perf_counter() - t0)
+            t0 = time.perf_counter(); app.make_thumbnail(img); thumb.append(time.perf_counter() - t0)
+        ratio.append(prepared['bytes'] / len(data))
+    return {'png_bytes': statistics.mean(len(d) for d in shots), 'fetch_s': fetch, 'store_add_s': store_add,
+            'preprocess_s': preprocess, 'thumbnail_s': thumb, 'payload_ratio': statistics.mean(ratio)}
+
+def bench_memory(images_per_session, sessions=4):
+    """
+    Oturum başına kalıcı bellek: görsel deposu + ham rapor + ayrıştırılmış bölümler (tracemalloc).
+    Her oturumun görselleri farklıdır ve ölçüm penceresinde üretilir (baytlar ve ortak önizleme önbelleği sayılır).
+    """
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    keep = []
+    for s in range(sessions):
+        store = app.ImageStore()
+        for i in range(images_per_session):
+            store.add(synthetic_screenshot("THYAO", f"k{i}", seed=s * images_per_session + i), label="bench")
+        report = synthetic_report(1000 + s)
+        keep.append((store, report, app.parse_markdown_sections(report)))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return {'images_per_session': images_per_session, 'bytes_per_session': used / sessions}
+
+# ==========================================
+# 🖥️ ÇIKTI
+# ==========================================
+def main():
+    ap = argparse.ArgumentParser(description="Scalper AI çevrimdışı benchmark")
+    ap.add_argument("--sessions", type=int, default=4, help="Eşzamanlı sanal oturum sayısı")
+    ap.add_argument("--requests", type=int, default=3, help="Oturum başına analiz sayısı")
+    ap.add_argument("--commands", default="derinlik,akd", help="Analiz başına bot komutları (virgüllü)")
+    ap.add_argument("--bot-latency", type=float, default=0.5, help="Bot yanıt gecikmesi (sn)")
+    ap.add_argument("--bot-jitter", type=float, default=0.2)
+    ap.add_argument("--bot-workers", type=int, default=8, help="Bridge'in aynı anda işlediği istek sayısı")
+    ap.add_argument("--selection-rate", type=float, default=0.0, help="Seçim isteyen yanıt oranı")
+    ap.add_argument("--bridge-timeout", type=float, default=30)
+    ap.add_argument("--hot", action="store_true", help="Tüm oturumlar aynı hisseyi ister (açılış anı; istek birleştirmeyi ölçer)")
+    ap.add_argument("--state", choices=("memory", "firebase"), default="memory", help="Paylaşılan durum deposu (firebase: sahte RTDB)")
+    ap.add_argument("--token-rate", type=float, default=2000, help="Sahte modelin token/sn hızı")
+    ap.add_argument("--ttfb", type=float, default=0.4, help="İlk parçaya kadar gecikme (sn)")
+    ap.add_argument("--fail-rate", type=float, default=0.05, help="429/503 oranı (yarı yarıya)")
+    ap.add_argument("--keys", type=int, default=8, help="Havuzdaki sahte key sayısı")
+    ap.add_argument("--model", default=app.MODEL_FLASH)
+    ap.add_argument("--micro", type=int, default=20, help="Parse/görsel mikro ölçüm tekrar sayısı")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--quick", action="store_true", help="Kısa duman testi (2 oturum x 1 analiz, hızlı sahteler)")
+    ap.add_argument("--json", help="Sonuçları bu dosyaya yaz")
+    args = ap.parse_args()
+    if args.quick:
+        args.sessions, args.requests, args.micro = 2, 1, 5
+        args.bot_latency, args.bot_jitter, args.ttfb, args.token_rate = 0.05, 0.0, 0.02, 0
+    args.commands = [c.strip() for c in args.commands.split(",") if c.strip()]
+
+    print(f"⚙️  {args.sessions} oturum x {args.requests} analiz | komutlar={args.commands} | bot={args.bot_latency}s "
+          f"| {args.token_rate:.0f} token/sn | hata=%{args.fail_rate * 100:.0f} | {args.keys} key | durum={args.state}")
+    e2e = bench_end_to_end(args)
+    parse = bench_parse(args.micro)
+    images = bench_images(max(1, args.micro // 2))
+    memory = bench_memory(len(args.commands) * args.requests)
+
+    print("\n📡 UÇTAN UCA")
+    print(f"  başarılı {e2e['succeeded']}/{e2e['analyses']} | süre {e2e['wall_s']:.1f} sn | verim {e2e['throughput_per_min']:.1f} analiz/dk")
+    for name in ('e2e_s', 'bridge_s', 'prepare_s', 'first_chunk_s', 'analysis_s', 'parse_s'):
+        print(f"  {name:<14} {describe(e2e[name], 's')}")
+    print(f"  gemini çağrı {e2e['gemini_calls']} (hata {e2e['gemini_failures']}, önbellekli talimat {e2e['gemini_cached_calls']}, "
+          f"önbellek oluşturma {e2e['prompt_cache_creates']}) | bot {e2e['bot_served']} görsel | rtdb yazma {e2e['rtdb_writes']}")
+    co = e2e['coalesce']
+    print(f"  bridge birleştirme: {co['new']} yeni istek, {co['attached']} uçuştakine bağlandı, {co['cached']} önbellekten")
+    for err in e2e['errors'][:5]: print(f"  ⚠️ {err}")
+
+    print(f"\n🧩 AYRIŞTIRMA (rapor ~{parse['report_chars']:.0f} karakter)")
+    for name in ('cold_s', 'warm_s', 'incremental_80b_s'):
+        print(f"  {name:<18} {describe([v * 1000 for v in parse[name]], 'ms')}")
+
+    print(f"\n🖼️ GÖRSEL (PNG ~{images['png_bytes'] / 1024:.0f} KB, Gemini'ye giden/kaynak = {images['payload_ratio']:.2f})")
+    for name in ('fetch_s', 'store_add_s', 'preprocess_s', 'thumbnail_s'):
+        print(f"  {name:<14} {describe([v * 1000 for v in images[name]], 'ms')}")
+
+    print(f"\n🧠 BELLEK: oturum başına ~{memory['bytes_per_session'] / 1048576:.2f} MB ({memory['images_per_session']} görsel + rapor)")
+
+    stages = app.get_metrics().summary()
+    if stages:
+        print("\n📈 AŞAMA METRİKLERİ (app.py)")
+        for row in stages:
+            tags = ",".join(f"{k}={v}" for k, v in row['tags'].items() if k != 'key')
+            print(f"  {row['name']:<28} {tags:<42} n={row['count']:<4} p50={row['p50']:.4g} p95={row['p95']:.4g}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({'args': vars(args), 'end_to_end': e2e, 'parse': parse, 'images': images, 'memory': memory,
+                       'stages': stages}, f, ensure_ascii=False, indent=1)
+        print(f"\n💾 {args.json}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,485 @@
+"""
+Scalper AI — Telegram Bridge Worker (asyncio / Telethon)
+
+bridge/requests/<id> düğümlerini dinler, BOT_CONFIGS'teki botlarla konuşur, görseli taşıma katmanına koyar,
+bridge/responses/<id> + durumu yazar (app.py ile aynı protokol):
+  pending -> processing -> completed | waiting_user_selection -> selection_made -> ... | miniapp_waiting_upload | error
+  * Bot başına bir şerit: aynı botla tek konuşma (yanıtlar karışmaz), botlar birbirini beklemez
+  * Bot başına hız sınırı; FloodWait'te sadece o botun şeridi bekler
+  * Bekçi: takılan istekleri 'timeout' yapar, eski düğümleri temizler
+  * bridge/system_command 'restart': Telegram bağlantısı yeniden kurulur, yarım kalan istekler yeniden sıraya girer
+
+Tek örnek çalıştırılmalıdır (istekler RTDB'de kilitlenmeden sahiplenilir).
+
+Kullanım:
+    TELEGRAM_API_ID=... TELEGRAM_API_HASH=... TELEGRAM_SESSION=... python bridge_worker.py --transport storage
+    python bridge_worker.py --test      # Sahte Telegram + sahte RTDB ile kendi kendini sınar (ağ gerekmez)
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+from telethon.errors import FloodWaitError
+
+import app
+
+# ==========================================
+# ⚙️ AYARLAR
+# ==========================================
+COMMAND_FORMAT = "/{type} {symbol}"   # Bota giden mesaj; hisse gerekmeyen komutlarda "/{type}"
+BOT_MIN_INTERVAL_SEC = 2.0            # Aynı bota art arda iki mesaj arasındaki en kısa süre
+BOT_REPLY_TIMEOUT_SEC = 45            # Görsel / buton / mini-app yanıtı için bekleme
+FLOOD_WAIT_MAX_RETRIES = 3            # FloodWait sonrası aynı adımın en fazla tekrar sayısı
+REQUEST_TIMEOUT_SEC = 120             # pending / processing / selection_made bundan uzun sürerse 'timeout'
+SELECTION_TIMEOUT_SEC = 300           # Kullanıcı seçimi bekleme süresi
+UPLOAD_TIMEOUT_SEC = 600              # Mini-app manuel yükleme bekleme süresi
+WATCHDOG_INTERVAL_SEC = 5
+NODE_GC_SEC = 3600                    # Bitmiş (tamamlanan / iptal / zaman aşımı) düğümler bu süre sonunda silinir
+TERMINAL_STATUSES = ('completed', 'timeout', 'cancelled', 'manual_completed', 'error')
+
+def format_command(req):
+    rtype, symbol = req.get('type', ""), (req.get('symbol') or "").upper()
+    if rtype in app.NO_SYMBOL_NEEDED or not symbol: return f"/{rtype}"
+    return COMMAND_FORMAT.format(type=rtype, symbol=symbol)
+
+def empty_reply(message=None, text=""):
+    """Bot yanıtının ortak biçimi (gerçek ve sahte ağ geçidi aynısını döndürür)."""
+    return {'message': message, 'text': text, 'image': None, 'content_type': None, 'options': [], 'webapp': False}
+
+# ==========================================
+# 📨 TELEGRAM AĞ GEÇİDİ
+# ==========================================
+def is_webapp_button(button):
+    # Katman sürümüne göre sınıf adı değişir (KeyboardButtonWebView, ...SimpleWebView, InlineButtonTypeWebView)
+    raw = getattr(button, 'button', None)
+    return any("WebView" in type(obj).__name__ for obj in (raw, getattr(raw, 'type', None)) if obj is not None)
+
+class TelethonGateway:
+    """Kullanıcı hesabıyla gerçek Telegram bağlantısı. Sıralama şeritlerde yapılır; burada bot başına tek konuşma açılır."""
+    def __init__(self, api_id, api_hash, session, reply_timeout=BOT_REPLY_TIMEOUT_SEC):
+        self.api_id, self.api_hash, self.session = int(api_id), api_hash, session
+        self.reply_timeout = reply_timeout
+        self.client = None
+
+    async def connect(self):
+        from telethon import TelegramClient
+        from telethon.sessions import StringSession
+        if self.client is None:
+            # Uzun değer StringSession, kısa değer oturum dosyası adıdır
+            session = StringSession(self.session) if len(self.session) > 64 else self.session
+            self.client = TelegramClient(session, self.api_id, self.api_hash)
+        await self.client.start()
+
+    async def disconnect(self):
+        if self.client is not None: await self.client.disconnect()
+
+    async def send(self, bot, text):
+        async with self.client.conversation(bot, timeout=self.reply_timeout, exclusive=True) as conv:
+            await conv.send_message(text)
+            return await self._read(conv, bot)
+
+    async def click(self, bot, reply, option):
+        """Önceki yanıttaki butona basar; bot yeni mesaj da atabilir, aynı mesajı da düzenleyebilir."""
+        message = reply['message']
+        async with self.client.conversation(bot, timeout=self.reply_timeout, exclusive=True) as conv:
+            await message.click(text=option)
+            return await self._read(conv, bot, edited_id=message.id)
+
+    async def _read(self, conv, bot, edited_id=None):
+        """Görsel / seçenek / mini-app gelene kadar okur; ara 'hazırlanıyor' mesajları atlanır, sonuncusu metin olarak döner."""
+        from telethon import events
+        deadline = time.monotonic() + self.reply_timeout
+        last = empty_reply()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return last
+            waits = [asyncio.ensure_future(conv.get_response())]
+            if edited_id is not None:
+                waits.append(asyncio.ensure_future(conv.wait_event(events.MessageEdited(chats=bot, func=lambda e: e.id == edited_id))))
+            done, pending = await asyncio.wait(waits, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for fut in pending: fut.cancel()
+            if not done: return last
+            result = done.pop().result()
+            reply = await self._to_reply(getattr(result, 'message', result))
+            if reply['image'] or reply['options'] or reply['webapp']: return reply
+            last = reply
+
+    async def _to_reply(self, msg):
+        reply = empty_reply(msg, msg.raw_text or "")
+        mime = (msg.file.mime_type or "") if msg.file else ""
+        if msg.photo or (msg.document and mime.startswith("image/")):
+            reply['image'] = await msg.download_media(file=bytes)
+            reply['content_type'] = "image/jpeg" if msg.photo else mime
+        for row in msg.buttons or []:
+            for button in row:
+                if is_webapp_button(button): reply['webapp'] = True
+                elif not button.url: reply['options'].append(button.text)
+        return reply
+
+# ==========================================
+# 🛣️ BOT ŞERİTLERİ
+# ==========================================
+class BotLane:
+    """
+    Tek bot için sıralı iş kuyruğu. Mesajlar arasında min_interval korunur; FloodWait gelirse
+    şerit istenen süre kadar durur ve aynı adım tekrarlanır. Diğer botların şeritleri etkilenmez.
+    """
+    def __init__(self, worker, bot, min_interval=BOT_MIN_INTERVAL_SEC):
+        self.worker, self.bot, self.min_interval = worker, bot, min_interval
+        self.queue = asyncio.Queue()
+        self.next_send = 0.0
+        self.task = asyncio.create_task(self._run(), name=f"lane-{bot}")
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.worker.handle(self, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self.worker.fail(job['id'], f"{type(e).__name__}: {e}")
+
+    async def call(self, fn, *args):
+        """Hız sınırına uyarak Telegram çağrısı yapar."""
+        for attempt in range(FLOOD_WAIT_MAX_RETRIES + 1):
+            wait = self.next_send - time.monotonic()
+            if wait > 0: await asyncio.sleep(wait)
+            self.next_send = time.monotonic() + self.min_interval
+            try:
+                return await fn(self.bot, *args)
+            except FloodWaitError as e:
+                self.worker.stats['flood_waits'] += 1
+                self.next_send = time.monotonic() + e.seconds
+                app.get_metrics().incr("bridge_flood_wait", bot=self.bot)
+                if attempt == FLOOD_WAIT_MAX_RETRIES: raise
+
+# ==========================================
+# 🌉 WORKER
+# ==========================================
+class BridgeWorker:
+    """
+    bridge/requests'i dinler, istekleri bot şeritlerine dağıtır, bekçiyi ve yeniden başlatma komutunu yönetir.
+    RTDB çağrıları (bloklayan HTTP) thread'e, Telegram çağrıları olay döngüsüne aittir.
+    """
+    def __init__(self, gateway, transport, min_interval=BOT_MIN_INTERVAL_SEC, request_timeout=REQUEST_TIMEOUT_SEC,
+                 selection_timeout=SELECTION_TIMEOUT_SEC, upload_timeout=UPLOAD_TIMEOUT_SEC,
+                 watchdog_interval=WATCHDOG_INTERVAL_SEC, gc_after=NODE_GC_SEC):
+        self.gateway, self.transport, self.min_interval = gateway, transport, min_interval
+        self.limits = {'pending': request_timeout, 'processing': request_timeout, 'selection_made': request_timeout,
+                       'waiting_user_selection': selection_timeout, 'miniapp_waiting_upload': upload_timeout}
+        self.watchdog_interval, self.gc_after = watchdog_interval, gc_after
+        self.snapshot = {}
+        self.active = {}   # req_id -> {'bot', 'stage': queued | running | waiting_selection, 'reply'}
+        self.lanes = {}
+        self.stats = {'completed': 0, 'selection': 0, 'miniapp': 0, 'error': 0, 'timeout': 0, 'collected': 0, 'restarts': 0, 'flood_waits': 0}
+        self.started = time.time()
+        self._events = None
+        self._loop = None
+        self._registrations = []
+        self._stop = asyncio.Event()
+
+    # --- RTDB ---
+    async def _write(self, path, method, value=None):
+        ref = app.rtdb(path)
+        await asyncio.to_thread(getattr(ref, method), *(() if value is None else (value,)))
+
+    async def _set_status(self, req_id, status, response=None):
+        # Önce yanıt, sonra durum: uygulama durumu görünce yanıtı hazır bulur
+        if response is not None: await self._write(app.bridge_response_path(req_id), 'set', response)
+        await self._write(app.bridge_request_path(req_id), 'update', {'status': status, 'timestamp': time.time()})
+
+    def _listen(self, path, kind):
+        def callback(event):
+            self._loop.call_soon_threadsafe(self._events.put_nowait, (kind, event))
+        return app.rtdb(path).listen(callback)
+
+    # --- Yaşam döngüsü ---
+    async def run(self):
+        self._loop, self._events = asyncio.get_running_loop(), asyncio.Queue()
+        await self.gateway.connect()
+        for path, kind in ((app.BRIDGE_REQUESTS_PATH, 'requests'), (app.BRIDGE_SYSTEM_COMMAND_PATH, 'command')):
+            self._registrations.append(await asyncio.to_thread(self._listen, path, kind))
+        watchdog = asyncio.create_task(self._watchdog(), name="watchdog")
+        stop = asyncio.create_task(self._stop.wait())
+        try:
+            while not self._stop.is_set():
+                get = asyncio.create_task(self._events.get())
+                await asyncio.wait((get, stop), return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    break
+                kind, event = get.result()
+                if kind == 'requests':
+                    self.snapshot = app._apply_rtdb_event(self.snapshot, event.event_type, event.path, event.data) or {}
+                    await self._dispatch()
+                elif kind == 'command':
+                    await self._on_command(app._apply_rtdb_event(None, event.event_type, event.path, event.data))
+        finally:
+            watchdog.cancel()
+            stop.cancel()
+            for lane in self.lanes.values(): lane.task.cancel()
+            for reg in self._registrations:
+                try: reg.close()
+                except Exception: pass
+            await self.gateway.disconnect()
+
+    def stop(self): self._stop.set()
+
+    def lane(self, bot):
+        if bot not in self.lanes: self.lanes[bot] = BotLane(self, bot, self.min_interval)
+        return self.lanes[bot]
+
+    async def _dispatch(self):
+        """Yeni istekleri sahiplenir, seçimleri ilgili şeride iletir, iptal edilenleri bırakır."""
+        for req_id, req in list(self.snapshot.items()):
+            if not isinstance(req, dict): continue
+            status, state = req.get('status'), self.active.get(req_id)
+            if status == 'pending' and state is None:
+                self.active[req_id] = {'bot': req.get('target_bot'), 'stage': 'queued', 'reply': None}
+                await self._set_status(req_id, 'processing')
+                self.lane(req.get('target_bot')).queue.put_nowait({'id': req_id, 'kind': 'send', 'req': dict(req)})
+            elif status == 'selection_made' and state and state['stage'] == 'waiting_selection':
+                state['stage'] = 'queued'
+                self.lane(state['bot']).queue.put_nowait({'id': req_id, 'kind': 'click', 'selection': req.get('selection')})
+            elif status in TERMINAL_STATUSES and state and state['stage'] != 'running':
+                self.active.pop(req_id, None)  # Uygulama iptal etti / elle tamamladı
+        for req_id in [r for r in self.active if r not in self.snapshot]:
+            self.active.pop(req_id, None)  # Düğüm silindi
+
+    async def handle(self, lane, job):
+        state = self.active.get(job['id'])
+        if state is None or state['stage'] != 'queued': return  # Sırada beklerken iptal / zaman aşımı
+        state['stage'] = 'running'
+        if job['kind'] == 'send':
+            reply = await lane.call(self.gateway.send, format_command(job['req']))
+        else:
+            reply = await lane.call(self.gateway.click, state['reply'], job['selection'])
+        if self.active.get(job['id']) is not state: return  # Beklerken bekçi zaman aşımı yazdı
+        await self._deliver(job['id'], state, reply)
+
+    async def _deliver(self, req_id, state, reply):
+        if reply['image']:
+            ref = await asyncio.to_thread(self.transport.put, reply['image'], reply['content_type'] or "image/jpeg")
+            self.active.pop(req_id, None)
+            await self._set_status(req_id, 'completed', {'image': ref, 'text': reply['text'][:500]})
+            self.stats['completed'] += 1
+        elif reply['options']:
+            state.update(stage='waiting_selection', reply=reply)
+            await self._set_status(req_id, 'waiting_user_selection', {'options': reply['options'], 'text': reply['text'][:500]})
+            self.stats['selection'] += 1
+        elif reply['webapp']:
+            self.active.pop(req_id, None)
+            await self._set_status(req_id, 'miniapp_waiting_upload')
+            self.stats['miniapp'] += 1
+        else:
+            await self.fail(req_id, reply['text'] or "Bot yanıt vermedi.")
+
+    async def fail(self, req_id, message):
+        if self.active.pop(req_id, None) is None: return
+        await self._set_status(req_id, 'error', {'error': message[:500]})
+        self.stats['error'] += 1
+
+    # --- Bekçi ---
+    async def _watchdog(self):
+        while True:
+            await asyncio.sleep(self.watchdog_interval)
+            try: await self.sweep()
+            except Exception as e: print(f"⚠️ Bekçi hatası: {e}", file=sys.stderr)
+
+    async def sweep(self, now=None):
+        """Süresi geçen istekleri 'timeout' yapar, eski bitmiş düğümleri siler."""
+        now = now or time.time()
+        for req_id, req in list(self.snapshot.items()):
+            if not isinstance(req, dict): continue
+            status, age = req.get('status'), now - (req.get('timestamp') or now)
+            limit = self.limits.get(status)
+            if limit is not None and age > limit:
+                self.active.pop(req_id, None)  # Şeritteki konuşma sürse de sonucu yazılmaz
+                await self._set_status(req_id, 'timeout')
+                self.stats['timeout'] += 1
+                app.get_metrics().incr("bridge_watchdog_timeout", status=status)
+            elif status in TERMINAL_STATUSES and age > self.gc_after:
+                app.get_metrics().incr("bridge_gc")
+                await self._write(app.bridge_request_path(req_id), 'delete')
+                await self._write(app.bridge_response_path(req_id), 'delete')
+                self.stats['collected'] += 1
+
+    # --- Yeniden başlatma ---
+    async def _on_command(self, command):
+        if not isinstance(command, dict) or command.get('command') != 'restart': return
+        await self._write(app.BRIDGE_SYSTEM_COMMAND_PATH, 'delete')  # Komut alındı
+        if (command.get('timestamp') or 0) < self.started: return  # Worker açılmadan önce yazılmış
+        await self.restart()
+
+    async def restart(self):
+        """Telegram bağlantısını yeniden kurar; seçim beklemeyen yarım işler yeniden sıraya girer."""
+        self.stats['restarts'] += 1
+        for lane in self.lanes.values(): lane.task.cancel()
+        self.lanes = {}
+        await self.gateway.disconnect()
+        await self.gateway.connect()
+        requeue = [r for r, s in self.active.items() if s['stage'] != 'waiting_selection']
+        for req_id in requeue:
+            self.active.pop(req_id, None)
+            await self._set_status(req_id, 'pending')  # Dinleyici üzerinden tekrar sahiplenilir
+
+# ==========================================
+# 🧪 TEST MODU (Sahte Telegram + sahte RTDB)
+# ==========================================
+FAKE_SELECTION_COMMANDS = ("akd", "akdpro", "takas")
+FAKE_MINIAPP_COMMANDS = ("kurum", "kurumlar")
+FAKE_ERROR_COMMANDS = ("haber",)
+
+class FakeTelegramGateway:
+    """
+    Botları taklit eder: çoğu komut görsel, bazıları önce seçenek, mini-app ya da hata döndürür.
+    flood_bots'a giden ilk mesaj FloodWait üretir. Bot başına / toplam eşzamanlılık kaydedilir.
+    """
+    def __init__(self, latency=0.3, flood_bots=(), flood_seconds=1):
+        self.latency, self.flood_seconds = latency, flood_seconds
+        self.flood_pending = set(flood_bots)
+        self.sent = []  # (bot, metin, zaman)
+        self.connects = 0
+        self.max_per_bot, self.max_total = {}, 0
+        self._active = {}
+
+    async def connect(self): self.connects += 1
+    async def disconnect(self): pass
+
+    async def send(self, bot, text):
+        if bot in self.flood_pending:
+            self.flood_pending.discard(bot)
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        self.sent.append((bot, text, time.monotonic()))
+        parts = text.lstrip("/").split()
+        rtype, symbol = parts[0], (parts[1] if len(parts) > 1 else "")
+        await self._busy(bot)
+        reply = empty_reply({'bot': bot, 'type': rtype, 'symbol': symbol})
+        if rtype in FAKE_SELECTION_COMMANDS: reply['options'] = ["Bugün", "1 Hafta"]
+        elif rtype in FAKE_MINIAPP_COMMANDS: reply['webapp'] = True
+        elif rtype in FAKE_ERROR_COMMANDS: reply['text'] = "Sonuç bulunamadı."
+        else: self._photo(reply, symbol, rtype)
+        return reply
+
+    async def click(self, bot, reply, option):
+        await self._busy(bot)
+        result = empty_reply(reply['message'])
+        self._photo(result, reply['message']['symbol'], f"{reply['message']['type']} {option}")
+        return result
+
+    def _photo(self, reply, symbol, kind):
+        from benchmark import synthetic_screenshot
+        reply['image'], reply['content_type'] = synthetic_screenshot(symbol or "XU100", kind, rows=8), "image/png"
+
+    async def _busy(self, bot):
+        self._active[bot] = self._active.get(bot, 0) + 1
+        self.max_per_bot[bot] = max(self.max_per_bot.get(bot, 0), self._active[bot])
+        self.max_total = max(self.max_total, sum(self._active.values()))
+        try: await asyncio.sleep(self.latency)
+        finally: self._active[bot] -= 1
+
+def run_self_test(args):
+    """Uygulamanın yaptığını taklit eder: istek yazar, seçim yapar, görseli çeker; sonunda beklentileri doğrular."""
+    from benchmark import FakeRTDB
+    fake_db = FakeRTDB()
+    app.get_client_registry().reference_factory = fake_db.reference
+    bots = [cfg["username"] for cfg in app.BOT_CONFIGS.values()]
+    gateway = FakeTelegramGateway(args.latency, flood_bots=bots[:1])
+    worker = BridgeWorker(gateway, app.get_image_transport("memory"), min_interval=args.interval,
+                          request_timeout=5, watchdog_interval=0.2)
+
+    expected, finished, lock = {}, {}, threading.Lock()
+    for bot_name, cfg in app.BOT_CONFIGS.items():
+        for _, cmd in cfg["buttons"]:
+            symbol = "" if cmd in app.NO_SYMBOL_NEEDED else "THYAO"
+            req_id = app.submit_bridge_request(symbol, cmd, cfg["username"])
+            expected[req_id] = ('miniapp_waiting_upload' if cmd in FAKE_MINIAPP_COMMANDS else
+                                'error' if cmd in FAKE_ERROR_COMMANDS else 'completed', bot_name, cmd)
+    # Çökmüş bir önceki worker'dan kalan istek: bekçi zaman aşımına düşürmeli
+    stale_id = app.new_bridge_request_id()
+    app.rtdb(app.bridge_request_path(stale_id)).set({'symbol': "ASELS", 'type': "derinlik", 'target_bot': bots[0],
+                                                     'status': 'processing', 'timestamp': time.time() - 60})
+    expected[stale_id] = ('timeout', "-", "stale")
+
+    def on_change(event):
+        # Uygulama tarafı: seçenek gelince ilkini seç, sonuçları kaydet
+        for req_id, req in (event.data or {}).items():
+            status = (req or {}).get('status')
+            if req_id not in expected or req_id in finished: continue
+            if status == 'waiting_user_selection':
+                options = (fake_db.reference(app.bridge_response_path(req_id)).get() or {}).get('options') or ["-"]
+                threading.Thread(target=fake_db.reference(app.bridge_request_path(req_id)).update,
+                                 args=({'status': 'selection_made', 'selection': options[0], 'timestamp': time.time()},)).start()
+            elif status in TERMINAL_STATUSES + ('miniapp_waiting_upload',):
+                with lock: finished[req_id] = (status, time.monotonic())
+    registration = fake_db.reference(app.BRIDGE_REQUESTS_PATH).listen(on_change)
+
+    async def scenario():
+        task = asyncio.create_task(worker.run())
+        t0 = time.monotonic()
+        await asyncio.sleep(args.latency * 2)
+        app.rtdb(app.BRIDGE_SYSTEM_COMMAND_PATH).set({'command': 'restart', 'timestamp': time.time()})
+        while len(finished) < len(expected) and time.monotonic() - t0 < args.timeout:
+            await asyncio.sleep(0.05)
+        wall = time.monotonic() - t0
+        worker.stop()
+        await task
+        return t0, wall
+
+    t0, wall = asyncio.run(scenario())
+    registration.close()
+
+    failures = []
+    print(f"\n🌉 BRIDGE WORKER TESTİ ({len(expected)} istek, {len(bots)} bot, bot gecikmesi {args.latency:.2f} sn)")
+    for req_id, (want, bot_name, cmd) in expected.items():
+        got, at = finished.get(req_id, (None, None))
+        ok = got == want
+        if want == 'completed' and ok:
+            data = app.fetch_bridge_image(fake_db.reference(app.bridge_response_path(req_id)).get() or {})
+            ok = bool(data)
+        if not ok: failures.append(f"{bot_name}/{cmd}: beklenen {want}, gelen {got}")
+        print(f"  {'✅' if ok else '❌'} {bot_name:<10} {cmd:<14} {str(got):<24} {'' if at is None else f'{at - t0:5.2f} sn'}")
+
+    serial = len(gateway.sent) * (args.latency + args.interval)
+    print(f"\n  süre {wall:.2f} sn (sıralı tahmin ~{serial:.1f} sn) | mesaj {len(gateway.sent)} | "
+          f"eşzamanlı bot en fazla {gateway.max_total} | bağlantı {gateway.connects}")
+    print(f"  {worker.stats}")
+    if max(gateway.max_per_bot.values()) > 1: failures.append(f"Aynı botla eşzamanlı konuşma: {gateway.max_per_bot}")
+    if gateway.max_total < 2: failures.append("Botlar paralel çalışmadı")
+    if worker.stats['restarts'] != 1 or gateway.connects != 2: failures.append("Yeniden başlatma komutu işlenmedi")
+    if gateway.flood_pending or not worker.stats['flood_waits']: failures.append("FloodWait senaryosu çalışmadı")
+    for f in failures: print(f"  ❌ {f}")
+    print("  ✅ Tüm kontroller geçti." if not failures else f"  ❌ {len(failures)} hata")
+    return 1 if failures else 0
+
+# ==========================================
+# ▶️ GİRİŞ
+# ==========================================
+def main():
+    ap = argparse.ArgumentParser(description="Scalper AI Telegram bridge worker")
+    ap.add_argument("--transport", default=app.IMAGE_TRANSPORT, choices=sorted(app.IMAGE_TRANSPORTS), help="Görsel taşıma katmanı")
+    ap.add_argument("--interval", type=float, default=BOT_MIN_INTERVAL_SEC, help="Bot başına mesaj aralığı (sn)")
+    ap.add_argument("--test", action="store_true", help="Sahte Telegram + sahte RTDB ile kendi kendini sına")
+    ap.add_argument("--latency", type=float, default=0.3, help="Test modu: sahte bot yanıt gecikmesi (sn)")
+    ap.add_argument("--timeout", type=float, default=60, help="Test modu: en uzun süre (sn)")
+    args = ap.parse_args()
+
+    if args.test:
+        if args.interval == BOT_MIN_INTERVAL_SEC: args.interval = 0.1
+        sys.exit(run_self_test(args))
+
+    missing = [k for k in ("TELEGRAM_API_ID", "TELEGRAM_API_HASH", "TELEGRAM_SESSION") if not os.environ.get(k)]
+    if missing: sys.exit(f"Eksik ortam değişkeni: {', '.join(missing)}")
+    app.get_firebase_app()
+    gateway = TelethonGateway(os.environ["TELEGRAM_API_ID"], os.environ["TELEGRAM_API_HASH"], os.environ["TELEGRAM_SESSION"])
+    worker = BridgeWorker(gateway, app.get_image_transport(args.transport), min_interval=args.interval)
+    print(f"🌉 Bridge worker başladı ({len(app.BOT_CONFIGS)} bot, taşıma: {args.transport})")
+    try: asyncio.run(worker.run())
+    except KeyboardInterrupt: pass
+
+if __name__ == "__main__":
+    main()